@@ -0,0 +1,371 @@
+from os import listdir, makedirs, remove, rename, stat, utime
+from os.path import exists, isdir, join
+from mmap import mmap, ACCESS_READ
+from struct import Struct
+from collections import OrderedDict
+from logging import getLogger
+
+from Tracing import span
+
+debug = getLogger('Animations').debug
+
+
+def color(red, green, blue):
+    # same layout as neopixel.Color, which can't be imported without the ws281x library
+    return (red << 16) | (green << 8) | blue
+
+
+LED_COUNT = 28
+
+RED = color(255, 0, 0)
+GREEN = color(0, 255, 0)
+BLUE = color(0, 0, 255)
+YELLOW = color(255, 255, 0)
+PURPLE = color(255, 0, 255)
+WHITE = color(255, 255, 255)
+ORANGE = color(0xFF, 0x8C, 0x00)
+BLACK = color(0, 0, 0)
+
+PALETTE = [RED, GREEN, BLUE, YELLOW, PURPLE, WHITE, ORANGE]
+
+VOLUME_LEVELS = 10
+
+_LEDS = range(LED_COUNT)
+_VOLUME_LEDS = _LEDS[4:14]
+_LEDS_FROM_MIDDLE = _LEDS[2:] + _LEDS[:2]
+_LEDS_SONG = _LEDS_FROM_MIDDLE[2:-2]
+
+# Color gradient from Green to Red
+_VOLUME_LED_COLORS = [0x00FF00, 0x1CE200, 0x38C600, 0x55AA00, 0x718D00, 0x8D7100, 0xAA5500, 0xC63800, 0xE21C00,
+                      0xFF0000]
+
+_FADE_STEPS = 10
+_FADE_FRAME_TIME = 0.05
+_WALK_FRAME_TIME = 0.03
+_RAINBOW_FRAME_TIME = 0.02
+
+_RAINBOW_OFFSETS = [int(i * 256 / LED_COUNT) for i in _LEDS]
+
+
+def _wheel(pos):
+    if pos < 85:
+        return color(pos * 3, 255 - pos * 3, 0)
+    elif pos < 170:
+        pos -= 85
+        return color(255 - pos * 3, 0, pos * 3)
+    else:
+        pos -= 170
+        return color(0, pos * 3, 255 - pos * 3)
+
+
+_WHEEL = [_wheel(pos) for pos in range(256)]
+
+
+#  Animation file format
+#
+#  header: magic, version, led count, frame count, sustain frame
+#  frames: <millis to show the frame> <LED_COUNT colors as 32 bit words>
+#
+# The sustain frame is the one an animation holds on, e.g. the fully lit volume bar. When a running animation is
+# replaced by another variant of itself, it continues from there at the latest instead of starting over.
+#
+# The colors are stored in the layout the ws281x library takes, so playing a frame is a single unpack_from on the
+# mapped file. Bump _VERSION whenever an animation below changes, cached files of other versions are baked again.
+
+_MAGIC = "MLED"
+_VERSION = 2
+
+_HEADER = Struct("<4sHHII")
+_FRAME = Struct("<H" + str(LED_COUNT) + "I")
+
+
+################################################################
+# compiler
+
+class _Recorder(object):
+    def __init__(self):
+        self.frame = [0] * LED_COUNT
+        self.frames = []
+        self.sustain = None
+
+    def push(self, seconds):
+        # a frame that isn't shown for any time is replaced by the next one, that carries its pixels anyway
+        if len(self.frames) is not 0 and self.frames[-1][0] == 0:
+            self.frames.pop()
+        self.frames.append([int(round(seconds * 1000)), list(self.frame)])
+
+    def hold(self, seconds):
+        if self.sustain is None:
+            self.sustain = len(self.frames) - 1
+        self.frames[-1][0] += int(round(seconds * 1000))
+
+
+def _fade_curve(c):
+    r, g, b = (c >> 16) & 255, (c >> 8) & 255, c & 255
+    return [color(int(round(r * 0.1 * s)), int(round(g * 0.1 * s)), int(round(b * 0.1 * s)))
+            for s in range(_FADE_STEPS + 1)]
+
+
+def _clear(recorder):
+    recorder.frame = [0] * LED_COUNT
+    recorder.push(0)
+
+
+def _fade(recorder, leds, curves, steps):
+    for s in steps:
+        for i in range(len(leds)):
+            recorder.frame[leds[i]] = curves[i][s]
+        recorder.push(_FADE_FRAME_TIME)
+
+
+def _fade_up(recorder, leds, colors):
+    _fade(recorder, leds, [_fade_curve(c) for c in colors], range(_FADE_STEPS + 1))
+
+
+def _fade_down(recorder, leds):
+    _fade(recorder, leds, [_fade_curve(recorder.frame[led]) for led in leds], range(_FADE_STEPS - 1, -1, -1))
+
+
+def _fade_up_and_down(recorder, leds, colors):
+    _fade_up(recorder, leds, colors)
+    recorder.hold(0.5)
+    _fade_down(recorder, leds)
+
+
+def _walk_around(recorder, leds, c):
+    color_is_fun = callable(c)
+    for i in leds:
+        recorder.frame[i] = c(i) if color_is_fun else c
+        recorder.push(_WALK_FRAME_TIME)
+
+
+def _rainbow_wheel(pos):
+    return _WHEEL[_RAINBOW_OFFSETS[pos] & 255]
+
+
+def _startup(recorder):
+    for c in [GREEN, _rainbow_wheel, BLACK]:
+        _walk_around(recorder, _LEDS_FROM_MIDDLE, c)
+
+
+def _shutdown(recorder):
+    for c in [_rainbow_wheel, RED, BLACK]:
+        _walk_around(recorder, _LEDS_FROM_MIDDLE, c)
+
+
+def _volume(recorder, volume):
+    _clear(recorder)
+    _fade_up_and_down(recorder, _VOLUME_LEDS[0:volume + 1], _VOLUME_LED_COLORS)
+
+
+def _fade_all(recorder, c):
+    _clear(recorder)
+    _fade_up_and_down(recorder, _LEDS, [c] * LED_COUNT)
+
+
+def _song(recorder, i, n, forward):
+    walk = _LEDS_SONG[2:2 + i] if forward else list(reversed(_LEDS_SONG[3 + i: 2 + n]))
+
+    _clear(recorder)
+    _fade_up(recorder, _LEDS_SONG[:2] + _LEDS_SONG[2 + n: 4 + n], [GREEN] * 2 + [RED] * 2)
+    _walk_around(recorder, walk, YELLOW)
+    _fade_up(recorder, _LEDS_SONG[i + 2: i + 3], [BLUE])
+    _walk_around(recorder, list(reversed(walk)), BLACK)
+    recorder.hold(1)
+    _fade_down(recorder, _LEDS_SONG[:2] + _LEDS_SONG[i + 2: i + 3] + _LEDS_SONG[2 + n: 4 + n])
+
+
+def _rainbow(recorder):
+    # a single cycle, it is played in a loop
+    for j in range(256):
+        recorder.frame = [_WHEEL[(offset + j) & 255] for offset in _RAINBOW_OFFSETS]
+        recorder.push(_RAINBOW_FRAME_TIME)
+
+
+_ANIMATIONS = {
+    "startup": _startup,
+    "shutdown": _shutdown,
+    "volume": _volume,
+    "fade": _fade_all,
+    "song": _song,
+    "rainbow": _rainbow,
+}
+
+
+def compile_animation(name, *args):
+    recorder = _Recorder()
+    _ANIMATIONS[name](recorder, *args)
+
+    frame_count = len(recorder.frames)
+    sustain = frame_count - 1 if recorder.sustain is None else recorder.sustain
+
+    data = [_HEADER.pack(_MAGIC, _VERSION, LED_COUNT, frame_count, sustain)]
+    for millis, frame in recorder.frames:
+        data.append(_FRAME.pack(millis, *frame))
+    return "".join(data)
+
+
+def fixed_variants():
+    # everything that doesn't depend on the library, the song animations are baked once they are needed
+    variants = [("startup",), ("shutdown",), ("rainbow",)]
+    variants += [("volume", volume) for volume in range(VOLUME_LEVELS)]
+    variants += [("fade", c) for c in PALETTE]
+    return variants
+
+
+################################################################
+# playback
+
+class Animation(object):
+    def __init__(self, buf):
+        self._buffer = buf
+
+        if len(buf) < _HEADER.size:
+            raise Exception("truncated animation")
+
+        magic, version, led_count, self.frame_count, self.sustain = _HEADER.unpack_from(buf, 0)
+        if magic != _MAGIC or version != _VERSION or led_count != LED_COUNT:
+            raise Exception("animation of unknown version")
+
+        if len(buf) != _HEADER.size + self.frame_count * _FRAME.size:
+            raise Exception("truncated animation")
+
+    def frame(self, index):
+        # (seconds to show the frame, colors)
+        frame = _FRAME.unpack_from(self._buffer, _HEADER.size + index * _FRAME.size)
+        return frame[0] / 1000.0, frame[1:]
+
+    def close(self):
+        self._buffer.close()
+
+
+class AnimationCache(object):
+    # Animations are baked into cache_dir on first use and played from memory mapped files. Without a cache_dir they
+    # are baked into anonymous memory.
+
+    FILE_SUFFIX = ".anim"
+
+    def __init__(self, cache_dir=None, max_mapped=16, max_files=64):
+        self._cache_dir = cache_dir
+        self._max_mapped = max_mapped
+        self._max_files = max_files
+
+        # key -> Animation, least recently used first
+        self._mapped = OrderedDict()
+
+        self.hits = 0
+        self.loads = 0
+        self.bakes = 0
+
+        if cache_dir is not None and not isdir(cache_dir):
+            makedirs(cache_dir)
+
+    @staticmethod
+    def _key(name, args):
+        return "_".join([name] + [str(arg) for arg in args])
+
+    def get(self, name, *args):
+        key = AnimationCache._key(name, args)
+
+        animation = self._mapped.pop(key, None)
+        if animation is not None:
+            self.hits += 1
+        else:
+            animation = self._load(key)
+            if animation is None:
+                animation = self._bake(key, name, args)
+
+        self._mapped[key] = animation
+
+        while len(self._mapped) > self._max_mapped:
+            self._mapped.popitem(last=False)[1].close()
+
+        return animation
+
+    def _path(self, key):
+        return join(self._cache_dir, key + AnimationCache.FILE_SUFFIX)
+
+    def _load(self, key):
+        if self._cache_dir is None or not exists(self._path(key)):
+            return None
+
+        path = self._path(key)
+        try:
+            animation = AnimationCache._map(path)
+        except Exception as e:
+            debug("baking " + key + " again: " + str(e))
+            remove(path)
+            return None
+
+        # the file's mtime tells the eviction how recently it was used
+        utime(path, None)
+        self.loads += 1
+        return animation
+
+    @staticmethod
+    def _map(path):
+        with open(path, 'rb') as animation_file:
+            return Animation(mmap(animation_file.fileno(), 0, access=ACCESS_READ))
+
+    @staticmethod
+    def _in_memory(data):
+        buf = mmap(-1, len(data))
+        buf.write(data)
+        return Animation(buf)
+
+    def _bake(self, key, name, args):
+        debug("baking " + key)
+        with span("animations.bake"):
+            data = compile_animation(name, *args)
+        self.bakes += 1
+
+        if self._cache_dir is None:
+            return AnimationCache._in_memory(data)
+
+        path = self._path(key)
+        try:
+            with open(path + ".tmp", 'wb') as animation_file:
+                animation_file.write(data)
+            rename(path + ".tmp", path)
+        except (IOError, OSError) as e:
+            debug("could not save animation " + key + ": " + str(e))
+            return AnimationCache._in_memory(data)
+
+        self._evict_files()
+        return AnimationCache._map(path)
+
+    def _evict_files(self):
+        files = [f for f in listdir(self._cache_dir) if f.endswith(AnimationCache.FILE_SUFFIX)]
+        if len(files) <= self._max_files:
+            return
+
+        files.sort(key=lambda f: stat(join(self._cache_dir, f)).st_mtime)
+        for f in files[:len(files) - self._max_files]:
+            debug("evicting " + f)
+            remove(join(self._cache_dir, f))
+
+    def bake_all(self, variants):
+        for variant in variants:
+            self.get(*variant)
+
+
+################################################################
+
+def main():
+    from SetupLogging import setup_stdout_logging
+    from sys import argv
+    from os import environ
+
+    setup_stdout_logging()
+
+    cache_dir = argv[1] if len(argv) > 1 else environ["MARTA"] + "/cache/animations"
+    debug("baking animations into " + cache_dir)
+
+    cache = AnimationCache(cache_dir)
+    cache.bake_all(fixed_variants())
+
+    debug(str(cache.bakes) + " baked, " + str(cache.loads) + " already up to date")
+
+
+if __name__ == "__main__":
+    main()
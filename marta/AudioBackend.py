@@ -0,0 +1,111 @@
+from abc import ABCMeta, abstractmethod
+from threading import Thread
+from Queue import Queue
+from logging import getLogger
+
+from MP3Info import get_mp3_info
+
+debug = getLogger('AudioBcknd').debug
+
+
+class AudioBackend(object):
+    # Everything Marta and the handlers do with audio. MPG123Player remote controls an mpg123 process, PCMPlayer
+    # decodes into a buffer of its own and applies volume and pitch itself.
+    #
+    # Volumes go from 0 to 100, pitches from 50 to 200 (100 is the original speed), positions are in millis.
+    # on_stop_callback is called whenever a track ended or was stopped, on_error_callback if the backend broke down
+    # for good.
+
+    __metaclass__ = ABCMeta
+
+    def __init__(self, prefetch=False):
+        self._prefetch_thread = None
+        if prefetch:
+            self._prefetch_queue = Queue()
+            self._prefetch_thread = Thread(target=self._prefetch_tracks)
+            self._prefetch_thread.daemon = True
+            self._prefetch_thread.start()
+
+    def _prefetch_tracks(self):
+        while True:
+            file_name = self._prefetch_queue.get()
+            if file_name is None:
+                break
+
+            # only the latest request is of interest
+            if not self._prefetch_queue.empty():
+                continue
+
+            debug("prefetching " + file_name)
+            try:
+                # this also pulls the beginning of the file into the page cache
+                get_mp3_info(file_name)
+            except Exception as e:
+                debug("prefetching failed: " + str(e))
+
+    def prefetch_track(self, file_name):
+        # Parses the track's headers in the background, so loading it later on is almost instant
+        if self._prefetch_thread is None:
+            return
+
+        self._prefetch_queue.put(file_name)
+
+    def _stop_prefetching(self):
+        if self._prefetch_thread is not None:
+            debug("waiting for prefetch thread.")
+            self._prefetch_queue.put(None)
+            self._prefetch_thread.join()
+            self._prefetch_thread = None
+
+    @abstractmethod
+    def load_track_from_file(self, file_name, gain=0):
+        # loads the track paused, gain in dB, e.g. from the loudness normalization. False if it can't be played.
+        pass
+
+    @abstractmethod
+    def play_track(self):
+        pass
+
+    @abstractmethod
+    def pause_track(self):
+        pass
+
+    @abstractmethod
+    def stop_track(self):
+        pass
+
+    @abstractmethod
+    def is_track_playing(self):
+        pass
+
+    @abstractmethod
+    def get_volume(self):
+        pass
+
+    @abstractmethod
+    def set_volume(self, volume):
+        pass
+
+    @abstractmethod
+    def get_pitch(self):
+        pass
+
+    @abstractmethod
+    def set_pitch(self, pitch):
+        pass
+
+    @abstractmethod
+    def get_position_in_millis(self):
+        pass
+
+    @abstractmethod
+    def set_position_in_millis(self, position_in_millis):
+        pass
+
+    @abstractmethod
+    def get_track_length_in_millis(self):
+        pass
+
+    @abstractmethod
+    def terminate(self):
+        pass
@@ -0,0 +1,213 @@
+from threading import Thread, Lock
+from Queue import Queue
+from os import stat, devnull
+from logging import getLogger
+from monotonic import monotonic as mtime
+
+from MP3Info import get_mp3_info
+from PCMPlayer import decode, pcm_bytes
+
+debug = getLogger('AudioCache').debug
+
+
+class _Entry(object):
+    def __init__(self, group, data, complete, pinned, file_stat):
+        self.group = group
+        self.data = data
+        self.complete = complete
+        self.pinned = pinned
+        self.file_stat = file_stat
+        self.last_use = mtime()
+
+
+def _file_stat(file_name):
+    file_stat = stat(file_name)
+    return file_stat.st_mtime, file_stat.st_size
+
+
+class AudioCache(object):
+    # Decoded audio from where tracks will probably start playing, so PCMPlayer starts them from RAM while mpg123 is
+    # still opening the file. Entries are decoded by a background thread and belong to a group, e.g. a tag: a group
+    # has one entry at most, a new one replaces the old. Pinned entries stay, the others are evicted once the budget
+    # is exceeded: the groups used least often first, of those the least recently used.
+
+    DEFAULT_BUDGET = 8 * 1024 * 1024
+
+    DEFAULT_SECONDS = 3
+
+    def __init__(self, budget=DEFAULT_BUDGET):
+        self._budget = budget
+
+        # guards everything below, get() is called with the player's lock held so it never touches the disk
+        self._lock = Lock()
+
+        # (file name, position in bytes) -> _Entry
+        self._entries = {}
+
+        # group -> key of its entry
+        self._groups = {}
+
+        # group -> number of uses
+        self._uses = {}
+
+        self._size = 0
+
+        # hits and misses of get(), evictions: entries dropped for the budget, decoded_bytes: by the warm thread
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "decoded_bytes": 0}
+
+        self._warm_queue = Queue()
+        self._warm_thread = Thread(target=self._warm_entries)
+        self._warm_thread.daemon = True
+        self._warm_thread.start()
+
+    def size(self):
+        return self._size
+
+    def use(self, group, count=1):
+        # counts uses of group for the eviction order, e.g. once per tag placed
+        with self._lock:
+            self._uses[group] = self._uses.get(group, 0) + count
+
+    def check(self, file_name):
+        # drops the entries of file_name if it was replaced since they were decoded, call it before get()
+        try:
+            file_stat = _file_stat(file_name)
+        except OSError:
+            file_stat = None
+
+        with self._lock:
+            outdated = [key for key, entry in self._entries.items()
+                        if key[0] == file_name and entry.file_stat != file_stat]
+            for key in outdated:
+                debug("dropping outdated " + file_name)
+                self._remove(key)
+
+    def get(self, file_name, position):
+        # (decoded audio from position (in bytes) on, whether it goes up to the end of the track) or None
+        with self._lock:
+            entry = self._entries.get((file_name, position))
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+
+            entry.last_use = mtime()
+            self.stats["hits"] += 1
+            return entry.data, entry.complete
+
+    def warm(self, group, file_name, position_in_millis=0, seconds=DEFAULT_SECONDS, pinned=False):
+        # decodes seconds of file_name from position_in_millis on in the background, all of it if seconds is None
+        self._warm_queue.put((group, file_name, pcm_bytes(position_in_millis / 1000.0), seconds, pinned))
+
+    def _warm_entries(self):
+        while True:
+            job = self._warm_queue.get()
+            if job is None:
+                break
+
+            group, file_name, position, seconds, pinned = job
+            key = (file_name, position)
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None and entry.group == group:
+                    continue
+
+            try:
+                data, complete, file_stat = self._decode(file_name, position, seconds)
+            except Exception as e:
+                debug("could not decode " + file_name + ": " + str(e))
+                continue
+
+            with self._lock:
+                self._put(group, key, _Entry(group, data, complete, pinned, file_stat))
+
+    def _decode(self, file_name, position, seconds):
+        file_stat = _file_stat(file_name)
+        size = None if seconds is None else pcm_bytes(seconds)
+
+        with open(devnull, 'w') as null:
+            process, skip = decode(file_name, get_mp3_info(file_name), position, null)
+            try:
+                process.stdout.read(skip)
+                data = process.stdout.read() if size is None else process.stdout.read(size)
+            finally:
+                if process.poll() is None:
+                    process.kill()
+                process.stdout.close()
+                process.wait()
+
+        self.stats["decoded_bytes"] += len(data)
+        return data, size is None or len(data) < size, file_stat
+
+    def _put(self, group, key, entry):
+        # the entries this one replaces count as free, but stay until it is certain that it fits
+        replaced = set(k for k in (self._groups.get(group), key) if k in self._entries)
+        if not self._make_room(len(entry.data), replaced) and not entry.pinned:
+            debug("no room for " + str(len(entry.data)) + " bytes of " + key[0])
+            return
+
+        for k in replaced:
+            self._remove(k)
+
+        self._entries[key] = entry
+        self._groups[group] = key
+        self._size += len(entry.data)
+        debug("cached %s bytes of %s at %s, %s bytes in total", len(entry.data), key[0], key[1], self._size)
+
+    def _make_room(self, size, replaced):
+        # False if the pinned entries leave no room for size bytes, nothing is evicted then
+        needed = self._size - sum(len(self._entries[key].data) for key in replaced) + size - self._budget
+        if needed <= 0:
+            return True
+
+        candidates = [(self._uses.get(entry.group, 0), entry.last_use, key)
+                      for key, entry in self._entries.items() if not entry.pinned and key not in replaced]
+        if sum(len(self._entries[key].data) for _, _, key in candidates) < needed:
+            return False
+
+        candidates.sort()
+        for uses, last_use, key in candidates:
+            needed -= len(self._entries[key].data)
+            self._remove(key)
+            self.stats["evictions"] += 1
+            if needed <= 0:
+                break
+        return True
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        if self._groups.get(entry.group) == key:
+            del self._groups[entry.group]
+        self._size -= len(entry.data)
+
+    def terminate(self):
+        debug("waiting for warm thread.")
+        self._warm_queue.put(None)
+        self._warm_thread.join()
+        debug(str(self.stats) + ", " + str(self._size) + " bytes")
+
+
+################################################################
+
+def main():
+    from SetupLogging import setup_stdout_logging
+    from sys import argv
+    from time import sleep
+    setup_stdout_logging()
+
+    if len(argv) < 2:
+        debug("usage: AudioCache.py <mp3 file> [<position in millis>]")
+        exit(1)
+
+    position_in_millis = int(argv[2]) if len(argv) > 2 else 0
+    cache = AudioCache()
+    start = mtime()
+    cache.warm("main", argv[1], position_in_millis)
+    while cache.get(argv[1], pcm_bytes(position_in_millis / 1000.0)) is None:
+        sleep(.01)
+    debug("decoded in " + str(round(mtime() - start, 3)) + " s")
+
+    cache.terminate()
+
+
+if __name__ == "__main__":
+    main()
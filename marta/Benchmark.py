@@ -0,0 +1,188 @@
+from os import times
+from resource import getrusage, RUSAGE_SELF
+from os.path import abspath
+from subprocess import call
+from sys import argv, executable
+from threading import Thread
+from time import sleep
+from logging import getLogger, StreamHandler, Formatter, DEBUG
+from monotonic import monotonic as mtime
+
+import Simulation
+
+debug = getLogger(' Benchmark').debug
+
+
+#  Event traces
+#
+# One event per line, "#" starts a comment:
+#
+#   <seconds since start> tag <index into Simulation.LIBRARY_TAGS or a 12 digit tag>
+#   <seconds since start> untag
+#   <seconds since start> button <YELLOW|BLUE|RED|GREEN> [<millis pushed>]
+#   <seconds since start> tilt <x degrees> <y degrees>
+#
+# Events are replayed in real time through the simulated hardware, so they take the same path through Buttons,
+# RFIDReader, MPU, Marta.message_loop and MPG123Player as on the device.
+
+_DEFAULT_PUSH_MILLIS = 100
+
+# time for the last events to be handled before the power button ends the run
+_SETTLE_TIME = 2
+
+
+def load_trace(trace_path):
+    events = []
+    with open(trace_path) as trace_file:
+        for line in trace_file:
+            line = line.split("#")[0].strip()
+            if line == "":
+                continue
+
+            parts = line.split()
+            events.append((float(parts[0]), parts[1], parts[2:]))
+
+    return sorted(events, key=lambda event: event[0])
+
+
+def _replay(events):
+    import Buttons
+    pins = dict((name, pin) for pin, name in Buttons.BUTTONS_HUMAN_READABLE.items())
+
+    start = mtime()
+    for at, action, args in events:
+        wait = start + at - mtime()
+        if wait > 0:
+            sleep(wait)
+
+        if action == "tag":
+            tag = args[0]
+            Simulation.present_tag(Simulation.LIBRARY_TAGS[int(tag)] if len(tag) < 12 else tag)
+        elif action == "untag":
+            Simulation.remove_tag()
+        elif action == "button":
+            Simulation.push_button(pins[args[0]], int(args[1]) if len(args) > 1 else _DEFAULT_PUSH_MILLIS)
+        elif action == "tilt":
+            Simulation.tilt(float(args[0]), float(args[1]))
+        else:
+            raise Exception("unknown trace action: " + action)
+
+
+def _context_switches():
+    # (voluntary, involuntary) of all threads of this process so far, including those that ended already
+    usage = getrusage(RUSAGE_SELF)
+    return usage.ru_nvcsw, usage.ru_nivcsw
+
+
+def run(trace_path, led_process=False, use_reactor=True, pcm_audio=False):
+    Simulation.setup()
+
+    import Buttons
+    import Tracing
+    from Marta import Marta
+
+    events = load_trace(trace_path)
+    Tracing.enable()
+
+    boot_start = mtime()
+    marta = Marta(led_process=led_process, use_reactor=use_reactor, pcm_audio=pcm_audio)
+    boot_time = mtime() - boot_start
+
+    loop = Thread(target=marta.message_loop)
+    loop.daemon = True
+
+    cpu_before = times()
+    switches_before = _context_switches()
+    reactor_before = {} if marta.reactor is None else dict(marta.reactor.stats)
+    hardware_before = Simulation.hardware_stats()
+    start = mtime()
+    loop.start()
+
+    _replay(events)
+    sleep(_SETTLE_TIME)
+
+    Simulation.push_button(Buttons.POWER_BUTTON)
+    loop.join()
+
+    wall = mtime() - start
+    cpu_after = times()
+    switches_after = _context_switches()
+    cpu = (cpu_after[0] - cpu_before[0]) + (cpu_after[1] - cpu_before[1])
+    hardware_after = Simulation.hardware_stats()
+
+    stats = Tracing.stats()
+    handled = sum(stats[name][0] for name in stats if name.startswith("event."))
+
+    debug("trace: " + trace_path)
+    debug("boot: %.2f s, replay: %.2f s, events: %d handled of %d replayed" % (boot_time, wall, handled, len(events)))
+    debug("cpu: %.3f s total, %.1f%% of wall time, %.2f ms per handled event" % (
+        cpu, cpu / wall * 100, cpu / max(1, handled) * 1000))
+
+    # every voluntary switch is a thread going to sleep, so they count the wakeups of all threads together
+    minutes = wall / 60
+    debug("context switches: %d voluntary, %d involuntary per minute (%s)" % (
+        (switches_after[0] - switches_before[0]) / minutes, (switches_after[1] - switches_before[1]) / minutes,
+        "threads" if marta.reactor is None else "reactor"))
+    if marta.reactor is not None:
+        for name in sorted(marta.reactor.stats):
+            debug("%-24s %d per minute" % ("reactor." + name,
+                                           (marta.reactor.stats[name] - reactor_before[name]) / minutes))
+
+    for name in sorted(hardware_after):
+        debug("%-24s %d" % (name, hardware_after[name] - hardware_before.get(name, 0)))
+
+    for line in Tracing.summary().splitlines():
+        debug(line)
+
+    marta.terminate()
+
+    # the mpu accounts for its last sleep when it is woken up to terminate
+    for name in sorted(marta.mpu.stats):
+        debug("%-24s %s" % ("mpu." + name, marta.mpu.stats[name]))
+
+    for name in sorted(marta.rfid_reader.stats):
+        debug("%-24s %s" % ("rfid." + name, marta.rfid_reader.stats[name]))
+
+    for name in sorted(getattr(marta.player, "stats", {})):
+        debug("%-24s %s" % ("player." + name, marta.player.stats[name]))
+
+    if marta.audio_cache is not None:
+        for name in sorted(marta.audio_cache.stats):
+            debug("%-24s %s" % ("cache." + name, marta.audio_cache.stats[name]))
+        debug("%-24s %s" % ("cache.size", marta.audio_cache.size()))
+
+    # with the renderer in its own process, the simulated strip's counters above stay in there
+    leds = marta.leds.stats
+    for name in sorted(leds):
+        debug("%-24s %s" % ("leds.frame." + name, leds[name]))
+
+
+def main():
+    logger = getLogger(' Benchmark')
+    logger.setLevel(DEBUG)
+    handler = StreamHandler()
+    handler.setFormatter(Formatter("%(message)s"))
+    logger.addHandler(handler)
+
+    options = [arg for arg in argv[1:] if arg.startswith("--")]
+    traces = [arg for arg in argv[1:] if not arg.startswith("--")]
+
+    if len(traces) is 0:
+        debug("usage: Benchmark.py [--led-process] [--threads] [--pcm] <trace file> [<trace file> ...]")
+        exit(1)
+
+    if "--run" in options:
+        run(traces[0], led_process="--led-process" in options, use_reactor="--threads" not in options,
+            pcm_audio="--pcm" in options)
+        return
+
+    # every trace gets a fresh process, the handlers and the tag directory are global
+    exit_val = 0
+    for trace_path in traces:
+        exit_val |= call([executable, abspath(__file__), "--run", trace_path] + options)
+
+    exit(exit_val)
+
+
+if __name__ == "__main__":
+    main()
@@ -8,6 +8,9 @@ debug = getLogger('   Buttons').debug
 POWER_BUTTON = 17
 RUN_LED = 20
 
+# INT of the MPU-6050
+MPU_INTERRUPT = 16
+
 YELLOW_BUTTON = 5
 BLUE_BUTTON = 6
 RED_BUTTON = 13
@@ -0,0 +1,126 @@
+from heapq import heappush, heappop
+from threading import Condition
+from Queue import Empty
+from logging import getLogger
+from monotonic import monotonic as mtime
+
+debug = getLogger('  EventBus').debug
+
+
+class EventBus(object):
+    PRIORITY_CRITICAL = 0
+    PRIORITY_NORMAL = 1
+
+    # entry = [priority, sequence, time put, message, key], message is None if the entry was dropped
+    _MESSAGE = 3
+    _KEY = 4
+
+    def __init__(self):
+        self._condition = Condition()
+        self._heap = []
+        self._sequence = 0
+        self._depth = 0
+        self._max_depth = 0
+
+        # key -> pending entries with this key, oldest first
+        self._keyed = {}
+
+        # event name -> [count, sum of latencies, max latency]
+        self._latencies = {}
+
+    def put(self, message, priority=PRIORITY_NORMAL, key=None, replace=False):
+        # replace: drop all pending messages with the same key, only the latest one is of interest
+        with self._condition:
+            if replace and key is not None:
+                for entry in list(self._keyed.get(key, [])):
+                    self._drop(entry)
+
+            entry = [priority, self._sequence, mtime(), message, key]
+            self._sequence += 1
+            heappush(self._heap, entry)
+
+            if key is not None:
+                self._keyed.setdefault(key, []).append(entry)
+
+            self._depth += 1
+            self._max_depth = max(self._max_depth, self._depth)
+            self._condition.notify()
+
+    def _drop(self, entry):
+        entry[EventBus._MESSAGE] = None
+        self._keyed[entry[EventBus._KEY]].remove(entry)
+        self._depth -= 1
+
+    def get(self, timeout=None):
+        # Returns the most important message and the time it was put, raises Empty after timeout seconds
+        end = None if timeout is None else mtime() + timeout
+        with self._condition:
+            while True:
+                while len(self._heap) is not 0:
+                    entry = heappop(self._heap)
+                    if entry[EventBus._MESSAGE] is None:
+                        continue
+
+                    if entry[EventBus._KEY] is not None:
+                        self._keyed[entry[EventBus._KEY]].remove(entry)
+
+                    self._depth -= 1
+                    return entry[EventBus._MESSAGE], entry[2]
+
+                if end is None:
+                    self._condition.wait()
+                    continue
+
+                remaining = end - mtime()
+                if remaining <= 0:
+                    raise Empty()
+
+                self._condition.wait(remaining)
+
+    def clear(self):
+        with self._condition:
+            self._heap = []
+            self._keyed = {}
+            self._depth = 0
+
+    def discard(self, keep_keys):
+        # drops all pending messages except those with one of the given keys
+        with self._condition:
+            for entry in self._heap:
+                if entry[EventBus._MESSAGE] is not None and entry[EventBus._KEY] not in keep_keys:
+                    if entry[EventBus._KEY] is None:
+                        entry[EventBus._MESSAGE] = None
+                        self._depth -= 1
+                    else:
+                        self._drop(entry)
+
+    def take(self, key):
+        # removes the oldest pending message with this key and returns it, None if there is none
+        with self._condition:
+            if len(self._keyed.get(key, [])) is 0:
+                return None
+
+            entry = self._keyed[key][0]
+            message = entry[EventBus._MESSAGE]
+            self._drop(entry)
+            return message
+
+    def has_pending(self, key):
+        return len(self._keyed.get(key, [])) is not 0
+
+    def depth(self):
+        return self._depth
+
+    def record_dispatch(self, name, put_time):
+        latency = mtime() - put_time
+        stats = self._latencies.setdefault(name, [0, 0.0, 0.0])
+        stats[0] += 1
+        stats[1] += latency
+        stats[2] = max(stats[2], latency)
+
+    def log_stats(self):
+        debug("max queue depth: " + str(self._max_depth))
+        for name in sorted(self._latencies):
+            count, total, maximum = self._latencies[name]
+            debug(name + ": " + str(count) + " events, avg " + str(int(total / count * 1000)) + " ms, max " + str(
+                int(maximum * 1000)) + " ms")
@@ -0,0 +1,311 @@
+from os import listdir, stat, rename, fsync
+from os.path import isdir, exists, join, dirname
+from multiprocessing import Pool
+from cPickle import load, dump, HIGHEST_PROTOCOL
+from logging import getLogger
+from monotonic import monotonic as mtime
+
+from Loudness import analyze, loudness, merge, gain
+from MP3Info import MP3Info, get_mp3_info, check_frames, remember
+from TagToDir import TAG_DIR_REGEX, ALBUM_TO_SONGS, prepare_albums
+from Util import sorted_aphanumeric
+from Tracing import span
+
+debug = getLogger('    Ingest').debug
+
+# song file -> gain in dB to play it with, filled by load_manifest
+TRACK_GAINS = {}
+
+# Bump this whenever the structure of the manifest changes, old manifests will be dropped and everything is checked
+# again.
+_MANIFEST_VERSION = 2
+
+
+#  Library manifest structure
+#
+#  {
+#    "version": _MANIFEST_VERSION,
+#    "files": {
+#      <song file, relative to the audio dir>: {
+#        "mtime": <mtime of the file>,
+#        "size": <size of the file>,
+#        "frames": <number of mpeg frames>,
+#        "info": (sample rate, total samples, bitrate, vbr) or None,
+#        "histogram": <block loudness histogram, see Loudness.py> or None,
+#        "loudness": <gated loudness in dB> or None,
+#        "problem": <why it won't play> or None
+#      }
+#    },
+#    "albums": {<album dir relative to the audio dir>: <gated loudness of all its songs in dB> or None},
+#    "problems": {<directory relative to the audio dir>: <what is wrong with it>}
+#  }
+#
+# Files with an unchanged mtime and size are taken from the old manifest without reading them again.
+
+def _load_manifest(manifest_path):
+    if not exists(manifest_path):
+        return None
+
+    try:
+        with open(manifest_path, 'rb') as manifest_file:
+            manifest = load(manifest_file)
+    except Exception as e:
+        debug("ignoring broken library manifest: " + str(e))
+        return None
+
+    if not isinstance(manifest, dict) or manifest.get("version") != _MANIFEST_VERSION:
+        debug("ignoring library manifest of unknown version")
+        return None
+
+    return manifest
+
+
+def _save_manifest(manifest_path, manifest):
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, 'wb') as manifest_file:
+        dump(manifest, manifest_file, HIGHEST_PROTOCOL)
+        manifest_file.flush()
+        fsync(manifest_file.fileno())
+    rename(tmp_path, manifest_path)
+
+
+def _relative(audio_path, path):
+    return path[len(audio_path):].strip("/")
+
+
+def _collect(audio_path):
+    # (song files relative to audio_path, problems), checks the layout just like TagToDir.prepare does
+    songs = []
+    problems = {}
+    tags = {}
+
+    for d in sorted_aphanumeric(listdir(audio_path)):
+        current = audio_path + "/" + d
+
+        if d == "system":
+            songs += [join(d, f) for f in sorted_aphanumeric(listdir(current))]
+            continue
+
+        if not isdir(current):
+            problems[d] = "not a directory"
+            continue
+
+        if not TAG_DIR_REGEX.match(d):
+            problems[d] = "naming convention error"
+            continue
+
+        tag = d[-12:]
+        if tag in tags:
+            problems[d] = "tag found twice, also in " + tags[tag]
+            continue
+        tags[tag] = d
+
+        try:
+            albums = prepare_albums(current)[0]
+        except Exception as e:
+            problems[d] = str(e)
+            continue
+
+        for album in albums:
+            songs += [join(_relative(audio_path, album), song) for song in ALBUM_TO_SONGS[album]]
+
+    return songs, problems
+
+
+def _check_file(job):
+    # runs in the worker processes
+    path, relative = job
+    file_stat = stat(path)
+    entry = {"mtime": file_stat.st_mtime, "size": file_stat.st_size, "frames": 0, "info": None, "histogram": None,
+             "loudness": None, "problem": None}
+
+    try:
+        entry["frames"], entry["problem"] = check_frames(path)
+        if entry["problem"] is None:
+            info = get_mp3_info(path)
+            if info is None:
+                entry["problem"] = "no length information"
+            else:
+                entry["info"] = (info.sample_rate, info.total_samples, info.bitrate, info.vbr)
+    except Exception as e:
+        entry["problem"] = str(e)
+
+    return relative, entry
+
+
+def _measure_file(job):
+    # runs in the worker processes
+    path, relative, entry = job
+    try:
+        entry["histogram"] = analyze(path, entry["info"][0], entry["info"][1])
+        if entry["histogram"] is not None:
+            entry["loudness"] = loudness(entry["histogram"])
+    except Exception as e:
+        # the song still plays, just without a gain, the next ingest tries again
+        debug("could not measure " + relative + ": " + str(e))
+        entry["histogram"] = None
+
+    return relative, entry
+
+
+def _unmeasured(files):
+    # playable files without a loudness yet, the biggest first
+    return sorted(((entry["size"], relative) for relative, entry in files.items()
+                   if entry["problem"] is None and entry["info"] is not None and entry["histogram"] is None),
+                  reverse=True)
+
+
+def _save(manifest_path, manifest, old_manifest):
+    album_histograms = {}
+    for relative, entry in manifest["files"].items():
+        if entry["histogram"] is not None:
+            album_histograms.setdefault(dirname(relative), []).append(entry["histogram"])
+    manifest["albums"] = dict((album, loudness(merge(histograms))) for album, histograms in album_histograms.items())
+
+    if manifest != old_manifest:
+        debug("saving library manifest")
+        _save_manifest(manifest_path, manifest)
+
+
+def ingest(audio_path, manifest_path, processes=None):
+    start = mtime()
+
+    old_manifest = _load_manifest(manifest_path)
+    old_files = {} if old_manifest is None else old_manifest["files"]
+
+    songs, problems = _collect(audio_path)
+
+    files = {}
+    jobs = []
+    for relative in songs:
+        path = join(audio_path, relative)
+        file_stat = stat(path)
+        entry = old_files.get(relative)
+        if entry is not None and entry["mtime"] == file_stat.st_mtime and entry["size"] == file_stat.st_size:
+            files[relative] = entry
+        else:
+            jobs.append((file_stat.st_size, path, relative))
+
+    # the biggest files first, so no worker is left alone with a long audiobook at the end
+    jobs.sort(reverse=True)
+    checked_bytes = sum(job[0] for job in jobs)
+
+    manifest = {"version": _MANIFEST_VERSION, "files": files, "albums": {}, "problems": problems}
+    measured = 0
+    pool = None
+    try:
+        if len(jobs) is not 0:
+            pool = Pool(processes)
+            with span("ingest.check"):
+                for relative, entry in pool.imap_unordered(_check_file, [job[1:] for job in jobs]):
+                    files[relative] = entry
+
+        # Marta can use the index right away, the gains follow once the second pass measured the loudness
+        _save(manifest_path, manifest, old_manifest)
+        seconds = max(mtime() - start, 0.001)
+        audio_seconds = sum(entry["info"][1] / float(entry["info"][0]) for entry in files.values() if entry["info"])
+        debug(str(len(files)) + " files, " + str(len(files) - len(jobs)) + " unchanged, " + str(len(jobs)) +
+              " checked in " + str(round(seconds, 2)) + " s (" + str(int(len(jobs) / seconds)) + " files/s, " +
+              str(round(checked_bytes / seconds / 1024 / 1024, 1)) + " MB/s), " + str(
+            round(audio_seconds / 3600, 1)) + " hours of audio")
+
+        unmeasured = _unmeasured(files)
+        if len(unmeasured) is not 0:
+            measure_start = mtime()
+            pool = pool or Pool(processes)
+            with span("ingest.loudness"):
+                measure_jobs = [(join(audio_path, relative), relative, files[relative]) for _, relative in unmeasured]
+                for relative, entry in pool.imap_unordered(_measure_file, measure_jobs):
+                    files[relative] = entry
+                    measured += 1
+
+            _save(manifest_path, manifest, None)
+            debug(str(measured) + " files measured in " + str(round(mtime() - measure_start, 2)) + " s")
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    return manifest
+
+
+def manifest_problems(manifest):
+    # (path relative to the audio dir, problem), sorted
+    problems = dict(manifest["problems"])
+    for relative, entry in manifest["files"].items():
+        if entry["problem"] is not None:
+            problems[relative] = entry["problem"]
+    return sorted(problems.items())
+
+
+def load_manifest(audio_path, manifest_path, album_gain=True):
+    # Call after TagToDir.prepare: songs that won't play are dropped from ALBUM_TO_SONGS, MP3Info gets the lengths
+    # without reading a single header and TRACK_GAINS is filled. The album gain keeps the quiet and the loud songs of
+    # an album apart, just like they were mastered.
+    with span("library.manifest"):
+        manifest = _load_manifest(manifest_path)
+        if manifest is None:
+            debug("no library manifest, run Ingest.py")
+            return
+
+        files = manifest["files"]
+        for album_dir, songs in ALBUM_TO_SONGS.items():
+            relative_album = _relative(audio_path, album_dir)
+            album_loudness = manifest["albums"].get(relative_album) if album_gain else None
+            playable = []
+            for song in songs:
+                path = album_dir + "/" + song
+                entry = files.get(join(relative_album, song))
+
+                # added after the last ingest
+                if entry is None:
+                    playable.append(song)
+                    continue
+
+                if entry["problem"] is not None:
+                    # it might have been replaced since, only the broken files are worth a stat
+                    file_stat = stat(path)
+                    if entry["mtime"] == file_stat.st_mtime and entry["size"] == file_stat.st_size:
+                        debug("skipping " + path + ": " + entry["problem"])
+                        continue
+
+                elif entry["info"] is not None:
+                    remember(path, entry["mtime"], entry["size"], MP3Info(*entry["info"]))
+                    TRACK_GAINS[path] = gain(entry["loudness"] if album_loudness is None else album_loudness)
+
+                playable.append(song)
+
+            # an album without songs wouldn't play either way
+            if len(playable) is not 0:
+                ALBUM_TO_SONGS[album_dir] = playable
+
+
+################################################################
+
+def main():
+    from SetupLogging import setup_stdout_logging
+    from sys import argv
+    from os import environ
+
+    setup_stdout_logging()
+
+    if len(argv) > 3:
+        debug("usage: Ingest.py [<audio dir> [<manifest>]]")
+        exit(1)
+
+    audio_path = argv[1] if len(argv) > 1 else environ["MARTA"] + "/audio"
+    manifest_path = argv[2] if len(argv) > 2 else environ["MARTA"] + "/cache/library.manifest"
+
+    problems = manifest_problems(ingest(audio_path.rstrip("/"), manifest_path))
+    for relative, problem in problems:
+        debug("Error: " + relative + ": " + problem)
+
+    if len(problems) is not 0:
+        exit(1)
+
+    debug("Everything seems fine.")
+    exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,289 @@
 from Queue import Queue, Empty
 
 from neopixel import *
-from threading import Thread
+from threading import Thread, Lock, Event
+from multiprocessing import Process, Pipe
+from multiprocessing.sharedctypes import RawArray
 from logging import getLogger
+from monotonic import monotonic as mtime
+
+from Tracing import span
+import Animations
+from Animations import AnimationCache
 
 debug = getLogger('  LEDStrip').debug
 
 
-class SleepInterruptedException(Exception):
-    def __init__(self, message):
-        super(SleepInterruptedException, self).__init__("")
-        self.msg = message
+class _Layer(object):
+    def __init__(self, name, animation, loop, now):
+        self.name = name
+        self.loop = loop
+        self.animation = animation
+        self.index = 0
+        frame_time, self.colors = animation.frame(0)
+        self.next_time = now + frame_time
+
+    def replace(self, animation, now):
+        # another variant of the running animation: go on from the same frame, but not beyond the sustain frame
+        index = min(self.index, animation.sustain, animation.frame_count - 1)
+        frame_time, self.colors = animation.frame(index)
+        self.animation = animation
+
+        if index != self.index:
+            self.index = index
+            self.next_time = now + frame_time
+
+    def advance(self, now):
+        # returns False once a non looping animation is over
+        while now >= self.next_time:
+            self.index += 1
+            if self.index == self.animation.frame_count:
+                if not self.loop:
+                    return False
+                self.index = 0
+
+            frame_time, self.colors = self.animation.frame(self.index)
+            self.next_time += frame_time
+
+        return True
+
+
+class _Renderer(object):
+    # Owns the strip and plays the layers. Runs in the LED thread, on the Reactor's timers or, with separate_process,
+    # in a process of its own that doesn't share the GIL with the event loop.
+
+    # frame timing: [frames, sum of lateness, max lateness, histogram of lateness in millis...]
+    _TIMING_FRAMES = 0
+    _TIMING_SUM = 1
+    _TIMING_MAX = 2
+    _TIMING_HISTOGRAM = 3
+    TIMING_BINS = 50
+
+    def __init__(self, animation_cache_dir, frame_buffer, timing):
+        self._strip = Adafruit_NeoPixel(LEDStrip._LED_COUNT, LEDStrip._LED_PIN, LEDStrip._LED_FREQ_HZ,
+                                        LEDStrip._LED_DMA, LEDStrip._LED_INVERT, LEDStrip._LED_BRIGHTNESS,
+                                        LEDStrip._LED_CHANNEL, LEDStrip._LED_STRIP)
+        self._strip.begin()
+
+        # the animations are pre-rendered, playing them back doesn't compute anything
+        self._animations = AnimationCache(animation_cache_dir)
+
+        # layer -> _Layer, only running animations have a layer
+        self._layers = {}
+        self._shown = [None] * LEDStrip._LED_COUNT
+
+        # both might live in shared memory, the renderer is the only one writing them
+        self._frame_buffer = frame_buffer
+        self._timing = timing
+
+    def run(self, receive):
+        # Requests change the layers in place, running animations go on. All pending requests are applied before
+        # the next frame, so a storm of requests still only costs one frame of latency.
+        # receive(timeout) returns the next request or None once the timeout passed, timeout None waits forever.
+        while True:
+            due = self._next_frame_time()
+            msg = receive(None if due is None else max(0, due - mtime()))
+
+            if msg is None:
+                lateness = mtime() - due
+
+                # the pipe's poll works in whole millis and might return a little early
+                if lateness < 0:
+                    continue
+
+                # anything after the frame was due is jitter
+                self._record_lateness(lateness)
+
+            while msg is not None:
+                event = msg[0]
+                debug("event: %s", LEDStrip._EVENTS_HUMAN_READABLE[event])
+
+                if event == LEDStrip._EVENT_TERMINATE:
+                    self._push_frame([0] * LEDStrip._LED_COUNT)
+                    return
+
+                with span("leds." + LEDStrip._EVENTS_HUMAN_READABLE[event]):
+                    self._handle(msg)
+
+                msg = receive(0)
+
+            self._render()
+
+    def attach(self, reactor, terminated):
+        # instead of run(): requests come through request() and the frames are timers on the reactor
+        self._reactor = reactor
+        self._terminated = terminated
+        self._frame_timer = None
+        self._render_pending = False
+
+    def request(self, msg):
+        # on the reactor, like run() all requests handed over together are applied before the next frame
+        if self._terminated.isSet():
+            return
+
+        event = msg[0]
+        debug("event: %s", LEDStrip._EVENTS_HUMAN_READABLE[event])
+
+        if event == LEDStrip._EVENT_TERMINATE:
+            if self._frame_timer is not None:
+                self._frame_timer.cancel()
+            self._push_frame([0] * LEDStrip._LED_COUNT)
+            self._terminated.set()
+            return
+
+        with span("leds." + LEDStrip._EVENTS_HUMAN_READABLE[event]):
+            self._handle(msg)
+
+        # runs after the requests that are already waiting on the reactor
+        if not self._render_pending:
+            self._render_pending = True
+            self._reactor.call_soon_threadsafe(self._render_requested)
+
+    def _render_requested(self):
+        self._render_pending = False
+        if self._terminated.isSet():
+            return
+
+        self._render()
+        self._schedule_frame()
+
+    def _frame_due(self, due):
+        self._frame_timer = None
+        if self._terminated.isSet():
+            return
+
+        # timers are never early, anything after the frame was due is jitter
+        self._record_lateness(mtime() - due)
+        self._render()
+        self._schedule_frame()
+
+    def _schedule_frame(self):
+        if self._frame_timer is not None:
+            self._frame_timer.cancel()
+
+        due = self._next_frame_time()
+        self._frame_timer = None if due is None else self._reactor.call_later(max(0, due - mtime()), self._frame_due,
+                                                                               due)
+
+    def _next_frame_time(self):
+        if len(self._layers) is 0:
+            return None
+
+        return min(layer.next_time for layer in self._layers.values())
+
+    def _record_lateness(self, lateness):
+        timing = self._timing
+        timing[_Renderer._TIMING_FRAMES] += 1
+        timing[_Renderer._TIMING_SUM] += lateness
+        timing[_Renderer._TIMING_MAX] = max(timing[_Renderer._TIMING_MAX], lateness)
+        timing[_Renderer._TIMING_HISTOGRAM + min(int(lateness * 1000), _Renderer.TIMING_BINS - 1)] += 1
+
+    def _handle(self, msg):
+        event = msg[0]
+
+        if event == LEDStrip._EVENT_RAINBOW_DEMO:
+            self._show_alone("rainbow", self._animations.get("rainbow"), loop=True)
+
+        elif event == LEDStrip._EVENT_VOLUME:
+            debug("animating volume %s", msg[1])
+            self._show(LEDStrip._LAYER_VOLUME, "volume", self._animations.get("volume", msg[1]))
+
+        elif event == LEDStrip._EVENT_FADE_UP_AND_DOWN:
+            debug("fading %s", msg[1])
+            self._show(LEDStrip._LAYER_FLASH, "fade", self._animations.get("fade", msg[1]))
+
+        elif event == LEDStrip._EVENT_STARTUP:
+            debug("startup animation")
+            self._show_alone("startup", self._animations.get("startup"))
+
+        elif event == LEDStrip._EVENT_SHUTDOWN:
+            debug("shutdown animation")
+            self._show_alone("shutdown", self._animations.get("shutdown"))
+
+        elif event == LEDStrip._EVENT_SONG:
+            debug("song %s %s", msg[1], msg[2])
+            # the song position is what the flash before it was about
+            self._layers.pop(LEDStrip._LAYER_FLASH, None)
+            self._show(LEDStrip._LAYER_BACKGROUND, "song", self._animations.get("song", msg[1], msg[2], msg[3]))
+
+        elif event == LEDStrip._EVENT_CLEAR:
+            self._layers.clear()
+
+        elif event == LEDStrip._EVENT_BRIGHTNESS:
+            self._strip.setBrightness(msg[1])
+            # the brightness is applied when the pixels are sent
+            self._shown = [None] * LEDStrip._LED_COUNT
+
+    def _show_alone(self, name, animation, loop=False):
+        for layer in [LEDStrip._LAYER_VOLUME, LEDStrip._LAYER_FLASH]:
+            self._layers.pop(layer, None)
+        self._show(LEDStrip._LAYER_BACKGROUND, name, animation, loop)
+
+    def _show(self, layer_id, name, animation, loop=False):
+        now = mtime()
+        layer = self._layers.get(layer_id)
+
+        if layer is None or layer.name != name:
+            self._layers[layer_id] = _Layer(name, animation, loop, now)
+        else:
+            layer.replace(animation, now)
+
+    def _render(self):
+        now = mtime()
+        for layer_id in list(self._layers):
+            if not self._layers[layer_id].advance(now):
+                del self._layers[layer_id]
+
+        layers = [self._layers[layer_id] for layer_id in LEDStrip._LAYERS if layer_id in self._layers]
+
+        if len(layers) is 0:
+            self._push_frame([0] * LEDStrip._LED_COUNT)
+        elif len(layers) is 1:
+            self._push_frame(layers[0].colors)
+        else:
+            frame = list(layers[0].colors)
+            for layer in layers[1:]:
+                for i, c in enumerate(layer.colors):
+                    if c:
+                        frame[i] = c
+            self._push_frame(frame)
+
+    def _push_frame(self, frame):
+        # the SWIG wrapper has no bulk write, so only the pixels that changed are written
+        shown = self._shown
+        changed = False
+        for i in LEDStrip._LEDS:
+            if frame[i] != shown[i]:
+                self._strip.setPixelColor(i, frame[i])
+                shown[i] = frame[i]
+                changed = True
+
+        if changed:
+            self._strip.show()
+            self._frame_buffer[:] = frame
+
+
+def _run_renderer_process(connection, animation_cache_dir, frame_buffer, timing):
+    # Forked from a process with threads, whose log handler locks might have been held by one of them
+    for handler in getLogger('').handlers:
+        handler.createLock()
+        if hasattr(handler, "after_fork"):
+            handler.after_fork()
+
+    def receive(timeout):
+        if not connection.poll(timeout):
+            return None
+        return connection.recv()
+
+    _Renderer(animation_cache_dir, frame_buffer, timing).run(receive)
+
+    # the process ends without running the atexit handlers
+    for handler in getLogger('').handlers:
+        handler.flush()
 
 
 class LEDStrip(object):
-    _LED_COUNT = 28  # Number of LED pixels.
+    _LED_COUNT = Animations.LED_COUNT  # Number of LED pixels.
     _LED_PIN = 12  # GPIO pin connected to the pixels (18 uses PWM!).
     _LED_FREQ_HZ = 800000  # LED signal frequency in hertz (usually 800khz)
     _LED_DMA = 10  # DMA channel to use for generating signal (try 10)
@@ -31,246 +300,172 @@ class LEDStrip(object):
     _EVENT_SHUTDOWN = 5
     _EVENT_SONG = 6
     _EVENT_CLEAR = 7
+    _EVENT_BRIGHTNESS = 8
 
     _EVENTS_HUMAN_READABLE = ["TERMINATE", "RAINBOW_DEMO", "VOLUME", "FADE_UP_AND_DOWN", "STARTUP", "SHUTDOWN", "SONG",
-                              "CLEAR"]
-
-    RED = Color(255, 0, 0)
-    GREEN = Color(0, 255, 0)
-    BLUE = Color(0, 0, 255)
-    YELLOW = Color(255, 255, 0)
-    PURPLE = Color(255, 0, 255)
-    WHITE = Color(255, 255, 255)
-    ORANGE = Color(0xFF, 0x8C, 0x00)
-
-    _LEDS = range(_LED_COUNT)
-    _VOLUME_LEDS = _LEDS[4:14]
-    _LEDS_FROM_MIDDLE = _LEDS[2:] + _LEDS[:2]
-    _LEDS_SONG = _LEDS_FROM_MIDDLE[2:-2]
-
-    # Color gradient from Green to Red
-    _VOLUME_LED_COLORS = [0x00FF00, 0x1CE200, 0x38C600, 0x55AA00, 0x718D00, 0x8D7100, 0xAA5500, 0xC63800, 0xE21C00,
-                          0xFF0000]
-
-    def __init__(self):
-        self._strip = Adafruit_NeoPixel(LEDStrip._LED_COUNT, LEDStrip._LED_PIN, LEDStrip._LED_FREQ_HZ,
-                                        LEDStrip._LED_DMA, LEDStrip._LED_INVERT, LEDStrip._LED_BRIGHTNESS,
-                                        LEDStrip._LED_CHANNEL, LEDStrip._LED_STRIP)
-        self._strip.begin()
-        self._message_queue = Queue()
-
-        self._led_controller_thread = Thread(target=self._control_leds)
-        self._led_controller_thread.daemon = True
-        self._led_controller_thread.start()
-
-    def _control_leds(self):
-        msg = None
-        while True:
-            msg = self._message_queue.get(block=True, timeout=None) if msg is None else msg
+                              "CLEAR", "BRIGHTNESS"]
 
-            event = msg[0]
+    # Layers from bottom to top. Black pixels are transparent, so the topmost lit pixel is shown.
+    _LAYER_BACKGROUND = 0  # startup, shutdown, rainbow and the song position
+    _LAYER_VOLUME = 1  # volume bar
+    _LAYER_FLASH = 2  # color flashes
 
-            debug("event: %s", LEDStrip._EVENTS_HUMAN_READABLE[event])
+    _LAYERS = [_LAYER_BACKGROUND, _LAYER_VOLUME, _LAYER_FLASH]
 
-            if event == LEDStrip._EVENT_TERMINATE:
-                break
+    RED = Animations.RED
+    GREEN = Animations.GREEN
+    BLUE = Animations.BLUE
+    YELLOW = Animations.YELLOW
+    PURPLE = Animations.PURPLE
+    WHITE = Animations.WHITE
+    ORANGE = Animations.ORANGE
 
-            # # Ignore if others are waiting
-            # if not self._message_queue.empty():
-            #     debug("ignoring that one...")
-            #     continue
-
-            try:
-                if event == LEDStrip._EVENT_RAINBOW_DEMO:
-                    self._rainbow_cycle_animation()
-
-                elif event == LEDStrip._EVENT_VOLUME:
-                    self._volume_animation(msg[1])
-
-                elif event == LEDStrip._EVENT_FADE_UP_AND_DOWN:
-                    self._fade_animation(msg[1])
-
-                elif event == LEDStrip._EVENT_STARTUP:
-                    self._startup_animation()
+    _LEDS = range(_LED_COUNT)
 
-                elif event == LEDStrip._EVENT_SHUTDOWN:
-                    self._shutdown_animation()
+    _TERMINATE_TIMEOUT = 5
+
+    def __init__(self, animation_cache_dir=None, separate_process=False, reactor=None):
+        # Requests are small lists, [event, arguments...]. They go to the renderer through a queue, the reactor or, if
+        # it runs in a process of its own, a pipe.
+        self._brightness = LEDStrip._LED_BRIGHTNESS
+        self._reactor = None
+
+        if separate_process:
+            self._frame_buffer = RawArray('L', LEDStrip._LED_COUNT)
+            self._timing = RawArray('d', _Renderer._TIMING_HISTOGRAM + _Renderer.TIMING_BINS)
+
+            receiver, self._sender = Pipe(duplex=False)
+            self._send_lock = Lock()
+            self._renderer = Process(target=_run_renderer_process,
+                                     args=(receiver, animation_cache_dir, self._frame_buffer, self._timing))
+            self._renderer.daemon = True
+            self._renderer.start()
+            receiver.close()
+        elif reactor is not None:
+            self._frame_buffer = [0] * LEDStrip._LED_COUNT
+            self._timing = [0] * (_Renderer._TIMING_HISTOGRAM + _Renderer.TIMING_BINS)
+
+            self._reactor = reactor
+            self._sender = None
+            self._terminated = Event()
+            self._renderer = _Renderer(animation_cache_dir, self._frame_buffer, self._timing)
+            self._renderer.attach(reactor, self._terminated)
+        else:
+            self._frame_buffer = [0] * LEDStrip._LED_COUNT
+            self._timing = [0] * (_Renderer._TIMING_HISTOGRAM + _Renderer.TIMING_BINS)
 
-                elif event == LEDStrip._EVENT_SONG:
-                    self._song_animation(msg[1], msg[2], msg[3])
+            self._message_queue = Queue()
+            self._sender = None
+            renderer = _Renderer(animation_cache_dir, self._frame_buffer, self._timing)
+            self._renderer = Thread(target=renderer.run, args=(self._receive,))
+            self._renderer.daemon = True
+            self._renderer.start()
 
-                elif event == LEDStrip._EVENT_CLEAR:
-                    self._clear_all()
+    def _receive(self, timeout):
+        try:
+            return self._message_queue.get(block=timeout != 0, timeout=timeout or None)
+        except Empty:
+            return None
 
-                msg = None
+    def _put(self, msg):
+        if self._reactor is not None:
+            self._reactor.call_soon_threadsafe(self._renderer.request, msg)
+            return
 
-            except SleepInterruptedException as sie:
-                msg = sie.msg
+        if self._sender is None:
+            self._message_queue.put(msg)
+            return
 
-    def _sleep(self, timeout):
-        try:
-            raise SleepInterruptedException(self._message_queue.get(block=True, timeout=timeout))
-        except Empty:
-            pass
+        with self._send_lock:
+            self._sender.send(msg)
 
     def startup(self):
-        self._message_queue.put([LEDStrip._EVENT_STARTUP])
+        self._put([LEDStrip._EVENT_STARTUP])
 
     def shutdown(self):
-        self._message_queue.put([LEDStrip._EVENT_SHUTDOWN])
+        self._put([LEDStrip._EVENT_SHUTDOWN])
 
     def rainbow_demo(self):
-        self._message_queue.put([LEDStrip._EVENT_RAINBOW_DEMO])
+        self._put([LEDStrip._EVENT_RAINBOW_DEMO])
 
     def volume(self, volume):
-        self._message_queue.put([LEDStrip._EVENT_VOLUME, volume])
+        self._put([LEDStrip._EVENT_VOLUME, volume])
 
     def song(self, i, n, forward=True):
-        self._message_queue.put([LEDStrip._EVENT_SONG, i, n, forward])
+        self._put([LEDStrip._EVENT_SONG, i, n, forward])
 
     def fade_up_and_down(self, color):
-        self._message_queue.put([LEDStrip._EVENT_FADE_UP_AND_DOWN, color])
+        self._put([LEDStrip._EVENT_FADE_UP_AND_DOWN, color])
 
     def clear(self):
-        self._message_queue.put([LEDStrip._EVENT_CLEAR])
-
-    def _clear_all(self):
-        for i in range(LEDStrip._LED_COUNT):
-            self._strip.setPixelColor(i, 0)
-        self._strip.show()
-
-    def _fade_up(self, leds, colors):
-        rgbs = []
-        for color in colors:
-            rgbs.append(((color >> 16) & 255, (color >> 8) & 255, color & 255))
-
-        for c in range(11):
-            for i in range(len(leds)):
-                self._strip.setPixelColor(leds[i], Color(int(round(rgbs[i][0] * 0.1 * c)),
-                                                         int(round(rgbs[i][1] * 0.1 * c)),
-                                                         int(round(rgbs[i][2] * 0.1 * c))))
-            self._strip.show()
-            self._sleep(0.05)
-
-    def _fade_down(self, leds):
-        initial_rgbs = []
-        for led in leds:
-            color = self._strip.getPixelColor(led)
-            initial_rgbs.append(((color >> 16) & 255, (color >> 8) & 255, color & 255))
-
-        for c in range(-9, 1):
-            for i in range(len(leds)):
-                self._strip.setPixelColor(leds[i], Color(int(round(initial_rgbs[i][0] * -0.1 * c)),
-                                                         int(round(initial_rgbs[i][1] * -0.1 * c)),
-                                                         int(round(initial_rgbs[i][2] * -0.1 * c))))
-            self._strip.show()
-            self._sleep(0.05)
-
-    def _fade_up_and_down(self, leds, colors):
-        self._fade_up(leds, colors)
-        self._sleep(0.5)
-        self._fade_down(leds)
-
-    def _walk_around(self, leds, color, timeout=0.03):
-        color_is_fun = callable(color)
-        for i in leds:
-            self._strip.setPixelColor(i, color(i) if color_is_fun else color)
-            self._strip.show()
-            self._sleep(timeout)
-
-    @staticmethod
-    def _rainbow_wheel(pos):
-        return LEDStrip._wheel((int(pos * 256 / LEDStrip._LED_COUNT)) & 255)
-
-    def _startup_animation(self):
-        debug("startup animation")
-        for c in [LEDStrip.GREEN, LEDStrip._rainbow_wheel, Color(0, 0, 0)]:
-            self._walk_around(LEDStrip._LEDS_FROM_MIDDLE, c)
-
-    def _shutdown_animation(self):
-        debug("shutdown animation")
-        for c in [LEDStrip._rainbow_wheel, LEDStrip.RED, Color(0, 0, 0)]:
-            self._walk_around(LEDStrip._LEDS_FROM_MIDDLE, c)
-
-    def _volume_animation(self, volume):
-        debug("animating volume " + str(volume))
-        self._clear_all()
-
-        self._fade_up_and_down(LEDStrip._VOLUME_LEDS[0:volume + 1], LEDStrip._VOLUME_LED_COLORS)
-
-    def _fade_animation(self, color):
-        debug("fading " + str(color))
-        self._clear_all()
-        self._fade_up_and_down(LEDStrip._LEDS, [color] * LEDStrip._LED_COUNT)
-
-    def _song_animation(self, i, n, forward):
-        debug("song " + str(i) + " " + str(n))
-
-        walk = LEDStrip._LEDS_SONG[2:2 + i] if forward else list(reversed(LEDStrip._LEDS_SONG[3 + i: 2 + n]))
-
-        debug("walk=" + str(walk))
-
-        self._clear_all()
-        self._fade_up(LEDStrip._LEDS_SONG[:2] + LEDStrip._LEDS_SONG[2 + n: 4 + n],
-                      [LEDStrip.GREEN] * 2 + [LEDStrip.RED] * 2)
-        self._walk_around(walk, LEDStrip.YELLOW)
-        self._fade_up(LEDStrip._LEDS_SONG[i + 2: i + 3], [LEDStrip.BLUE])
-        self._walk_around(list(reversed(walk)), Color(0, 0, 0))
-        self._sleep(1)
-        self._fade_down(LEDStrip._LEDS_SONG[:2] + LEDStrip._LEDS_SONG[i + 2: i + 3] + LEDStrip._LEDS_SONG[2 + n: 4 + n])
-
-    @staticmethod
-    def _wheel(pos):
-        if pos < 85:
-            return Color(pos * 3, 255 - pos * 3, 0)
-        elif pos < 170:
-            pos -= 85
-            return Color(255 - pos * 3, 0, pos * 3)
-        else:
-            pos -= 170
-            return Color(0, pos * 3, 255 - pos * 3)
+        self._put([LEDStrip._EVENT_CLEAR])
 
     def set_brightness(self, brightness):
-        self._strip.setBrightness(brightness)
+        self._brightness = brightness
+        self._put([LEDStrip._EVENT_BRIGHTNESS, brightness])
 
     def get_brightness(self):
-        return self._strip.getBrightness()
-
-    def _rainbow_cycle_animation(self):
-        while True:
-            for j in range(256):
-                for i in range(LEDStrip._LED_COUNT):
-                    self._strip.setPixelColor(i, LEDStrip._wheel((int(i * 256 / LEDStrip._LED_COUNT) + j) & 255))
-                    self._strip.show()
-
-                self._sleep(0.02)
+        return self._brightness
+
+    def frame(self):
+        # the colors the strip shows right now
+        return list(self._frame_buffer)
+
+    @property
+    def stats(self):
+        # how late the animation frames were shown, in millis
+        timing = list(self._timing)
+        frames = int(timing[_Renderer._TIMING_FRAMES])
+        histogram = timing[_Renderer._TIMING_HISTOGRAM:]
+
+        def percentile(p):
+            seen = 0
+            for millis, count in enumerate(histogram):
+                seen += count
+                if seen >= frames * p:
+                    return millis
+            return len(histogram)
+
+        return {"frames": frames,
+                "late_avg_ms": round(timing[_Renderer._TIMING_SUM] / max(1, frames) * 1000, 2),
+                "late_p50_ms": percentile(0.5),
+                "late_p99_ms": percentile(0.99),
+                "late_max_ms": round(timing[_Renderer._TIMING_MAX] * 1000, 1)}
 
     def terminate(self):
         debug("led strip terminating.")
-        if self._led_controller_thread is None:
+        if self._renderer is None:
             debug("already terminated")
             return
 
-        self._message_queue.put([LEDStrip._EVENT_TERMINATE])
-        self._led_controller_thread.join()
+        self._put([LEDStrip._EVENT_TERMINATE])
+        if self._reactor is not None:
+            self._terminated.wait(LEDStrip._TERMINATE_TIMEOUT)
+            self._renderer = None
+            return
+
+        self._renderer.join(LEDStrip._TERMINATE_TIMEOUT)
 
-        for i in range(LEDStrip._LED_COUNT):
-            self._strip.setPixelColor(i, 0)
-        self._strip.show()
+        if self._sender is not None:
+            if self._renderer.is_alive():
+                debug("renderer didn't stop, killing it")
+                self._renderer.terminate()
+            self._sender.close()
 
-        self._led_controller_thread = None
+        self._renderer = None
 
 
 ################################################################
 
 def main():
     from SetupLogging import setup_stdout_logging
+    from sys import argv
     setup_stdout_logging()
 
     debug("see the beautiful lights")
     debug("ENTER or CTRL + C to quit")
 
-    leds = LEDStrip()
+    leds = LEDStrip(separate_process="process" in argv)
     leds.rainbow_demo()
 
     try:
@@ -279,6 +474,7 @@ def main():
         pass
 
     leds.terminate()
+    debug("frame timing: " + str(leds.stats))
 
 
 if __name__ == "__main__":
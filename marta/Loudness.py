@@ -0,0 +1,161 @@
+from subprocess import Popen, PIPE
+from os import devnull
+from audioop import rms
+from collections import deque
+from math import log10
+from logging import getLogger
+
+debug = getLogger('  Loudness').debug
+
+# Loudness is measured the way EBU R128 does it: the mean square of 400 ms blocks that overlap by 75%, ignoring
+# blocks below -70 dB and then those 10 dB below the average of the rest. The K-weighting filter is left out, it would
+# cost a python loop per sample, so the values are dB of the plain signal (full scale square = 0 dB), not LUFS.
+#
+# Tracks keep a histogram of their block loudness instead of a single value, merging the histograms of all tracks
+# gates an album as if it was one long track.
+
+# ReplayGain 2 reference level
+TARGET = -18.0
+
+# quiet tracks are lifted up to that much, loud ones are always lowered
+MAX_GAIN = 12.0
+
+_ABSOLUTE_GATE = -70.0
+_RELATIVE_GATE = -10.0
+
+# the histogram counts blocks in bins of that many dB
+_BIN_SIZE = 0.1
+
+_SUB_BLOCKS_PER_BLOCK = 4
+_SUB_BLOCKS_PER_SECOND = 10
+_FULL_SCALE = 32768.0 * 32768.0
+
+_MPG123_BINARY = "mpg123"
+
+# mpg123 decodes at a quarter of the sample rate, plenty for a level and a lot cheaper
+_DOWNSAMPLING = 4
+
+# Longer tracks are measured in that many windows spread evenly over the track, instead of decoding all of it. An
+# audiobook costs about as much as a song then, and weighs about as much in its album's histogram.
+SAMPLED_WINDOWS = 6
+SAMPLED_WINDOW_SECONDS = 10
+
+
+def _decibels(mean_square):
+    return 10 * log10(mean_square)
+
+
+def _windows(sample_rate, total_samples):
+    # [(first frame, number of frames)] to decode, [(0, None)] for all of it
+    if total_samples is None:
+        return [(0, None)]
+
+    samples_per_frame = 1152 if sample_rate >= 32000 else 576
+    frames = total_samples // samples_per_frame
+    window = int(SAMPLED_WINDOW_SECONDS * sample_rate / samples_per_frame)
+    if frames <= 2 * SAMPLED_WINDOWS * window:
+        return [(0, None)]
+
+    return [(frames * (2 * i + 1) // (2 * SAMPLED_WINDOWS) - window // 2, window) for i in range(SAMPLED_WINDOWS)]
+
+
+def analyze(file_name, sample_rate, total_samples=None):
+    # histogram of the block loudness {bin: block count}, None if there's no mpg123 to decode the file. Long tracks
+    # are only sampled if total_samples is given.
+    histogram = {}
+    for first, count in _windows(sample_rate, total_samples):
+        args = ["-k", str(first)] + ([] if count is None else ["-n", str(count)])
+        if not _analyze(file_name, sample_rate, args, histogram):
+            return None
+    return histogram
+
+
+def _analyze(file_name, sample_rate, args, histogram):
+    # adds the blocks mpg123 decodes with args to histogram, False if there's no mpg123
+    rate = sample_rate // _DOWNSAMPLING
+    sub_block_size = rate // _SUB_BLOCKS_PER_SECOND * 2
+
+    with open(devnull, 'w') as null:
+        try:
+            process = Popen([_MPG123_BINARY, "-q", "-s", "-m", "-" + str(_DOWNSAMPLING)] + args + [file_name],
+                            stdout=PIPE, stderr=null)
+        except OSError as e:
+            debug("could not run " + _MPG123_BINARY + ": " + str(e))
+            return False
+
+        sub_blocks = deque(maxlen=_SUB_BLOCKS_PER_BLOCK)
+        while True:
+            sub_block = process.stdout.read(sub_block_size)
+            if len(sub_block) < sub_block_size:
+                break
+
+            sub_blocks.append(rms(sub_block, 2) ** 2)
+            if len(sub_blocks) < _SUB_BLOCKS_PER_BLOCK:
+                continue
+
+            mean_square = sum(sub_blocks) / _SUB_BLOCKS_PER_BLOCK / _FULL_SCALE
+            if mean_square > 0 and _decibels(mean_square) > _ABSOLUTE_GATE:
+                b = int(round(_decibels(mean_square) / _BIN_SIZE))
+                histogram[b] = histogram.get(b, 0) + 1
+
+        process.stdout.close()
+        if process.wait() != 0:
+            raise Exception("mpg123 could not decode the file")
+
+    return True
+
+
+def merge(histograms):
+    merged = {}
+    for histogram in histograms:
+        for b, count in histogram.items():
+            merged[b] = merged.get(b, 0) + count
+    return merged
+
+
+def loudness(histogram):
+    # gated loudness in dB, None if there's nothing above the absolute gate
+    blocks = [(count, 10 ** (b * _BIN_SIZE / 10)) for b, count in histogram.items()]
+    if len(blocks) is 0:
+        return None
+
+    gate = _decibels(sum(count * energy for count, energy in blocks) / sum(count for count, _ in blocks))
+    gate += _RELATIVE_GATE
+
+    blocks = [(count, energy) for count, energy in blocks if _decibels(energy) >= gate]
+    return round(_decibels(sum(count * energy for count, energy in blocks) / sum(count for count, _ in blocks)), 1)
+
+
+def gain(level):
+    # gain in dB that brings a track or album of this loudness to TARGET
+    if level is None:
+        return 0.0
+    return min(MAX_GAIN, round(TARGET - level, 1))
+
+
+################################################################
+
+def main():
+    from SetupLogging import setup_stdout_logging
+    from MP3Info import get_mp3_info
+    from sys import argv
+
+    setup_stdout_logging()
+
+    histograms = []
+    for file_name in argv[1:]:
+        info = get_mp3_info(file_name)
+        histogram = None if info is None else analyze(file_name, info.sample_rate, info.total_samples)
+        if histogram is None:
+            continue
+
+        histograms.append(histogram)
+        level = loudness(histogram)
+        debug(file_name + ": " + str(level) + " dB, gain " + str(gain(level)) + " dB")
+
+    level = loudness(merge(histograms))
+    debug("album: " + str(level) + " dB, gain " + str(gain(level)) + " dB")
+
+
+if __name__ == "__main__":
+    main()
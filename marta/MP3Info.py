@@ -0,0 +1,289 @@
+from os import stat
+from struct import unpack
+from mmap import mmap, ACCESS_READ
+from logging import getLogger
+
+debug = getLogger('   MP3Info').debug
+
+
+#  MPEG audio frame header
+#
+# AAAAAAAA AAABBCCD EEEEFFGH IIJJKLMM
+#
+#    A: 11 bits frame sync, always set
+#    B: 2 bits version (00 = 2.5, 01 = reserved, 10 = 2, 11 = 1)
+#    C: 2 bits layer (00 = reserved, 01 = III, 10 = II, 11 = I)
+#    D: 1 bit protection
+#    E: 4 bits bitrate index
+#    F: 2 bits sample rate index
+#    G: 1 bit padding
+#    H: 1 bit private
+#    I: 2 bits channel mode (11 = mono)
+#    J, K, L, M: mode extension, copyright, original, emphasis
+#
+# The first frame of VBR files usually doesn't contain audio but a Xing/Info (LAME) or VBRI header which holds the
+# number of frames. For everything else the number of frames is estimated from the size of the first frame.
+
+_VERSION_1 = 3
+_VERSION_2 = 2
+_VERSION_2_5 = 0
+
+_LAYER_1 = 3
+_LAYER_2 = 2
+_LAYER_3 = 1
+
+_BITRATES = {
+    (_VERSION_1, _LAYER_1): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+    (_VERSION_1, _LAYER_2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+    (_VERSION_1, _LAYER_3): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    (_VERSION_2, _LAYER_1): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+    (_VERSION_2, _LAYER_2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+    (_VERSION_2, _LAYER_3): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+
+_SAMPLE_RATES = {
+    _VERSION_1: [44100, 48000, 32000],
+    _VERSION_2: [22050, 24000, 16000],
+    _VERSION_2_5: [11025, 12000, 8000],
+}
+
+_XING_FLAG_FRAMES = 0x1
+_XING_FLAG_BYTES = 0x2
+
+# the LAME tag always starts at a fixed offset behind the Xing/Info tag
+_LAME_TAG_OFFSET = 120
+
+# mpg123 doesn't look further for the first frame either
+_MAX_SYNC_SEARCH = 64 * 1024
+
+_ID3V1_SIZE = 128
+
+# tags that may follow the last frame
+_TRAILING_TAGS = ["TAG", "APETAGEX", "LYRICSBEGIN"]
+
+# file name -> (mtime, size, MP3Info)
+_CACHE = {}
+
+
+class MP3Info(object):
+    def __init__(self, sample_rate, total_samples, bitrate, vbr):
+        self.sample_rate = sample_rate
+        self.total_samples = total_samples
+        self.length_in_millis = int(round(total_samples * 1000.0 / sample_rate))
+        self.bitrate = bitrate
+        self.vbr = vbr
+
+    def __repr__(self):
+        return "MP3Info(" + str(self.sample_rate) + " Hz, " + str(self.total_samples) + " samples, " + str(
+            self.length_in_millis) + " ms, " + str(self.bitrate) + " kbps" + (" VBR" if self.vbr else "") + ")"
+
+
+def _parse_header(header):
+    if len(header) < 4:
+        return None
+
+    b1, b2, b3, b4 = unpack(">4B", header[:4])
+    if b1 != 0xFF or (b2 & 0xE0) != 0xE0:
+        return None
+
+    version = (b2 >> 3) & 3
+    layer = (b2 >> 1) & 3
+    bitrate_index = b3 >> 4
+    sample_rate_index = (b3 >> 2) & 3
+
+    if version == 1 or layer == 0 or bitrate_index == 0 or bitrate_index == 15 or sample_rate_index == 3:
+        return None
+
+    bitrate = _BITRATES[(_VERSION_1 if version == _VERSION_1 else _VERSION_2, layer)][bitrate_index]
+    sample_rate = _SAMPLE_RATES[version][sample_rate_index]
+    padding = (b3 >> 1) & 1
+    mono = (b4 >> 6) == 3
+
+    if layer == _LAYER_1:
+        samples_per_frame = 384
+        frame_length = (12 * bitrate * 1000 // sample_rate + padding) * 4
+    elif layer == _LAYER_3 and version != _VERSION_1:
+        samples_per_frame = 576
+        frame_length = 72 * bitrate * 1000 // sample_rate + padding
+    else:
+        samples_per_frame = 1152
+        frame_length = 144 * bitrate * 1000 // sample_rate + padding
+
+    return version, layer, bitrate, sample_rate, samples_per_frame, frame_length, mono
+
+
+def _skip_id3v2(f):
+    header = f.read(10)
+    if len(header) < 10 or header[:3] != "ID3":
+        return 0
+
+    # syncsafe integer, 7 bits per byte
+    size = 0
+    for b in unpack(">4B", header[6:10]):
+        size = (size << 7) | (b & 0x7F)
+
+    # footer present
+    if ord(header[5]) & 0x10:
+        size += 10
+
+    return 10 + size
+
+
+def _find_first_frame(f, offset):
+    f.seek(offset)
+    data = f.read(_MAX_SYNC_SEARCH)
+
+    i = data.find("\xFF")
+    while 0 <= i < len(data) - 4:
+        header = _parse_header(data[i:i + 4])
+
+        # a single match might be garbage, so the next frame has to be right behind this one
+        if header is not None:
+            following = _parse_header(data[i + header[5]:i + header[5] + 4])
+            if following is not None and following[:2] == header[:2] and following[3] == header[3]:
+                return offset + i, header
+            if i + header[5] + 4 > len(data):
+                return offset + i, header
+
+        i = data.find("\xFF", i + 1)
+
+    return None, None
+
+
+def _read_info(f, file_size):
+    offset, header = _find_first_frame(f, _skip_id3v2(f))
+    if header is None:
+        return None
+
+    version, layer, bitrate, sample_rate, samples_per_frame, frame_length, mono = header
+
+    f.seek(offset)
+    frame = f.read(max(frame_length, 4 + 32 + _LAME_TAG_OFFSET + 24))
+
+    if version == _VERSION_1:
+        xing_offset = 4 + (17 if mono else 32)
+    else:
+        xing_offset = 4 + (9 if mono else 17)
+
+    xing = frame[xing_offset:xing_offset + 4]
+    if xing == "Xing" or xing == "Info":
+        flags = unpack(">I", frame[xing_offset + 4:xing_offset + 8])[0]
+        if flags & _XING_FLAG_FRAMES:
+            frames = unpack(">I", frame[xing_offset + 8:xing_offset + 12])[0]
+            total_samples = frames * samples_per_frame
+
+            # encoder delay and padding (12 bits each) are removed by mpg123's gapless decoding
+            lame = frame[xing_offset + _LAME_TAG_OFFSET:xing_offset + _LAME_TAG_OFFSET + 24]
+            if len(lame) == 24 and lame[:4] == "LAME":
+                d1, d2, d3 = unpack(">3B", lame[21:24])
+                delay = (d1 << 4) | (d2 >> 4)
+                padding = ((d2 & 0x0F) << 8) | d3
+                if delay + padding < total_samples:
+                    total_samples -= delay + padding
+
+            if flags & _XING_FLAG_BYTES:
+                audio_bytes = unpack(">I", frame[xing_offset + 12:xing_offset + 16])[0]
+            else:
+                audio_bytes = file_size - offset
+
+            if frames > 0:
+                bitrate = int(round(audio_bytes * 8.0 * sample_rate / (frames * samples_per_frame) / 1000))
+
+            return MP3Info(sample_rate, total_samples, bitrate, xing == "Xing")
+
+    # the VBRI header is always 32 bytes behind the frame header
+    if frame[36:40] == "VBRI":
+        audio_bytes, frames = unpack(">II", frame[46:54])
+        bitrate = int(round(audio_bytes * 8.0 * sample_rate / (frames * samples_per_frame) / 1000)) if frames else 0
+        return MP3Info(sample_rate, frames * samples_per_frame, bitrate, True)
+
+    # CBR: estimate the length from the audio data size
+    audio_bytes = file_size - offset
+    f.seek(-_ID3V1_SIZE, 2)
+    if f.read(3) == "TAG":
+        audio_bytes -= _ID3V1_SIZE
+
+    return MP3Info(sample_rate, int(audio_bytes * 8.0 * sample_rate / (bitrate * 1000)), bitrate, False)
+
+
+def get_mp3_info(file_name):
+    file_stat = stat(file_name)
+
+    cached = _CACHE.get(file_name)
+    if cached is not None and cached[0] == file_stat.st_mtime and cached[1] == file_stat.st_size:
+        return cached[2]
+
+    if file_stat.st_size < _ID3V1_SIZE:
+        return None
+
+    with open(file_name, 'rb') as f:
+        info = _read_info(f, file_stat.st_size)
+
+    debug(file_name + ": " + str(info))
+    if info is not None and info.total_samples > 0:
+        _CACHE[file_name] = (file_stat.st_mtime, file_stat.st_size, info)
+        return info
+
+    return None
+
+
+def check_frames(file_name):
+    # Walks the headers of all frames like a decoder would. Returns (frames, problem), problem is None if the frames
+    # follow each other without a gap up to the end of the file or a trailing tag.
+    file_size = stat(file_name).st_size
+    if file_size < _ID3V1_SIZE:
+        return 0, "file too short"
+
+    with open(file_name, 'rb') as f:
+        offset, header = _find_first_frame(f, _skip_id3v2(f))
+        if header is None:
+            return 0, "no mpeg audio frame found"
+
+        data = mmap(f.fileno(), 0, access=ACCESS_READ)
+
+    try:
+        # most files use a handful of different headers, parsing each of them once keeps this I/O bound
+        headers = {}
+        frames = 0
+        while offset + 4 <= file_size:
+            raw = data[offset:offset + 4]
+            current = headers.get(raw)
+            if current is None:
+                current = headers[raw] = _parse_header(raw)
+
+            if current is None:
+                if any(data[offset:offset + len(tag)] == tag for tag in _TRAILING_TAGS):
+                    break
+                return frames, "lost frame sync at byte " + str(offset)
+
+            if current[:2] != header[:2] or current[3] != header[3]:
+                return frames, "stream changes at byte " + str(offset)
+
+            frames += 1
+            offset += current[5]
+    finally:
+        data.close()
+
+    return frames, None
+
+
+def remember(file_name, mtime, size, info):
+    # info obtained elsewhere, e.g. from the library manifest
+    _CACHE[file_name] = (mtime, size, info)
+
+
+################################################################
+
+def main():
+    from SetupLogging import setup_stdout_logging
+    from sys import argv
+    setup_stdout_logging()
+
+    for file_name in argv[1:]:
+        get_mp3_info(file_name)
+        frames, problem = check_frames(file_name)
+        debug(file_name + ": " + str(frames) + " frames" + ("" if problem is None else ", " + problem))
+
+
+if __name__ == "__main__":
+    main()
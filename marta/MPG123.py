@@ -1,12 +1,47 @@
 from subprocess import Popen, PIPE, STDOUT
+from os import read
 import select
-from threading import Thread, Event
+from threading import Thread, Event, Lock
+from collections import deque
 from logging import getLogger
+from monotonic import monotonic as mtime
+
+from AudioBackend import AudioBackend
+from MP3Info import get_mp3_info
+from Tracing import span
 
 debug = getLogger('    MPG123').debug
 
 
-class MPG123Player(object):
+class _Reply(object):
+    # A command sent to mpg123 whose response has not arrived yet
+    #
+    # responses: the status lines that answer the command, e.g. ('@P 1', '@P 2') for a toggle
+    # blocking: somebody waits for it, mpg123's errors go to the oldest blocking command
+
+    def __init__(self, command, responses, blocking=True):
+        self.command = command
+        self.responses = responses
+        self.blocking = blocking
+        self.sent = mtime()
+        self.okay = None
+        self._event = Event()
+
+    def resolve(self, okay):
+        self.okay = okay
+        self._event.set()
+
+    def done(self):
+        return self._event.isSet()
+
+    def wait(self, timeout):
+        if not self._event.wait(timeout):
+            raise Exception("timeout: " + str(timeout) + " sec (" + str(self.command) + ")")
+
+        return self.okay
+
+
+class MPG123Player(AudioBackend):
     STATE_STOPPED = 0
     STATE_PAUSED = 1
     STATE_PLAYING = 2
@@ -16,20 +51,43 @@ class MPG123Player(object):
     # but all subsequent commands will not take longer than this time
     _DEFAULT_IPC_TIMEOUT_IN_SECONDS = 1
 
+    # Commands nobody waits for are dropped if mpg123 didn't answer them within this time
+    _STALE_REPLY_IN_SECONDS = 10
+
+    # Worst case for how far the interpolated position drifts away from mpg123's position per second of playback
+    _POSITION_DRIFT_IN_MILLIS_PER_SECOND = 5
+
     _DEFAULT_VOLUME = 50
     _DEFAULT_PITCH = 100
     _MPG123_BINARY = "mpg123"
 
-    def __init__(self, on_stop_callback, on_error_callback, volume=_DEFAULT_VOLUME, pitch=_DEFAULT_PITCH):
+    def __init__(self, on_stop_callback, on_error_callback, volume=_DEFAULT_VOLUME, pitch=_DEFAULT_PITCH,
+                 prefetch=False, max_position_drift_in_millis=None, reactor=None):
+        # reactor: mpg123's output is read by the Reactor instead of a thread of its own
         self._ipc_timeout = 10
         self._current_state = MPG123Player.STATE_STOPPED
-        self._program_responded = Event()
+
+        # mpg123 answers the commands in order, so each response goes to the oldest command waiting for its kind
+        self._pending_replies = deque()
+        self._pending_replies_lock = Lock()
+        self._track_header_received = Event()
 
         self._track_length_in_samples = 0
         self._track_position_in_samples = 0
         self._track_length_in_millis = 0
+        self._sample_rate = 0
 
+        # The position is interpolated from (position in samples, monotonic time, samples per second) and only
+        # synced with mpg123 if the drift might exceed max_position_drift_in_millis
+        self._position_anchor = (0, mtime(), 0)
+        self._position_synced_at = mtime()
+        self._position_resync = None
+        self._max_position_drift_in_millis = max_position_drift_in_millis
+
+        # The user's volume and the loaded track's gain (as a factor) are combined into the volume mpg123 plays at
         self._volume = None
+        self._gain = 1.0
+        self._output_volume = None
         self._actual_program_pitch = MPG123Player._DEFAULT_PITCH
         self._pitch = MPG123Player._DEFAULT_PITCH
 
@@ -39,50 +97,68 @@ class MPG123Player(object):
         self._on_error_callback = on_error_callback
         self._mpg123_process = Popen([MPG123Player._MPG123_BINARY, "--remote"], stdin=PIPE, stdout=PIPE, stderr=STDOUT)
 
-        self._read_sout_thread = Thread(target=self._read_sout)
-        self._read_sout_thread.daemon = True
-        self._read_sout_thread.start()
-        self._was_error = False
+        startup = _Reply(None, ('@R',))
+        self._pending_replies.append(startup)
 
-        # this prevents mpg123 from spamming the stdout with positional information
-        self._command('SILENCE')
+        self._reactor = reactor
+        self._read_sout_thread = None
+        if reactor is None:
+            self._read_sout_thread = Thread(target=self._read_sout)
+            self._read_sout_thread.daemon = True
+            self._read_sout_thread.start()
+        else:
+            # a partial line, the rest of it comes with the next read
+            self._sout_buffer = ""
+            reactor.add_reader(self._mpg123_process.stdout, self._sout_readable)
+
+        startup.wait(self._ipc_timeout)
         self._ipc_timeout = MPG123Player._DEFAULT_IPC_TIMEOUT_IN_SECONDS
 
+        # this prevents mpg123 from spamming the stdout with positional information
+        self._send('SILENCE', ())
+
         self.set_volume(volume)
         self.set_pitch(pitch)
+
+        super(MPG123Player, self).__init__(prefetch)
+
         debug("mpg123 initialized")
 
     def _mpg123_input(self, line):
-        debug("< " + str(line))
+        debug("< %s", line)
 
         if line.startswith('@R MPG123'):
             debug("mpg123 startup")
-            self._program_responded.set()
+            self._resolve('@R')
             return
 
         if line.startswith('@E '):
-            self._was_error = True
-            self._program_responded.set()
+            self._resolve_error()
             return
 
         if line.startswith('@P 0'):
             self._current_state = MPG123Player.STATE_STOPPED
-            self._program_responded.set()
+            self._anchor_position(0)
+            self._resolve('@P 0')
             self._current_file = None
             self._on_stop_callback()
             debug("state=STOPPED")
             return
 
         if line.startswith('@P 1'):
+            position = self._estimate_position_in_samples()
             self._current_state = MPG123Player.STATE_PAUSED
+            self._anchor_position(position)
             debug("state=PAUSED")
-            self._program_responded.set()
+            self._resolve('@P 1')
             return
 
         if line.startswith('@P 2'):
+            position = self._estimate_position_in_samples()
             self._current_state = MPG123Player.STATE_PLAYING
+            self._anchor_position(position)
             debug("state=PLAYING")
-            self._program_responded.set()
+            self._resolve('@P 2')
             return
 
         if line.startswith('@SAMPLE '):
@@ -91,34 +167,34 @@ class MPG123Player(object):
             self._track_position_in_samples = int(line[0])
             debug("current position: %d", self._track_position_in_samples)
             self._track_length_in_samples = int(line[1])
-            self._program_responded.set()
+            self._anchor_position(self._track_position_in_samples, synced=True)
+            self._resolve('@SAMPLE')
             return
 
         if line.startswith('@S '):
-            self._expecting_input = False
-            sample_rate = int(line.split(" ")[3]) / float(1000)
-            self._track_length_in_millis = int(round(self._track_length_in_samples / sample_rate))
+            self._sample_rate = int(line.split(" ")[3])
+            self._track_length_in_millis = int(round(self._track_length_in_samples / (self._sample_rate / 1000.0)))
             debug("track length: %d", self._track_length_in_millis)
-            self._program_responded.set()
+            self._track_header_received.set()
             return
 
         if line.startswith('@K '):
-            self._program_responded.set()
+            self._resolve('@K')
             return
 
         if line.startswith('@V '):
             line = line[3:-1]
             line = line.split('%')[0]
-            self._volume = float(line)
-            debug("volume: %f", self._volume)
-            self._program_responded.set()
+            self._output_volume = float(line)
+            debug("volume: %f", self._output_volume)
+            self._resolve('@V')
             return
 
         if line.startswith('@PITCH '):
             line = line.split(' ')[1]
             self._actual_program_pitch = round((float(line) + 1) * 100)
             debug("pitch: %f", self._actual_program_pitch)
-            self._program_responded.set()
+            self._resolve('@PITCH')
             return
 
     def _read_sout(self):
@@ -134,30 +210,86 @@ class MPG123Player(object):
             line = self._mpg123_process.stdout.readline()
             self._mpg123_input(line)
 
-        debug("mpg123 died")
         mpg123_stdout_poll.unregister(self._mpg123_process.stdout)
+        self._mpg123_died()
+
+    def _sout_readable(self):
+        # on the reactor: everything that is there in one read, instead of a system call per byte like readline()
+        data = read(self._mpg123_process.stdout.fileno(), 4096)
+        if len(data) is 0:
+            self._reactor.remove_reader(self._mpg123_process.stdout)
+            self._mpg123_died()
+            return
 
-        if self._on_error_callback is not None:
-            self._on_error_callback()
-
-        self._program_responded.set()
-
-    def _command(self, command):
-        self._program_responded.clear()
-        debug("> " + str(command))
-        self._mpg123_process.stdin.write(command + '\n')
-        self._mpg123_process.stdin.flush()
+        lines = (self._sout_buffer + data).split("\n")
+        self._sout_buffer = lines.pop()
+        for line in lines:
+            self._mpg123_input(line + "\n")
 
-        debug("waiting for max " + str(self._ipc_timeout) + " seconds")
-        self._program_responded.wait(self._ipc_timeout)
-        if not self._program_responded.isSet():
-            raise Exception("timeout: " + str(self._ipc_timeout) + " sec")
+    def _mpg123_died(self):
+        debug("mpg123 died")
 
-        if self._was_error:
-            self._was_error = False
-            return False
+        if self._on_error_callback is not None:
+            self._on_error_callback()
 
-        return True
+        with self._pending_replies_lock:
+            while len(self._pending_replies) is not 0:
+                self._pending_replies.popleft().resolve(False)
+
+    def _resolve(self, response):
+        # the oldest command this answers, status lines nobody asked for (e.g. '@P 0' at the end of a track) are
+        # just that
+        with self._pending_replies_lock:
+            for reply in self._pending_replies:
+                if response in reply.responses:
+                    self._pending_replies.remove(reply)
+                    reply.resolve(True)
+                    return
+
+        debug("unsolicited " + response)
+
+    def _resolve_error(self):
+        # mpg123 doesn't say which command failed. Fire and forget commands like V rarely do, so it's the oldest one
+        # somebody waits for, if there is one.
+        with self._pending_replies_lock:
+            if len(self._pending_replies) is 0:
+                debug("unsolicited error")
+                return
+
+            blocking = [reply for reply in self._pending_replies if reply.blocking]
+            reply = blocking[0] if len(blocking) is not 0 else self._pending_replies[0]
+            self._pending_replies.remove(reply)
+            reply.resolve(False)
+
+    def _send(self, command, responses, blocking=False):
+        # Sends the command without waiting. The returned reply is resolved as soon as mpg123 responds with one of
+        # responses, right away if there are none.
+        reply = _Reply(command, responses, blocking)
+
+        with self._pending_replies_lock:
+            stale = reply.sent - MPG123Player._STALE_REPLY_IN_SECONDS
+            while len(self._pending_replies) is not 0 and self._pending_replies[0].sent < stale:
+                dropped = self._pending_replies.popleft()
+                debug("dropping stale %s", dropped.command)
+                dropped.resolve(False)
+
+            if len(responses) is not 0:
+                self._pending_replies.append(reply)
+
+            debug("> %s", command)
+            self._mpg123_process.stdin.write(command + '\n')
+            self._mpg123_process.stdin.flush()
+
+        if len(responses) is 0:
+            reply.resolve(True)
+
+        return reply
+
+    def _command(self, command, responses):
+        with span("mpg123." + command.split(' ', 1)[0]):
+            reply = self._send(command, responses, blocking=True)
+            debug("waiting for max %s seconds", self._ipc_timeout)
+            return reply.wait(self._ipc_timeout)
 
     def is_track_playing(self):
         return self._current_state == MPG123Player.STATE_PLAYING
@@ -175,7 +307,18 @@ class MPG123Player(object):
             debug("volume already set")
             return
 
-        self._command('V ' + str(volume))
+        self._volume = volume
+        return self._apply_volume()
+
+    def _apply_volume(self):
+        # tracks are only ever amplified up to mpg123's full volume
+        volume = min(100.0, round(self._volume * self._gain, 1))
+        if volume == self._output_volume:
+            return None
+
+        # mpg123's answer will overwrite this value later on
+        self._output_volume = volume
+        return self._send('V ' + str(volume), ('@V',))
 
     def get_pitch(self):
         return self._pitch
@@ -186,7 +329,9 @@ class MPG123Player(object):
         elif pitch > 200:
             raise ValueError("Out of bounds!")
 
+        position = self._estimate_position_in_samples()
         self._pitch = pitch
+        self._anchor_position(position)
 
         if not (self._current_state == MPG123Player.STATE_PLAYING or self._current_state == MPG123Player.STATE_PAUSED):
             return
@@ -194,44 +339,91 @@ class MPG123Player(object):
         pitch = float(pitch) / 100 - 1
         pitch = str(pitch)[0:8]
 
-        self._command('PITCH ' + pitch)
+        return self._send('PITCH ' + pitch, ('@PITCH',))
 
     def _get_position_in_samples(self):
-        self._command('SAMPLE')
+        self._command('SAMPLE', ('@SAMPLE',))
         return self._track_position_in_samples, self._track_length_in_samples
 
+    def _anchor_position(self, position_in_samples, synced=False):
+        now = mtime()
+        playing = self._current_state == MPG123Player.STATE_PLAYING
+        self._position_anchor = (position_in_samples, now, self._sample_rate * self._pitch / 100.0 if playing else 0)
+        if synced:
+            self._position_synced_at = now
+
+    def _estimate_position_in_samples(self):
+        position, since, samples_per_second = self._position_anchor
+        position += (mtime() - since) * samples_per_second
+        if self._track_length_in_samples > 0:
+            position = min(position, self._track_length_in_samples)
+        return position
+
     def get_position_in_millis(self):
-        current_pos, length = self._get_position_in_samples()
-        return int(round((float(current_pos) / length) * self._track_length_in_millis))
+        if self._sample_rate == 0:
+            return 0
+
+        if self._max_position_drift_in_millis is not None and self._current_state == MPG123Player.STATE_PLAYING:
+            drift = (mtime() - self._position_synced_at) * MPG123Player._POSITION_DRIFT_IN_MILLIS_PER_SECOND
+            if drift > self._max_position_drift_in_millis and (
+                    self._position_resync is None or self._position_resync.done()):
+                # the answer updates the anchor whenever it arrives, nobody has to wait for it
+                self._position_resync = self._send('SAMPLE', ('@SAMPLE',))
+
+        return int(round(self._estimate_position_in_samples() * 1000.0 / self._sample_rate))
 
     def set_position_in_millis(self, position_in_millis):
-        position_in_millis /= float(self._track_length_in_millis)
-        position_in_millis = int(round(position_in_millis * self._track_length_in_samples))
-        self._command('K ' + str(position_in_millis))
+        position = int(round(position_in_millis * self._sample_rate / 1000.0))
+        self._command('K ' + str(position), ('@K',))
+        self._anchor_position(position, synced=True)
 
     def get_track_length_in_millis(self):
         return self._track_length_in_millis
 
-    def load_track_from_file(self, file_name):
+    def load_track_from_file(self, file_name, gain=0):
+        # gain in dB, e.g. from the loudness normalization
         if file_name == self._current_file:
             debug("file already loaded")
             return
 
         self._current_file = file_name
-        okay = self._command('LP ' + file_name)
-        if not okay:
-            return False
+        self._gain = 10 ** (gain / 20.0)
 
-        self._get_position_in_samples()
-        # Forcing '@S ...' output in order to get the track's length in ms
+        with span("mpg123.LP"):
+            reply = self._send('LP ' + file_name, ('@P 1',), blocking=True)
 
-        volume_before = self._volume
-        self.set_volume(0)
-        self.play_track()
-        self.pause_track()
-        self.set_volume(volume_before)
+            # the track is loaded paused, so its volume is in place before it is heard and nobody waits for it
+            self._apply_volume()
 
-        self.set_position_in_millis(0)
+            okay = reply.wait(self._ipc_timeout)
+        if not okay:
+            return False
+
+        try:
+            info = get_mp3_info(file_name)
+        except Exception as e:
+            debug("could not parse mp3 headers: " + str(e))
+            info = None
+
+        if info is not None:
+            self._track_length_in_samples = info.total_samples
+            self._track_length_in_millis = info.length_in_millis
+            self._sample_rate = info.sample_rate
+            self._track_position_in_samples = 0
+            self._anchor_position(0, synced=True)
+        else:
+            self._get_position_in_samples()
+            # Forcing '@S ...' output in order to get the track's length in ms
+
+            volume_before = self._volume
+            self._track_header_received.clear()
+            self.set_volume(0)
+            self.play_track()
+            self._track_header_received.wait(self._ipc_timeout)
+            self.pause_track()
+            self.set_volume(volume_before)
+
+            self.set_position_in_millis(0)
 
         if self._pitch != self._actual_program_pitch:
             self.set_pitch(self._pitch)
@@ -239,7 +431,7 @@ class MPG123Player(object):
         return True
 
     def toggle(self):
-        self._command('P')
+        self._command('P', ('@P 1', '@P 2'))
 
     def play_track(self):
         if self._current_state == MPG123Player.STATE_PLAYING:
@@ -260,7 +452,7 @@ class MPG123Player(object):
             debug("already stopped")
             return
 
-        self._command('S')
+        self._command('S', ('@P 0',))
 
     def terminate(self):
         debug("MPG123 terminating...")
@@ -270,12 +462,14 @@ class MPG123Player(object):
 
         self._on_error_callback = None
         self._current_state = MPG123Player.STATE_TERMINATED
+
+        self._stop_prefetching()
         if self._mpg123_process.returncode is None:
             # This strange construct is half of a historical artifact from python 3
             # and can probably be destroyed and hopefully be forgotten.
             # On the other hand: I don't know what happens then and at this point I'm too afraid to ask (or test).
             try:
-                self._command('Q')
+                self._send('Q', ())
                 self._mpg123_process.wait()
             except:
                 try:
@@ -284,9 +478,10 @@ class MPG123Player(object):
                 except:
                     pass
 
-        debug("waiting for checker thread.")
-        self._read_sout_thread.join()
-        self._read_sout_thread = None
+        if self._read_sout_thread is not None:
+            debug("waiting for checker thread.")
+            self._read_sout_thread.join()
+            self._read_sout_thread = None
 
         debug("ok, finished.")
 
@@ -1,150 +1,371 @@
-from logging import getLogger
-from math import atan2, degrees, sqrt
-
-from smbus import SMBus
-from threading import Thread, Event
-
-# Power management registers
-POWER_MANAGEMENT_1 = 0x6b
-POWER_MANAGEMENT_2 = 0x6c
-
-ADDRESS = 0x68
-
-REVISION = 1  # 1 = Revision 2, 0 = Revision 1
-
-SLEEP_BETWEEN_READS = 0.01
-TOTAL_READS = 16
-TIME_TO_READ = TOTAL_READS * (SLEEP_BETWEEN_READS + 0.00375)
-
-REMOVE_READS = 5
-REMAINING_READS = float(TOTAL_READS - (2 * REMOVE_READS))
-
-debug = getLogger('       MPU').debug
-
-
-class MPU(object):
-    def __init__(self, period, threshold, rotation_receiver):
-
-        self._stop_event = Event()
-        self._old_x = 10000
-        self._old_y = 10000
-
-        self._period = period
-        self._threshold = threshold
-        self._rotation_receiver = rotation_receiver
-
-        self._bus = SMBus(REVISION)
-        self._bus.write_byte_data(ADDRESS, POWER_MANAGEMENT_1, 0)
-
-        self._mpu_reader_thread = Thread(target=self._read_mpu)
-        self._mpu_reader_thread.daemon = True
-        self._mpu_reader_thread.start()
-
-    def _read_mpu(self):
-        while True:
-            self._stop_event.wait(self._period - TIME_TO_READ)
-            if self._stop_event.isSet():
-                debug("stop event received!")
-                break
-
-            x, y = self.get_average_rotation()
-            if x is None:
-                debug("return value None -> stop")
-                break
-
-            if abs(x - self._old_x) > self._threshold or abs(y - self._old_y) > self._threshold:
-                self._old_x = x
-                self._old_y = y
-                self._rotation_receiver(x, y)
-
-    def _read_byte(self, adr):
-        return self._bus.read_byte_data(ADDRESS, adr)
-
-    def _read_word(self, adr):
-        high = self._bus.read_byte_data(ADDRESS, adr)
-        low = self._bus.read_byte_data(ADDRESS, adr + 1)
-        val = (high << 8) + low
-        return val
-
-    def _read_word_2c(self, adr):
-        val = self._read_word(adr)
-        if val >= 0x8000:
-            return -((65535 - val) + 1)
-        else:
-            return val
-
-    @staticmethod
-    def _dist(a, b):
-        return sqrt((a * a) + (b * b))
-
-    @staticmethod
-    def _get_y_rotation(x, y, z):
-        radians = atan2(x, MPU._dist(y, z))
-        return -degrees(radians)
-
-    @staticmethod
-    def _get_x_rotation(x, y, z):
-        radians = atan2(y, MPU._dist(x, z))
-        return degrees(radians)
-
-    def get_rotation(self):
-        accel_xout = self._read_word_2c(0x3b)
-        accel_yout = self._read_word_2c(0x3d)
-        accel_zout = self._read_word_2c(0x3f)
-
-        accel_xout_scaled = accel_xout / 16384.0
-        accel_yout_scaled = accel_yout / 16384.0
-        accel_zout_scaled = accel_zout / 16384.0
-
-        x = MPU._get_x_rotation(accel_xout_scaled, accel_yout_scaled, accel_zout_scaled)
-        y = MPU._get_y_rotation(accel_xout_scaled, accel_yout_scaled, accel_zout_scaled)
-        return x, y
-
-    def get_average_rotation(self):
-        xs = []
-        ys = []
-        for i in range(TOTAL_READS):
-            x, y = self.get_rotation()
-            xs.append(x)
-            ys.append(y)
-            self._stop_event.wait(SLEEP_BETWEEN_READS)
-            if self._stop_event.isSet():
-                debug("terminated while reading average rotation")
-                return None, None
-
-        return sum(sorted(xs)[REMOVE_READS:-REMOVE_READS]) / REMAINING_READS, sum(
-            sorted(ys)[REMOVE_READS:-REMOVE_READS]) / REMAINING_READS
-
-    def terminate(self):
-        debug("MPU terminating...")
-        self._stop_event.set()
-
-        debug("waiting for mpu thread.")
-        self._mpu_reader_thread.join()
-        self._mpu_reader_thread = None
-
-        debug("ok, finished.")
-
-
-################################################################
-
-def main():
-    from SetupLogging import setup_stdout_logging
-    setup_stdout_logging()
-
-    debug("tilt the device!")
-    debug("ENTER to start, ENTER or CTRL + C to quit")
-    raw_input()
-
-    mpu = MPU(0.5, 0, lambda x, y: debug("rot=" + str(x) + ", " + str(y)))
-
-    try:
-        raw_input()
-    except:
-        pass
-
-    mpu.terminate()
-
-
-if __name__ == "__main__":
-    main()
+from logging import getLogger
+from struct import unpack
+from monotonic import monotonic as mtime
+
+from smbus import SMBus
+from threading import Thread, Event
+
+from TiltFilter import TiltFilter, accel_rotation, zone
+
+# Power management registers
+POWER_MANAGEMENT_1 = 0x6b
+POWER_MANAGEMENT_2 = 0x6c
+
+ADDRESS = 0x68
+
+REVISION = 1  # 1 = Revision 2, 0 = Revision 1
+
+# Data registers, accel x, y, z, temperature and gyro x, y, z are read in one block
+ACCEL_XOUT_H = 0x3b
+SAMPLE_REGISTERS = 14
+
+ACCEL_SCALE = 16384.0  # LSB per g at +-2 g
+GYRO_SCALE = 131.0  # LSB per degree per second at +-250 degrees per second
+
+# Configuration and FIFO registers
+SMPLRT_DIV = 0x19
+CONFIG = 0x1a
+ACCEL_CONFIG = 0x1c
+MOT_THR = 0x1f
+MOT_DUR = 0x20
+FIFO_EN = 0x23
+INT_PIN_CFG = 0x37
+INT_ENABLE = 0x38
+USER_CTRL = 0x6a
+FIFO_COUNT_H = 0x72
+FIFO_R_W = 0x74
+
+FIFO_EN_ACCEL_AND_GYRO = 0x78
+USER_CTRL_FIFO_EN = 0x40
+USER_CTRL_FIFO_RESET = 0x04
+
+FIFO_SIZE = 1024
+FIFO_SAMPLE_SIZE = 12  # accel x, y, z and gyro x, y, z
+
+# SMBus block reads are limited to 32 bytes
+MAX_BLOCK_READ = 32
+
+# 10 Hz low pass, the gyro output rate is 1 kHz with the filter on
+DLPF_CFG = 5
+GYRO_OUTPUT_RATE = 1000
+FIFO_SAMPLE_RATE = 25
+
+# degrees beyond a zone limit it takes to leave a zone
+ZONE_HYSTERESIS = 5
+
+# Motion wake up: the INT pin pulses whenever the high pass filtered acceleration exceeds the threshold
+ACCEL_HPF_5HZ = 0x01
+MOTION_THRESHOLD = 20  # 2 mg per LSB
+MOTION_DURATION = 1  # ms
+INT_PIN_CFG_ACTIVE_HIGH_PULSE = 0x00
+INT_ENABLE_MOTION = 0x40
+
+# seconds without a motion interrupt before sampling stops
+SETTLE_TIME = 3
+
+# seconds to leave the bus alone after a failed read
+ERROR_BACKOFF = 1
+
+debug = getLogger('       MPU').debug
+
+
+class MPU(object):
+    _TERMINATE_TIMEOUT = 5
+
+    # Every sample goes through a TiltFilter, the MPU is read every period.
+    #
+    # use_fifo: the MPU samples into its FIFO on its own and everything since the last period is read in one go
+    # zones: sorted x rotation limits, the receiver gets the rotation whenever it crosses into another zone instead
+    #        of whenever it changed by more than threshold
+    # motion_pin: GPIO the MPU's INT is connected to. Sampling stops settle_time seconds after the last motion
+    #             interrupt and only starts again with the next one.
+    # reactor: the periods are timers on the Reactor instead of a thread of its own
+    def __init__(self, period, threshold, rotation_receiver, use_fifo=False, zones=None, hysteresis=ZONE_HYSTERESIS,
+                 motion_pin=None, settle_time=SETTLE_TIME, reactor=None):
+
+        self._stop_event = Event()
+        self._terminated = Event()
+        self._old_x = 10000
+        self._old_y = 10000
+
+        self._period = period
+        self._threshold = threshold
+        self._rotation_receiver = rotation_receiver
+
+        self._filter = TiltFilter()
+        self._zones = zones
+        self._hysteresis = hysteresis
+        self._zone = None
+        self._last_sample_time = None
+
+        self._bus = SMBus(REVISION)
+        self._bus.write_byte_data(ADDRESS, POWER_MANAGEMENT_1, 0)
+
+        self._use_fifo = use_fifo
+        if use_fifo:
+            self._setup_fifo()
+            # don't let the fifo run over between two reads
+            self._wait_time = min(period, FIFO_SIZE / 2.0 / (FIFO_SAMPLE_RATE * FIFO_SAMPLE_SIZE))
+        else:
+            self._wait_time = period
+
+        self._motion_pin = motion_pin
+        self._settle_time = settle_time
+        self._motion_event = Event()
+        self._last_motion_time = mtime()
+
+        self.stats = {"reads": 0, "errors": 0, "sleeps": 0, "seconds_asleep": 0.0, "reads_avoided": 0}
+
+        self._reactor = reactor
+        self._mpu_reader_thread = None
+        self._sample_timer = None
+        self._asleep_since = None
+        self._wake_up_pending = False
+
+        if motion_pin is not None:
+            self._setup_motion_interrupt()
+
+        if reactor is None:
+            self._mpu_reader_thread = Thread(target=self._read_mpu)
+            self._mpu_reader_thread.daemon = True
+            self._mpu_reader_thread.start()
+        else:
+            self._sample_timer = reactor.call_later(self._wait_time, self._sample_on_reactor)
+
+    def _read_mpu(self):
+        while True:
+            if self._motion_pin is not None and mtime() - self._last_motion_time > self._settle_time:
+                self._sleep_until_motion()
+
+            self._stop_event.wait(self._wait_time)
+            if self._stop_event.isSet():
+                debug("stop event received!")
+                break
+
+            if not self._try_sample():
+                self._stop_event.wait(ERROR_BACKOFF)
+
+    def _sample_on_reactor(self):
+        self._sample_timer = None
+        if self._stop_event.isSet():
+            return
+
+        if not self._try_sample():
+            self._sample_timer = self._reactor.call_later(ERROR_BACKOFF, self._sample_on_reactor)
+            return
+
+        if self._motion_pin is not None and mtime() - self._last_motion_time > self._settle_time:
+            self._asleep_since = mtime()
+
+            # the interrupt thread sets the motion time before it looks at _asleep_since, this looks at the motion
+            # time after setting it: one of both sees the other and a motion right now can't be missed
+            if mtime() - self._last_motion_time > self._settle_time:
+                debug("no motion for " + str(self._settle_time) + " s, waiting for the motion interrupt")
+                return
+            self._asleep_since = None
+
+        self._sample_timer = self._reactor.call_later(self._wait_time, self._sample_on_reactor)
+
+    def _wake_up(self):
+        # on the reactor
+        self._wake_up_pending = False
+        if self._asleep_since is None or self._stop_event.isSet():
+            return
+
+        self._woke_up(mtime() - self._asleep_since)
+        self._asleep_since = None
+        self._sample_timer = self._reactor.call_later(self._wait_time, self._sample_on_reactor)
+
+    def _terminated_on_reactor(self):
+        if self._asleep_since is not None:
+            self._woke_up(mtime() - self._asleep_since)
+            self._asleep_since = None
+        self._terminated.set()
+
+    def _try_sample(self):
+        # False if the bus failed, it usually recovers after a while
+        try:
+            self._sample()
+            return True
+        except IOError as e:
+            self.stats["errors"] += 1
+            debug("reading failed: " + str(e))
+            return False
+
+    def _sample(self):
+        self.stats["reads"] += 1
+        x, y = self._update_filter()
+        if x is None:
+            return
+
+        if self._zones is not None:
+            new_zone = zone(x, self._zones, self._zone, self._hysteresis)
+            if new_zone != self._zone:
+                debug("zone " + str(self._zone) + " -> " + str(new_zone))
+                self._zone = new_zone
+                self._rotation_receiver(x, y)
+
+        elif abs(x - self._old_x) > self._threshold or abs(y - self._old_y) > self._threshold:
+            self._old_x = x
+            self._old_y = y
+            self._rotation_receiver(x, y)
+
+    def _update_filter(self):
+        if self._use_fifo:
+            dt = 1.0 / FIFO_SAMPLE_RATE
+            samples = self.read_fifo()
+        else:
+            now = mtime()
+            dt = self._period if self._last_sample_time is None else now - self._last_sample_time
+            self._last_sample_time = now
+            samples = [self.read_sample()]
+
+        for ax, ay, az, gx, gy, gz in samples:
+            self._filter.update(ax, ay, az, gx, gy, dt)
+
+        return self._filter.x, self._filter.y
+
+    def _setup_motion_interrupt(self):
+        import RPi.GPIO as GPIO
+
+        debug("waking up on motion interrupts on pin " + str(self._motion_pin))
+        self._bus.write_byte_data(ADDRESS, ACCEL_CONFIG, ACCEL_HPF_5HZ)
+        self._bus.write_byte_data(ADDRESS, MOT_THR, MOTION_THRESHOLD)
+        self._bus.write_byte_data(ADDRESS, MOT_DUR, MOTION_DURATION)
+        self._bus.write_byte_data(ADDRESS, INT_PIN_CFG, INT_PIN_CFG_ACTIVE_HIGH_PULSE)
+        self._bus.write_byte_data(ADDRESS, INT_ENABLE, INT_ENABLE_MOTION)
+
+        GPIO.setmode(GPIO.BCM)
+        GPIO.setup(self._motion_pin, GPIO.IN)
+        GPIO.add_event_detect(self._motion_pin, GPIO.RISING, callback=self._motion_detected)
+
+    def _motion_detected(self, pin):
+        self._last_motion_time = mtime()
+        if self._reactor is None:
+            self._motion_event.set()
+        elif self._asleep_since is not None and not self._wake_up_pending:
+            # the pulses keep coming while it moves, only the first one wakes the reactor
+            self._wake_up_pending = True
+            self._reactor.call_soon_threadsafe(self._wake_up)
+
+    def _sleep_until_motion(self):
+        start = mtime()
+
+        # the interrupt sets the motion time before the event, so a motion after the caller's check is either seen
+        # here or sets the event again after it was cleared, like on the reactor
+        self._motion_event.clear()
+        if self._stop_event.isSet() or mtime() - self._last_motion_time <= self._settle_time:
+            return
+
+        debug("no motion for " + str(self._settle_time) + " s, waiting for the motion interrupt")
+        self._motion_event.wait()
+        self._woke_up(mtime() - start)
+
+    def _woke_up(self, asleep):
+        self.stats["sleeps"] += 1
+        self.stats["seconds_asleep"] += asleep
+        self.stats["reads_avoided"] += int(asleep / self._wait_time)
+        debug("woke up after " + str(int(asleep)) + " s")
+
+        # whatever piled up in the meantime is stale
+        self._last_sample_time = None
+        if self._use_fifo:
+            self._reset_fifo()
+
+    def _setup_fifo(self):
+        debug("sampling into the fifo at " + str(FIFO_SAMPLE_RATE) + " Hz")
+        self._bus.write_byte_data(ADDRESS, CONFIG, DLPF_CFG)
+        self._bus.write_byte_data(ADDRESS, SMPLRT_DIV, GYRO_OUTPUT_RATE / FIFO_SAMPLE_RATE - 1)
+        self._bus.write_byte_data(ADDRESS, FIFO_EN, FIFO_EN_ACCEL_AND_GYRO)
+        self._reset_fifo()
+
+    def _reset_fifo(self):
+        self._bus.write_byte_data(ADDRESS, USER_CTRL, USER_CTRL_FIFO_RESET)
+        self._bus.write_byte_data(ADDRESS, USER_CTRL, USER_CTRL_FIFO_EN)
+
+    def _read_block(self, adr, length):
+        data = []
+        while len(data) < length:
+            data += self._bus.read_i2c_block_data(ADDRESS, adr, min(MAX_BLOCK_READ, length - len(data)))
+        return str(bytearray(data))
+
+    def read_sample(self):
+        # accel in g and gyro in degrees per second, all of them from the same instant
+        ax, ay, az, temperature, gx, gy, gz = unpack(">7h", self._read_block(ACCEL_XOUT_H, SAMPLE_REGISTERS))
+        return (ax / ACCEL_SCALE, ay / ACCEL_SCALE, az / ACCEL_SCALE,
+                gx / GYRO_SCALE, gy / GYRO_SCALE, gz / GYRO_SCALE)
+
+    def read_fifo(self):
+        # all samples collected since the last call, as read_sample returns them
+        high, low = self._bus.read_i2c_block_data(ADDRESS, FIFO_COUNT_H, 2)
+        count = (high << 8) | low
+
+        if count >= FIFO_SIZE:
+            # samples were dropped, what's left might not start at a sample boundary
+            debug("fifo overflow")
+            self._reset_fifo()
+            return []
+
+        count -= count % FIFO_SAMPLE_SIZE
+        values = unpack(">" + str(count / 2) + "h", self._read_block(FIFO_R_W, count))
+
+        samples = []
+        for i in range(0, len(values), 6):
+            ax, ay, az, gx, gy, gz = values[i:i + 6]
+            samples.append((ax / ACCEL_SCALE, ay / ACCEL_SCALE, az / ACCEL_SCALE,
+                            gx / GYRO_SCALE, gy / GYRO_SCALE, gz / GYRO_SCALE))
+        return samples
+
+    def get_rotation(self):
+        ax, ay, az = self.read_sample()[:3]
+        return accel_rotation(ax, ay, az)
+
+    def terminate(self):
+        debug("MPU terminating...")
+        self._stop_event.set()
+        self._motion_event.set()
+
+        if self._mpu_reader_thread is not None:
+            debug("waiting for mpu thread.")
+            self._mpu_reader_thread.join()
+            self._mpu_reader_thread = None
+        else:
+            timer = self._sample_timer
+            if timer is not None:
+                timer.cancel()
+
+            # the last sleep is accounted for on the reactor, just like the thread does when it is woken up
+            self._reactor.call_soon_threadsafe(self._terminated_on_reactor)
+            self._terminated.wait(MPU._TERMINATE_TIMEOUT)
+
+        if self._motion_pin is not None:
+            import RPi.GPIO as GPIO
+            GPIO.remove_event_detect(self._motion_pin)
+
+        debug(str(self.stats["reads"]) + " reads, " + str(self.stats["reads_avoided"]) + " avoided by " + str(
+            self.stats["sleeps"]) + " sleeps")
+        debug("ok, finished.")
+
+
+################################################################
+
+def main():
+    from SetupLogging import setup_stdout_logging
+    setup_stdout_logging()
+
+    debug("tilt the device!")
+    debug("ENTER to start, ENTER or CTRL + C to quit")
+    raw_input()
+
+    mpu = MPU(0.5, 0, lambda x, y: debug("rot=" + str(x) + ", " + str(y)), use_fifo=True)
+
+    try:
+        raw_input()
+    except:
+        pass
+
+    mpu.terminate()
+
+
+if __name__ == "__main__":
+    main()
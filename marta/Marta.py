@@ -1,25 +1,39 @@
 # system
 from logging import handlers, getLogger, DEBUG, Formatter, StreamHandler
 from sys import stdout, argv
-from Queue import Queue, Empty
+from Queue import Empty
 from time import sleep, strftime
-from signal import signal, SIGINT
-from os import environ
+from signal import signal, SIGINT, SIGUSR1
+from os import environ, makedirs, remove
+from os.path import isdir, dirname
+from shutil import copyfile
+from threading import Thread
 from monotonic import monotonic as mtime
 import traceback
 
 import Buttons
+import Tracing
+from EventBus import EventBus
 from MartaHandler import MartaHandler
 from LEDStrip import LEDStrip
 from MPG123 import MPG123Player
-from MPU import MPU
-from RFIDReader import RFIDReader
-from TagToHandler import TAG_TO_HANDLER
+from Reactor import Reactor
+from RingLog import RingHandler
 
 debug = getLogger('     Marta').debug
 
 MARTA_BASE_DIR = environ["MARTA"]
 
+TRACE_FILE = MARTA_BASE_DIR + "/logs/trace.txt"
+
+LOG_FILE = MARTA_BASE_DIR + "/logs/mmm.log"
+
+# what happened right before message_loop failed, the log file might lag behind
+CRASH_LOG_FILE = MARTA_BASE_DIR + "/logs/crash.log"
+CRASH_LOG_SECONDS = 30
+
+ANIMATION_CACHE_DIR = MARTA_BASE_DIR + "/cache/animations"
+
 
 class Marta(object):
     ################
@@ -30,6 +44,8 @@ class Marta(object):
     EVENT_MPG123_ERROR = 3
     EVENT_ROTATION = 4
     EVENT_INTERRUPT = 5
+    EVENT_TIMEOUT = 6
+    EVENT_SIGNAL = 7
 
     EXIT_DEBUG = 2
 
@@ -39,7 +55,9 @@ class Marta(object):
         "EVENT_BUTTON",
         "EVENT_MPG123_ERROR",
         "EVENT_ROTATION",
-        "EVENT_INTERRUPT"
+        "EVENT_INTERRUPT",
+        "EVENT_TIMEOUT",
+        "EVENT_SIGNAL"
     ]
 
     ################
@@ -54,21 +72,73 @@ class Marta(object):
     SHUTDOWN_SOUND_PATH = MARTA_BASE_DIR + "/audio/system/shutdown.mp3"
     SYSTEM_SOUND_VOLUME = 2
 
-    def __init__(self):
-        self.__message_queue = Queue()
-        Buttons.setup_gpio(lambda pin, millis: self.__message_queue.put([Marta.EVENT_BUTTON, pin, millis]))
+    # mpg123 only plays files, the shutdown sound is copied to this tmpfs directory so it's never read from the card
+    # again. PCMPlayer keeps it decoded in the audio cache instead.
+    SYSTEM_SOUND_RAM_DIR = "/dev/shm/marta"
+
+    # positions are only used to resume songs and to tell whether a song just started
+    MAX_POSITION_DRIFT_IN_MILLIS = 500
+
+    ################
+    # TILT
+
+    # MusicHandler.rotation_event switches between brightness, volume and pitch at these x rotations
+    TILT_ZONES = [-45, 45]
+    TILT_PERIOD = 0.08
+
+    def __init__(self, led_process=False, use_reactor=True, pcm_audio=False):
+        # led_process: render the animations in a process of its own, see LEDStrip
+        # pcm_audio: play with PCMPlayer instead of remote controlling mpg123, the system sounds and the tags' resume
+        #            points are kept decoded in audio_cache then
+        # use_reactor: mpg123's output, the serial port, the MPU's periods and the animation frames are all handled by
+        #              a single Reactor thread, otherwise each of them has a thread of its own
+        self.__boot_start = mtime()
+        self.__boot_timeline = []
+        self.__boot_errors = []
+
+        self.reactor = None
+        if use_reactor:
+            self.reactor = Reactor()
+            self.reactor.wake_on_signals(self.__signalled)
+            self.reactor.start()
+
+        self.__event_bus = EventBus()
+        Buttons.setup_gpio(self.__put_button_event)
 
         if Buttons.is_pushed(Buttons.POWER_BUTTON) and Buttons.is_pushed(Buttons.RED_BUTTON):
             Buttons.terminate()
             debug("Early user interrupt!")
             exit(Marta.EXIT_DEBUG)
 
-        self.player = MPG123Player(lambda: self.__message_queue.put([Marta.EVENT_SONG_STOPPED]),
-                                   lambda: self.__message_queue.put([Marta.EVENT_MPG123_ERROR]),
-                                   volume=Marta.SYSTEM_SOUND_VOLUME)
-
-        self.leds = LEDStrip()
-
+        # the music handler warms it up while the library comes up
+        self.audio_cache = None
+        if pcm_audio:
+            from AudioCache import AudioCache
+            self.audio_cache = AudioCache()
+        self.__shutdown_sound_path = Marta.SHUTDOWN_SOUND_PATH
+
+        # Everything that doesn't make a sound comes up in the background while the startup sound plays
+        stages = [self.__start_stage("system sounds", self.__keep_system_sounds),
+                  self.__start_stage("library", self.__start_library),
+                  self.__start_stage("mpu", self.__start_mpu),
+                  self.__start_stage("rfid", self.__start_rfid)]
+
+        stage_start = mtime()
+        on_stop = lambda: self.__event_bus.put([Marta.EVENT_SONG_STOPPED])
+        on_error = lambda: self.__event_bus.put([Marta.EVENT_MPG123_ERROR], priority=EventBus.PRIORITY_CRITICAL)
+        if pcm_audio:
+            from PCMPlayer import PCMPlayer
+            self.player = PCMPlayer(on_stop, on_error, volume=Marta.SYSTEM_SOUND_VOLUME, prefetch=True,
+                                    cache=self.audio_cache)
+        else:
+            self.player = MPG123Player(on_stop, on_error, volume=Marta.SYSTEM_SOUND_VOLUME, prefetch=True,
+                                       max_position_drift_in_millis=Marta.MAX_POSITION_DRIFT_IN_MILLIS,
+                                       reactor=self.reactor)
+
+        self.leds = LEDStrip(ANIMATION_CACHE_DIR, separate_process=led_process, reactor=self.reactor)
+        self.__add_to_boot_timeline("mpg123 and leds", stage_start)
+
+        stage_start = mtime()
         self.player.load_track_from_file(Marta.START_SOUND_PATH)
         self.leds.startup()
         self.player.play_track()
@@ -81,42 +151,148 @@ class Marta(object):
         # False = GPIO.LOW = 0
         g = True
         while self.player.is_track_playing():
+            # a tag placed right after power on shouldn't have to wait for the startup sound
+            if self.__event_bus.has_pending(Marta.EVENT_RFID_TAG):
+                debug("tag placed during startup")
+                self.player.stop_track()
+                break
+
             Buttons.set_status_led(g)
             sleep(0.2)
             g = not g
 
         Buttons.set_status_led(0)
+        self.__add_to_boot_timeline("startup sound", stage_start)
+
+        for stage in stages:
+            stage.join()
 
-        # Empty q after short period of time (player stop event and button pushes)
+        if len(self.__boot_errors) is not 0:
+            raise self.__boot_errors[0]
+
+        # Empty q after short period of time (player stop event and button pushes), tags and rotations are kept
         sleep(0.1)
-        while not self.__message_queue.empty():
-            self.__message_queue.get(block=False)
+        self.__event_bus.discard([Marta.EVENT_RFID_TAG, Marta.EVENT_ROTATION])
+
+        debug("boot timeline:")
+        for name, start, end in sorted(self.__boot_timeline, key=lambda stage: stage[1]):
+            debug("  %-16s %6d ms - %6d ms" % (name, start * 1000, end * 1000))
 
-        self.mpu = MPU(period=1, threshold=5,
-                       rotation_receiver=lambda x, y: self.__message_queue.put([Marta.EVENT_ROTATION, x, y]))
+    def __add_to_boot_timeline(self, name, stage_start):
+        now = mtime()
+        self.__boot_timeline.append((name, stage_start - self.__boot_start, now - self.__boot_start))
+        Tracing.record("boot." + name, now - stage_start)
 
-        self.rfid_reader = RFIDReader(lambda tag: self.__message_queue.put([Marta.EVENT_RFID_TAG, tag]))
+    def __start_stage(self, name, target):
+        def run():
+            stage_start = mtime()
+            try:
+                target()
+            except Exception as e:
+                debug("boot stage " + name + " failed: " + str(e))
+                self.__boot_errors.append(e)
+            self.__add_to_boot_timeline(name, stage_start)
+
+        thread = Thread(target=run, name=name)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def __keep_system_sounds(self):
+        # the startup sound plays once per boot, keeping it wouldn't help
+        if self.audio_cache is not None:
+            self.audio_cache.warm("shutdown", Marta.SHUTDOWN_SOUND_PATH, seconds=None, pinned=True)
+            return
+
+        if not isdir(dirname(Marta.SYSTEM_SOUND_RAM_DIR)):
+            debug("no tmpfs, the shutdown sound stays on the card")
+            return
+
+        if not isdir(Marta.SYSTEM_SOUND_RAM_DIR):
+            makedirs(Marta.SYSTEM_SOUND_RAM_DIR)
+        path = Marta.SYSTEM_SOUND_RAM_DIR + "/shutdown.mp3"
+        copyfile(Marta.SHUTDOWN_SOUND_PATH, path)
+        self.__shutdown_sound_path = path
+
+    def __start_library(self):
+        # the music handler scans the library when it's created
+        from TagToHandler import TAG_TO_HANDLER
+        TAG_TO_HANDLER["default"].get_instance(self)
+
+    def __start_mpu(self):
+        from MPU import MPU
+
+        # only the latest rotation is of interest
+        self.mpu = MPU(period=Marta.TILT_PERIOD, threshold=5, use_fifo=True, zones=Marta.TILT_ZONES,
+                       motion_pin=Buttons.MPU_INTERRUPT, reactor=self.reactor,
+                       rotation_receiver=lambda x, y: self.__event_bus.put([Marta.EVENT_ROTATION, x, y],
+                                                                           key=Marta.EVENT_ROTATION, replace=True))
+
+    def __start_rfid(self):
+        from RFIDReader import RFIDReader
+        self.rfid_reader = RFIDReader(
+            lambda tag: self.__event_bus.put([Marta.EVENT_RFID_TAG, tag], key=Marta.EVENT_RFID_TAG),
+            reactor=self.reactor)
+
+    def __put_button_event(self, pin, millis):
+        if pin == Buttons.POWER_BUTTON:
+            self.__event_bus.put([Marta.EVENT_BUTTON, pin, millis], priority=EventBus.PRIORITY_CRITICAL)
+        else:
+            self.__event_bus.put([Marta.EVENT_BUTTON, pin, millis], key=(Marta.EVENT_BUTTON, pin))
+
+    def take_pending_buttons(self, pin):
+        # for handlers that coalesce presses: the number of pending presses of pin, they won't be handled anymore
+        taken = 0
+        while self.__event_bus.take((Marta.EVENT_BUTTON, pin)) is not None:
+            taken += 1
+        return taken
 
     def interrupt(self):
-        self.__message_queue.put([Marta.EVENT_INTERRUPT])
+        self.__event_bus.put([Marta.EVENT_INTERRUPT], priority=EventBus.PRIORITY_CRITICAL)
+
+    def __signalled(self):
+        # on the reactor thread: the main thread runs the signal handlers as soon as it gets a message
+        self.__event_bus.put([Marta.EVENT_SIGNAL], priority=EventBus.PRIORITY_CRITICAL, key=Marta.EVENT_SIGNAL,
+                             replace=True)
+
+    def __wait_for_event(self, timeout):
+        # Python 2's timed waits poll the clock every 50 ms, with a reactor a timer wakes up the untimed wait instead.
+        # The untimed wait can't be interrupted by signals, the reactor sends EVENT_SIGNAL after one arrived.
+        if self.reactor is None:
+            return self.__event_bus.get(timeout=timeout)
+
+        timer = self.reactor.call_later(timeout, self.__event_bus.put, [Marta.EVENT_TIMEOUT], EventBus.PRIORITY_NORMAL,
+                                        Marta.EVENT_TIMEOUT, True)
+        try:
+            msg, put_time = self.__event_bus.get()
+            while msg[0] == Marta.EVENT_SIGNAL:
+                msg, put_time = self.__event_bus.get()
+        finally:
+            timer.cancel()
+
+        if msg[0] == Marta.EVENT_TIMEOUT:
+            raise Empty()
+
+        return msg, put_time
 
     def message_loop(self):
+        from TagToHandler import TAG_TO_HANDLER
 
         current_handler = TAG_TO_HANDLER["default"].get_instance(self)
         max_mono_time = mtime() + current_handler.initialize()
 
         while True:
             now = mtime()
-            debug("now = " + str(now))
+            debug("now = %s", now)
 
             if now >= max_mono_time:
                 debug("timeout occurred")
                 break
 
             timeout = max_mono_time - now
-            debug("waiting for " + str(timeout))
+            debug("waiting for %s", timeout)
             try:
-                msg = self.__message_queue.get(block=True, timeout=timeout)
+                msg, put_time = self.__wait_for_event(timeout)
             except Empty:
                 # If a time change (due to network time availability) occurs while waiting for an event,
                 # Queue.get will return Empty early:
@@ -160,17 +336,22 @@ class Marta(object):
                     current_handler = TAG_TO_HANDLER[tag].get_instance(self)
                     current_handler.initialize()
 
-            debug(Marta.EVENT_HUMAN_READABLE[event] + ": " + str(params))
-            if event == Marta.EVENT_ROTATION:
-                return_val = current_handler.rotation_event(params[0], params[1])
-            elif event == Marta.EVENT_SONG_STOPPED:
-                return_val = current_handler.player_stop_event()
-            elif event == Marta.EVENT_RFID_TAG:
-                return_val = current_handler.rfid_tag_event(params[0])
-            elif event == Marta.EVENT_BUTTON:
-                return_val = current_handler.button_event(params[0], params[1])
-            else:
-                raise Exception("Unknown event: " + str(event))
+            debug("%s: %s, pending: %d", Marta.EVENT_HUMAN_READABLE[event], params, self.__event_bus.depth())
+            with Tracing.span("dispatch." + Marta.EVENT_HUMAN_READABLE[event]):
+                if event == Marta.EVENT_ROTATION:
+                    return_val = current_handler.rotation_event(params[0], params[1])
+                elif event == Marta.EVENT_SONG_STOPPED:
+                    return_val = current_handler.player_stop_event()
+                elif event == Marta.EVENT_RFID_TAG:
+                    return_val = current_handler.rfid_tag_event(params[0])
+                elif event == Marta.EVENT_BUTTON:
+                    return_val = current_handler.button_event(params[0], params[1])
+                else:
+                    raise Exception("Unknown event: " + str(event))
+
+            # from putting the event into the bus (e.g. the button edge) until it was handled
+            self.__event_bus.record_dispatch(Marta.EVENT_HUMAN_READABLE[event], put_time)
+            Tracing.record("event." + Marta.EVENT_HUMAN_READABLE[event], mtime() - put_time)
 
             if return_val is None:
                 debug("not changing the timeout")
@@ -183,6 +364,8 @@ class Marta(object):
                 max_mono_time = mtime() + return_val
 
         current_handler.uninitialize()
+        self.__event_bus.log_stats()
+        Tracing.dump(TRACE_FILE)
 
     def terminate(self):
         debug("Terminating!")
@@ -190,7 +373,7 @@ class Marta(object):
         try:
             self.player.set_volume(Marta.SYSTEM_SOUND_VOLUME)
             self.player.set_pitch(100)
-            self.player.load_track_from_file(Marta.SHUTDOWN_SOUND_PATH)
+            self.player.load_track_from_file(self.__shutdown_sound_path)
             self.player.play_track()
         except:
             pass
@@ -217,6 +400,14 @@ class Marta(object):
         except:
             pass
 
+        try:
+            if self.audio_cache is not None:
+                self.audio_cache.terminate()
+            if self.__shutdown_sound_path != Marta.SHUTDOWN_SOUND_PATH:
+                remove(self.__shutdown_sound_path)
+        except:
+            pass
+
         try:
             self.rfid_reader.terminate()
         except:
@@ -227,6 +418,12 @@ class Marta(object):
         except:
             pass
 
+        try:
+            if self.reactor is not None:
+                self.reactor.stop()
+        except:
+            pass
+
         try:
             for i in range(10):
                 Buttons.set_status_led(i % 2)
@@ -245,14 +442,19 @@ def main():
     logger.setLevel(DEBUG)
     formatter = Formatter("%(asctime)s.%(msecs)03d | %(name)s |    %(message)s", "%H:%M:%S")
 
+    if "trace" in argv:
+        Tracing.enable()
+
     if "log2stdout" in argv:
         ch = StreamHandler(stdout)
         ch.setFormatter(formatter)
         logger.addHandler(ch)
 
-    fh = handlers.RotatingFileHandler(MARTA_BASE_DIR + "/logs/mmm.log", maxBytes=(1024 * 1024 * 10), backupCount=10)
+    # the card is only written by the ring's flusher, never by the thread that logs
+    fh = handlers.RotatingFileHandler(LOG_FILE, maxBytes=(1024 * 1024 * 10), backupCount=10)
     fh.setFormatter(formatter)
-    logger.addHandler(fh)
+    ring = RingHandler(fh)
+    logger.addHandler(ring)
 
     debug("#################################################")
     debug("#                  INITIALIZED                  #")
@@ -292,8 +494,9 @@ def main():
     exit_val = 0
 
     debug("initializing")
-    marta = Marta()
+    marta = Marta(led_process="ledprocess" in argv, use_reactor="threads" not in argv, pcm_audio="pcm" in argv)
     signal(SIGINT, lambda s, f: marta.interrupt())
+    signal(SIGUSR1, lambda s, f: Tracing.dump(TRACE_FILE))
 
     debug("looping")
     try:
@@ -301,6 +504,7 @@ def main():
     except Exception as e:
         debug("excepted: " + str(e))
         debug(traceback.format_exc())
+        ring.dump(CRASH_LOG_FILE, CRASH_LOG_SECONDS)
         exit_val = 1
 
     marta.terminate()
@@ -1,11 +1,12 @@
 from logging import getLogger
-from os import listdir, environ, remove
+from os import environ, remove
 
 import Buttons
-from Util import sorted_aphanumeric
 from LEDStrip import LEDStrip
+from Ingest import load_manifest, TRACK_GAINS
 from MartaHandler import MartaHandler
-from TagToDir import TAG_TO_DIR, prepare, ALBUM_INDICATOR_FILE
+from StateStore import StateStore
+from TagToDir import TAG_TO_DIR, ALBUM_TO_SONGS, prepare, SONG_STATE_FILE
 from os.path import exists
 
 debug = getLogger('MscHandler').debug
@@ -29,14 +30,38 @@ class MusicHandler(MartaHandler):
 
     SONG_DIR = MARTA_BASE_DIR + "/audio/"
     UNKNOWN_TAG_FILE = SONG_DIR + "/unknown_tag.txt"
-
-    SONG_STATE_FILE = ".songstate"
+    LIBRARY_INDEX_FILE = MARTA_BASE_DIR + "/cache/library.index"
+    LIBRARY_MANIFEST_FILE = MARTA_BASE_DIR + "/cache/library.manifest"
+    STATE_DIR = MARTA_BASE_DIR + "/state"
+
+    # only read, for albums that have no state in the state store yet
+    SONG_STATE_FILE = SONG_STATE_FILE
+
+    # State store keys, album directories relative to SONG_DIR
+    # position:<album dir> -> "<song index> <position in millis>"
+    # album:<tag> -> album dir that was played last
+    # plays:<tag> -> how often the tag was placed
+    # volume -> player volume
+    STATE_POSITION = "position:"
+    STATE_ALBUM = "album:"
+    STATE_PLAYS = "plays:"
+    STATE_VOLUME = "volume"
+
+    # the resume points of that many of the most played tags are decoded into the audio cache at startup, every
+    # removed tag's is added to them
+    CACHED_TAGS = 5
 
     LONG_TIMEOUT = 20 * 60
     SHORT_TIMEOUT = 5 * 60
 
     LONG_CLICK_THRESHOLD = 1500
 
+    # a press of one of them right after the other one takes it back, see button_red_green_event
+    STEPS = {
+        Buttons.RED_BUTTON: 1,
+        Buttons.GREEN_BUTTON: -1
+    }
+
     #################
     # SINGLETON
     instance = None
@@ -62,20 +87,71 @@ class MusicHandler(MartaHandler):
             debug("unknown tag file exists. removing")
             remove(MusicHandler.UNKNOWN_TAG_FILE)
 
-        prepare(MusicHandler.SONG_DIR)
+        self.state = StateStore(MusicHandler.STATE_DIR)
+
+        prepare(MusicHandler.SONG_DIR, MusicHandler.LIBRARY_INDEX_FILE)
+        load_manifest(MusicHandler.SONG_DIR, MusicHandler.LIBRARY_MANIFEST_FILE)
+        self.restore_album_order()
+        self.warm_most_played()
+
+    @staticmethod
+    def relative_dir(song_dir):
+        return song_dir[len(MusicHandler.SONG_DIR):]
+
+    def restore_album_order(self):
+        for tag, albums in TAG_TO_DIR.items():
+            current = self.state.get(MusicHandler.STATE_ALBUM + tag)
+            relative_albums = [MusicHandler.relative_dir(album) for album in albums]
+            if current in relative_albums:
+                i = relative_albums.index(current)
+                TAG_TO_DIR[tag] = albums[i:] + albums[:i]
+
+    def plays(self, tag):
+        return int(self.state.get(MusicHandler.STATE_PLAYS + tag, 0))
+
+    def warm_most_played(self):
+        cache = self.marta.audio_cache
+        if cache is None:
+            return
+
+        tags = sorted(TAG_TO_DIR.keys(), key=self.plays, reverse=True)
+        for tag in tags:
+            cache.use(tag, self.plays(tag))
+        for tag in tags[:MusicHandler.CACHED_TAGS]:
+            self.warm_resume_point(tag)
+
+    def warm_resume_point(self, tag):
+        # the beginning of what plays when the tag is placed next time
+        cache = self.marta.audio_cache
+        if cache is None:
+            return
+
+        song_dir = TAG_TO_DIR[tag][0]
+        songs = ALBUM_TO_SONGS.get(song_dir, [])
+        if len(songs) is 0:
+            return
+
+        song_index, position = self.resume_point(song_dir)
+        cache.warm(tag, song_dir + "/" + songs[song_index], position)
+
+    def load_current_song(self):
+        song = self.all_songs[self.current_song_index]
+        self.marta.player.load_track_from_file(song, TRACK_GAINS.get(song, 0))
 
     def initialize(self):
         debug("init")
+        volume = self.state.get(MusicHandler.STATE_VOLUME)
+        if volume is not None:
+            self.marta.player.set_volume(int(volume))
         return MusicHandler.SHORT_TIMEOUT
 
     def save_state_and_stop(self):
         self.marta.player.pause_track()
 
         debug("Saving state.")
-        with open(self.current_song_dir + "/" + MusicHandler.SONG_STATE_FILE, 'w') as state_file:
-            debug("writing to file: " + self.current_song_dir + "/" + MusicHandler.SONG_STATE_FILE)
-            state_file.write(
-                str(self.current_song_index) + "\n" + str(self.marta.player.get_position_in_millis()) + "\n")
+        self.state.set(MusicHandler.STATE_POSITION + MusicHandler.relative_dir(self.current_song_dir),
+                       str(self.current_song_index) + " " + str(self.marta.player.get_position_in_millis()))
+        self.warm_resume_point(self.current_tag)
         self.current_song_dir = None
         self.current_tag = None
         self.all_songs = None
@@ -84,34 +160,51 @@ class MusicHandler(MartaHandler):
         self.expected_stop = True
         self.marta.player.stop_track()
 
+    def resume_point(self, song_dir):
+        # (song index, position in millis) to continue the album with
+        song_index = 0
+        position = 0
+
+        state = self.state.get(MusicHandler.STATE_POSITION + MusicHandler.relative_dir(song_dir))
+        if state is not None:
+            index, position = state.split()
+            song_index = int(index)
+            position = long(position)
+
+        elif exists(song_dir + "/" + MusicHandler.SONG_STATE_FILE):
+            with open(song_dir + "/" + MusicHandler.SONG_STATE_FILE) as state_file:
+                debug("reading from file: " + song_dir + "/" + MusicHandler.SONG_STATE_FILE)
+                lines = state_file.readlines()
+                lines = [line.strip() for line in lines]
+                song_index = int(lines[0])
+                position = long(lines[1])
+
+        # the album might have changed since
+        if song_index >= len(ALBUM_TO_SONGS[song_dir]):
+            return 0, 0
+
+        return song_index, position
+
     def load_state(self, tag):
         debug("Loading state.")
         self.current_tag = tag
         self.current_song_dir = TAG_TO_DIR[self.current_tag][0]
         debug("tag name: " + self.current_song_dir)
-        songs = sorted_aphanumeric(listdir(self.current_song_dir))
-
-        current_pos = 0
+        songs = ALBUM_TO_SONGS[self.current_song_dir]
 
-        if ALBUM_INDICATOR_FILE in songs:
-            songs.remove(ALBUM_INDICATOR_FILE)
+        self.current_song_index, current_pos = self.resume_point(self.current_song_dir)
 
-        if MusicHandler.SONG_STATE_FILE in songs:
-            songs.remove(MusicHandler.SONG_STATE_FILE)
-            with open(self.current_song_dir + "/" + MusicHandler.SONG_STATE_FILE) as state_file:
-                debug("reading from file: " + self.current_song_dir + "/" + MusicHandler.SONG_STATE_FILE)
-                lines = state_file.readlines()
-                lines = [line.strip() for line in lines]
-                self.current_song_index = int(lines[0])
-                debug("current song index: " + str(self.current_song_index))
-                current_pos = long(lines[1])
-                debug("current song position: " + str(current_pos))
+        debug("current song index: " + str(self.current_song_index))
+        debug("current song position: " + str(current_pos))
 
         self.all_songs = [self.current_song_dir + "/" + song for song in songs]
         debug("all songs: " + str(self.all_songs))
 
         return current_pos
 
+    def prefetch_next_song(self):
+        self.marta.player.prefetch_track(self.all_songs[(self.current_song_index + 1) % len(self.all_songs)])
+
     def rfid_removed_event(self):
         debug("tag removed.")
         self.marta.leds.fade_up_and_down(LEDStrip.RED)
@@ -119,8 +212,12 @@ class MusicHandler(MartaHandler):
         return MusicHandler.SHORT_TIMEOUT
 
     def rfid_music_tag_event(self, tag):
+        self.state.set(MusicHandler.STATE_PLAYS + tag, str(self.plays(tag) + 1))
+        if self.marta.audio_cache is not None:
+            self.marta.audio_cache.use(tag)
+
         current_position = self.load_state(tag)
-        self.marta.player.load_track_from_file(self.all_songs[self.current_song_index])
+        self.load_current_song()
         if current_position != 0:
             self.marta.player.set_position_in_millis(current_position)
 
@@ -129,6 +226,7 @@ class MusicHandler(MartaHandler):
         else:
             self.marta.leds.song(self.current_song_index, len(self.all_songs))
         self.marta.player.play_track()
+        self.prefetch_next_song()
         return MusicHandler.LONG_TIMEOUT
 
     def rfid_tag_event(self, tag):
@@ -198,8 +296,9 @@ class MusicHandler(MartaHandler):
             self.marta.leds.fade_up_and_down(LEDStrip.GREEN)
         else:
             self.marta.leds.song(self.current_song_index, len(self.all_songs))
-        self.marta.player.load_track_from_file(self.all_songs[self.current_song_index])
+        self.load_current_song()
         self.marta.player.play_track()
+        self.prefetch_next_song()
 
     def button_red_green_event(self, pin, millis):
         if self.currently_controlling == MusicHandler.CONTROL_VOLUME:
@@ -219,13 +318,14 @@ class MusicHandler(MartaHandler):
 
         current = arr.index(current)
 
-        if pin == Buttons.RED_BUTTON:
-            new = current + 1
-        else:
-            new = current - 1
+        # the presses that piled up meanwhile are netted and applied at once
+        steps = MusicHandler.STEPS[pin]
+        for other, step in MusicHandler.STEPS.items():
+            steps += step * self.marta.take_pending_buttons(other)
 
-        if new < 0 or new >= len(arr):
-            debug("would be out of bounds")
+        new = min(max(current + steps, 0), len(arr) - 1)
+        if new == current:
+            debug("nothing to change by " + str(steps) + " steps")
             self.marta.leds.volume(current)
             return
 
@@ -236,17 +336,13 @@ class MusicHandler(MartaHandler):
 
         if self.currently_controlling == MusicHandler.CONTROL_VOLUME:
             self.marta.player.set_volume(new)
+            self.state.set(MusicHandler.STATE_VOLUME, new)
         elif self.currently_controlling == MusicHandler.CONTROL_PITCH:
             self.marta.player.set_pitch(new)
         else:
             self.marta.leds.set_brightness(new)
 
     def button_next_previous_album(self, pin):
-        album_indicator = self.current_song_dir + "/" + ALBUM_INDICATOR_FILE
-        if exists(album_indicator):
-            debug("removing album indicator: " + album_indicator)
-            remove(album_indicator)
-
         tag = self.current_tag
 
         off = 1 if pin == Buttons.YELLOW_BUTTON else -1
@@ -256,8 +352,7 @@ class MusicHandler(MartaHandler):
         self.rfid_removed_event()
         self.rfid_tag_event(tag)
 
-        album_indicator = self.current_song_dir + "/" + ALBUM_INDICATOR_FILE
-        open(album_indicator, 'w').close()
+        self.state.set(MusicHandler.STATE_ALBUM + tag, MusicHandler.relative_dir(self.current_song_dir))
 
     def button_next_previous_song(self, pin):
         if pin == Buttons.BLUE_BUTTON:
@@ -277,8 +372,9 @@ class MusicHandler(MartaHandler):
             self.expected_stop = True
             self.marta.player.stop_track()
             self.current_song_index = (self.current_song_index + off) % len(self.all_songs)
-            self.marta.player.load_track_from_file(self.all_songs[self.current_song_index])
+            self.load_current_song()
             self.marta.player.play_track()
+            self.prefetch_next_song()
 
         if len(self.all_songs) == 1:
             self.marta.leds.fade_up_and_down(LEDStrip.GREEN)
@@ -310,3 +406,6 @@ class MusicHandler(MartaHandler):
         debug("uninitialize")
         if self.current_tag is not None:
             self.save_state_and_stop()
+
+        # the device might be switched off next
+        self.state.flush()
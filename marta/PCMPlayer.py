@@ -0,0 +1,569 @@
+from subprocess import Popen, PIPE
+from threading import Thread, Condition
+from os import devnull
+from os.path import exists
+from time import sleep
+import audioop
+import wave
+from logging import getLogger
+from monotonic import monotonic as mtime
+
+from AudioBackend import AudioBackend
+from MP3Info import get_mp3_info
+from Tracing import span
+import Tracing
+
+debug = getLogger(' PCMPlayer').debug
+
+# Everything is played as 16 bit stereo at this rate, mpg123 resamples what doesn't match
+OUTPUT_RATE = 44100
+CHANNELS = 2
+SAMPLE_WIDTH = 2
+FRAME_SIZE = CHANNELS * SAMPLE_WIDTH
+
+# audio is handed to the sink in pieces of that many seconds
+PERIOD = 0.02
+
+MPG123_BINARY = "mpg123"
+
+
+def pcm_bytes(seconds):
+    return int(seconds * OUTPUT_RATE) * FRAME_SIZE
+
+
+def decode(file_name, info, position, stderr):
+    # (mpg123 process decoding file_name to its stdout, bytes of its output before position), position in bytes.
+    # mpg123 skips whole mpeg frames, it starts with the frame containing position.
+    frames = 0
+    start = 0
+    if position > 0 and info is not None:
+        samples_per_frame = 1152 if info.sample_rate >= 32000 else 576
+        frames = int(position / FRAME_SIZE * float(info.sample_rate) / OUTPUT_RATE / samples_per_frame)
+        start = pcm_bytes(frames * samples_per_frame / float(info.sample_rate))
+
+    process = Popen([MPG123_BINARY, "-q", "-s", "-r", str(OUTPUT_RATE), "--stereo", "-k", str(frames), file_name],
+                    stdout=PIPE, stderr=stderr)
+    return process, position - start
+
+
+class _PCMRing(object):
+    # A window of one track's decoded audio, positions are byte offsets into all of it. It holds what was decoded
+    # ahead of the read position and, as long as there is room, what was played last. Seeking anywhere within is
+    # instant. Not thread safe, PCMPlayer holds its lock.
+
+    def __init__(self, capacity):
+        self._data = bytearray(capacity)
+        self._capacity = capacity
+        self.reset(0)
+
+    def reset(self, position):
+        self.start = position
+        self.end = position
+        self.read_position = position
+        self.complete = False
+
+    def ahead(self):
+        return self.end - self.read_position
+
+    def capacity(self):
+        return self._capacity
+
+    def write(self, data):
+        offset = self.end % self._capacity
+        first = min(len(data), self._capacity - offset)
+        self._data[offset:offset + first] = data[:first]
+        self._data[:len(data) - first] = data[first:]
+        self.end += len(data)
+        self.start = max(self.start, self.end - self._capacity)
+
+    def read(self, size):
+        size = min(size, self.end - self.read_position)
+        offset = self.read_position % self._capacity
+        first = min(size, self._capacity - offset)
+        data = str(self._data[offset:offset + first] + self._data[:size - first])
+        self.read_position += size
+        return data
+
+    def seek(self, position):
+        # False if position isn't in the buffer
+        if not self.start <= position <= self.end:
+            return False
+
+        self.read_position = position
+        return True
+
+
+class NullSink(object):
+    # Discards the audio, but takes as long as playing it would
+
+    # the device's buffer, writes return that much before the audio is over
+    _LATENCY = 0.05
+
+    def __init__(self):
+        self._clock = 0
+
+    def write(self, data):
+        now = mtime()
+        self._clock = max(self._clock, now) + len(data) / float(FRAME_SIZE * OUTPUT_RATE)
+        if self._clock - now > NullSink._LATENCY:
+            sleep(self._clock - now - NullSink._LATENCY)
+
+    def close(self):
+        pass
+
+
+class FileSink(NullSink):
+    # Writes the audio to a wav file, in real time like the device would play it
+
+    def __init__(self, path):
+        NullSink.__init__(self)
+        self._wav = wave.open(path, 'wb')
+        self._wav.setnchannels(CHANNELS)
+        self._wav.setsampwidth(SAMPLE_WIDTH)
+        self._wav.setframerate(OUTPUT_RATE)
+
+    def write(self, data):
+        self._wav.writeframes(data)
+        NullSink.write(self, data)
+
+    def close(self):
+        self._wav.close()
+
+
+class AlsaSink(object):
+    # The sound card, writes block until there's room in its buffer
+
+    DEFAULT_DEVICE = "default"
+
+    def __init__(self, device=DEFAULT_DEVICE):
+        import alsaaudio
+
+        self._pcm = alsaaudio.PCM(alsaaudio.PCM_PLAYBACK, alsaaudio.PCM_NORMAL, device)
+        self._pcm.setchannels(CHANNELS)
+        self._pcm.setrate(OUTPUT_RATE)
+        self._pcm.setformat(alsaaudio.PCM_FORMAT_S16_LE)
+        self._pcm.setperiodsize(int(PERIOD * OUTPUT_RATE))
+
+    def write(self, data):
+        self._pcm.write(data)
+
+    def close(self):
+        self._pcm.close()
+
+
+def default_sink():
+    try:
+        return AlsaSink()
+    except Exception as e:
+        debug("no sound card (" + str(e) + "), audio goes nowhere")
+        return NullSink()
+
+
+class PCMPlayer(AudioBackend):
+    # mpg123 only decodes, into a buffer in this process. Volume and pitch are applied to whole periods of audio by
+    # audioop's C loops on the way to the sink, so changing them is just setting a number. The position is the
+    # sample that went to the sink last.
+    #
+    # decode_ahead_in_seconds: how much is decoded ahead of what is played
+    # keep_behind_in_seconds: how much of what was played is kept for seeking back
+    # cache: an AudioCache, tracks it has the audio for start playing from RAM and mpg123 goes on after it. The
+    #        decoder is only started once the track plays or is seeked, so a resumed track is opened just once.
+
+    STATE_STOPPED = 0
+    STATE_PAUSED = 1
+    STATE_PLAYING = 2
+    STATE_TERMINATED = 3
+
+    DEFAULT_DECODE_AHEAD_IN_SECONDS = 3
+    DEFAULT_KEEP_BEHIND_IN_SECONDS = 10
+
+    _DEFAULT_VOLUME = 50
+    _DEFAULT_PITCH = 100
+
+    # what mpg123 hands over in one read
+    _DECODE_CHUNK = 4096 * FRAME_SIZE
+
+    def __init__(self, on_stop_callback, on_error_callback, volume=_DEFAULT_VOLUME, pitch=_DEFAULT_PITCH,
+                 prefetch=False, sink=None, decode_ahead_in_seconds=DEFAULT_DECODE_AHEAD_IN_SECONDS,
+                 keep_behind_in_seconds=DEFAULT_KEEP_BEHIND_IN_SECONDS, cache=None):
+        super(PCMPlayer, self).__init__(prefetch)
+
+        self._on_stop_callback = on_stop_callback
+        self._on_error_callback = on_error_callback
+        self._sink = default_sink() if sink is None else sink
+        self._cache = cache
+        self._devnull = open(devnull, 'w')
+
+        self._decode_ahead = pcm_bytes(decode_ahead_in_seconds)
+        self._ring = _PCMRing(self._decode_ahead + pcm_bytes(keep_behind_in_seconds))
+
+        # guards everything below, the decoder and the output thread wait on it
+        self._condition = Condition()
+        self._current_state = PCMPlayer.STATE_STOPPED
+        self._current_file = None
+        self._info = None
+        self._volume = volume
+        self._gain = 1.0
+        self._pitch = pitch
+
+        # bumped whenever the ring starts over, a decoder of an older generation quits
+        self._generation = 0
+        self._decoder_process = None
+        self._decoder_pending = False
+
+        # waiting for the first period of a new decoder isn't an underrun
+        self._decoder_started = False
+
+        # when play_track was called, until the first period went to the sink
+        self._play_requested = None
+
+        # underruns: periods the decoder didn't deliver in time, seeks: within the buffer, seeks_decoded: the others,
+        # cached_starts: loads and seeks that started from the cache
+        self.stats = {"underruns": 0, "seeks": 0, "seeks_decoded": 0, "decoded_bytes": 0, "played_bytes": 0,
+                      "cached_starts": 0}
+
+        self._output_thread = Thread(target=self._output)
+        self._output_thread.daemon = True
+        self._output_thread.start()
+
+        debug("pcm player initialized")
+
+    def _restart(self, position):
+        # with the lock held: starts over at position (in bytes), with the cached audio if there is any
+        self._stop_decoder()
+        self._generation += 1
+        self._ring.reset(position)
+        self._decoder_started = False
+        self._decoder_pending = True
+
+        cached = None if self._cache is None else self._cache.get(self._current_file, position)
+        if cached is not None:
+            data, complete = cached
+            self.stats["cached_starts"] += 1
+            self._ring.write(data[:self._ring.capacity()])
+            if complete and len(data) <= self._ring.capacity():
+                self._ring.complete = True
+                self._decoder_pending = False
+
+    def _start_decoder(self):
+        # with the lock held: mpg123 fills the ring from its end on
+        self._stop_decoder()
+        self._generation += 1
+        self._decoder_pending = False
+
+        try:
+            self._decoder_process, skip = decode(self._current_file, self._info, self._ring.end, self._devnull)
+        except OSError as e:
+            debug("could not run " + MPG123_BINARY + ": " + str(e))
+            self._ring.complete = True
+            if self._on_error_callback is not None:
+                self._on_error_callback()
+            return
+
+        decoder = Thread(target=self._decode, args=(self._decoder_process, self._generation, skip))
+        decoder.daemon = True
+        decoder.start()
+
+    def _stop_decoder(self):
+        if self._decoder_process is None:
+            return
+
+        # its thread notices it's outdated and waits for it
+        try:
+            self._decoder_process.kill()
+        except OSError:
+            pass
+        self._decoder_process = None
+
+    def _decode(self, process, generation, skip):
+        # the audio from the start of the frame up to the ring's end
+        process.stdout.read(skip)
+
+        while True:
+            data = process.stdout.read(PCMPlayer._DECODE_CHUNK)
+
+            with self._condition:
+                while generation == self._generation and self._ring.ahead() >= self._decode_ahead:
+                    self._condition.wait()
+
+                if generation != self._generation:
+                    break
+
+                if len(data) is 0:
+                    self._ring.complete = True
+                    self._condition.notify_all()
+                    break
+
+                self._ring.write(data)
+                self.stats["decoded_bytes"] += len(data)
+                self._condition.notify_all()
+
+        process.stdout.close()
+        if process.wait() > 0:
+            debug("mpg123 could not decode everything")
+
+    def _output(self):
+        resample_state = None
+        resampling = None
+        underrun = False
+
+        while True:
+            with self._condition:
+                while True:
+                    if self._current_state == PCMPlayer.STATE_TERMINATED:
+                        return
+
+                    if self._current_state == PCMPlayer.STATE_PLAYING and (
+                            self._ring.ahead() > 0 or self._ring.complete):
+                        break
+
+                    if self._current_state == PCMPlayer.STATE_PLAYING and self._decoder_started and not underrun:
+                        underrun = True
+                        self.stats["underruns"] += 1
+                    self._condition.wait()
+
+                underrun = False
+                self._decoder_started = True
+                data = self._ring.read(pcm_bytes(PERIOD))
+                play_requested = self._play_requested
+                self._play_requested = None
+                self._condition.notify_all()
+
+                if len(data) is 0:
+                    debug("track finished")
+                    self._finish()
+                else:
+                    factor = min(1.0, self._volume / 100.0 * self._gain)
+                    rate = int(round(OUTPUT_RATE * self._pitch / 100.0))
+
+            if len(data) is 0:
+                self._on_stop_callback()
+                continue
+
+            if factor != 1.0:
+                data = audioop.mul(data, SAMPLE_WIDTH, factor)
+
+            # a higher pitch plays the same audio in less time, just like mpg123 does it
+            if rate != OUTPUT_RATE:
+                if resampling != rate:
+                    resampling = rate
+                    resample_state = None
+                data, resample_state = audioop.ratecv(data, SAMPLE_WIDTH, CHANNELS, rate, OUTPUT_RATE, resample_state)
+
+            try:
+                self._sink.write(data)
+                if play_requested is not None:
+                    Tracing.record("pcm.start", mtime() - play_requested)
+            except Exception as e:
+                debug("writing to the sink failed: " + str(e))
+                if self._on_error_callback is not None:
+                    self._on_error_callback()
+
+                # the track ends here, just like it ended by itself
+                with self._condition:
+                    stopped = self._current_state != PCMPlayer.STATE_TERMINATED
+                    if stopped:
+                        self._finish()
+                if stopped:
+                    self._on_stop_callback()
+                continue
+
+            self.stats["played_bytes"] += len(data)
+
+    def _finish(self):
+        # with the lock held: nothing is loaded anymore, the caller calls the stop callback without it
+        self._stop_decoder()
+        self._generation += 1
+        self._decoder_pending = False
+        self._current_file = None
+        self._current_state = PCMPlayer.STATE_STOPPED
+        self._condition.notify_all()
+
+    def is_track_playing(self):
+        return self._current_state == PCMPlayer.STATE_PLAYING
+
+    def get_volume(self):
+        return self._volume
+
+    def set_volume(self, volume):
+        if volume < 0:
+            raise ValueError("Out of bounds!")
+        elif volume > 100:
+            raise ValueError("Out of bounds!")
+
+        # the next period is played with it
+        self._volume = volume
+
+    def get_pitch(self):
+        return self._pitch
+
+    def set_pitch(self, pitch):
+        if pitch < 50:
+            raise ValueError("Out of bounds!")
+        elif pitch > 200:
+            raise ValueError("Out of bounds!")
+
+        self._pitch = pitch
+
+    def get_position_in_millis(self):
+        return int(self._ring.read_position / FRAME_SIZE * 1000 / OUTPUT_RATE)
+
+    def set_position_in_millis(self, position_in_millis):
+        position = pcm_bytes(position_in_millis / 1000.0)
+        with self._condition:
+            if self._current_file is None:
+                return
+
+            if self._ring.seek(position):
+                self.stats["seeks"] += 1
+            else:
+                with span("pcm.seek"):
+                    self.stats["seeks_decoded"] += 1
+                    self._restart(position)
+                    if self._current_state == PCMPlayer.STATE_PLAYING:
+                        self._start_decoder()
+            self._condition.notify_all()
+
+    def get_track_length_in_millis(self):
+        return 0 if self._info is None else self._info.length_in_millis
+
+    def load_track_from_file(self, file_name, gain=0):
+        if file_name == self._current_file:
+            debug("file already loaded")
+            self._gain = 10 ** (gain / 20.0)
+            return
+
+        if not exists(file_name):
+            debug("no such file: " + file_name)
+            return False
+
+        try:
+            info = get_mp3_info(file_name)
+        except Exception as e:
+            debug("could not parse mp3 headers: " + str(e))
+            info = None
+
+        # not with the lock held, this might wait for the card
+        if self._cache is not None:
+            self._cache.check(file_name)
+
+        with span("pcm.load"):
+            with self._condition:
+                self._current_file = file_name
+                self._info = info
+                self._gain = 10 ** (gain / 20.0)
+                self._current_state = PCMPlayer.STATE_PAUSED
+                self._restart(0)
+                self._condition.notify_all()
+
+        return True
+
+    def _set_state(self, state):
+        with self._condition:
+            self._current_state = state
+            self._condition.notify_all()
+
+    def play_track(self):
+        if self._current_state == PCMPlayer.STATE_PLAYING:
+            debug("already playing")
+            return
+
+        if self._current_file is None:
+            debug("nothing loaded")
+            return
+
+        with self._condition:
+            if self._decoder_pending:
+                self._start_decoder()
+            self._play_requested = mtime()
+            self._current_state = PCMPlayer.STATE_PLAYING
+            self._condition.notify_all()
+
+    def pause_track(self):
+        if self._current_state == PCMPlayer.STATE_PAUSED:
+            debug("already paused")
+            return
+
+        if self._current_file is None:
+            debug("nothing loaded")
+            return
+
+        self._set_state(PCMPlayer.STATE_PAUSED)
+
+    def stop_track(self):
+        if self._current_state == PCMPlayer.STATE_STOPPED:
+            debug("already stopped")
+            return
+
+        with self._condition:
+            self._stop_decoder()
+            self._generation += 1
+            self._decoder_pending = False
+            self._ring.reset(0)
+            self._current_file = None
+            self._current_state = PCMPlayer.STATE_STOPPED
+            self._condition.notify_all()
+
+        # like mpg123, stopping counts as the end of the track
+        self._on_stop_callback()
+
+    def terminate(self):
+        debug("pcm player terminating...")
+        if self._current_state == PCMPlayer.STATE_TERMINATED:
+            debug("already terminated")
+            return
+
+        self._on_error_callback = None
+        self._stop_prefetching()
+
+        with self._condition:
+            self._stop_decoder()
+            self._generation += 1
+            self._current_state = PCMPlayer.STATE_TERMINATED
+            self._condition.notify_all()
+
+        debug("waiting for output thread.")
+        self._output_thread.join()
+        self._sink.close()
+        self._devnull.close()
+
+        debug(str(self.stats))
+        debug("ok, finished.")
+        return 0
+
+
+################################################################
+
+def main():
+    from SetupLogging import setup_stdout_logging
+    from sys import argv
+    setup_stdout_logging()
+
+    if len(argv) < 2:
+        debug("usage: PCMPlayer.py <mp3 file> [<wav file to write instead of playing>]")
+        exit(1)
+
+    player = PCMPlayer(lambda: debug("song stopped"), lambda: debug("error"), 50,
+                       sink=FileSink(argv[2]) if len(argv) > 2 else None)
+
+    if not player.load_track_from_file(argv[1]):
+        debug("file could not be loaded")
+        return
+
+    player.play_track()
+
+    debug("CTRL + C to interrupt")
+    try:
+        while player.is_track_playing():
+            sleep(.5)
+            debug("position: " + str(player.get_position_in_millis()) + " ms")
+    except:
+        pass
+
+    player.terminate()
+
+    debug("good bye")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,9 @@
 from serial import Serial
 from threading import Thread, Event
 from logging import getLogger
+from monotonic import monotonic as mtime
+
+from Tracing import span
 
 debug = getLogger('RFIDReader').debug
 
@@ -27,6 +30,10 @@ debug = getLogger('RFIDReader').debug
 #    |
 #    +--> 1 byte header is always 0x2
 
+# two hex digits -> value, anything else isn't in there
+_HEX_VALUES = dict([("%02X" % i, i) for i in range(256)] + [("%02x" % i, i) for i in range(256)])
+
+
 class RFIDReader(object):
     DEFAULT_BAUD_RATE = 9600
 
@@ -34,64 +41,167 @@ class RFIDReader(object):
 
     DEFAULT_TIMEOUT = 0.5
 
+    # a tag is only gone once there was no frame of it for that long, it may fade while a child wiggles it
+    DEFAULT_REMOVAL_GRACE = 1.0
+
     START_BYTE = "\x02"
 
     END_BYTE = "\x03"
 
-    def __init__(self, on_detection, port=DEFAULT_PORT, baud_rate=DEFAULT_BAUD_RATE, timeout=DEFAULT_TIMEOUT):
+    FRAME_LENGTH = 14
+
+    def __init__(self, on_detection, port=DEFAULT_PORT, baud_rate=DEFAULT_BAUD_RATE, timeout=DEFAULT_TIMEOUT,
+                 removal_grace=DEFAULT_REMOVAL_GRACE, reactor=None):
+        # reactor: the serial port is read by the Reactor whenever bytes arrived, instead of a thread of its own
         self._old_tag = ""
+        self._last_frame_time = 0
         self._stop_read_thread = Event()
 
+        # frames: complete frames, errors: frames with a broken checksum, resyncs: bytes skipped to find a frame,
+        # flaps: gaps in the frames of a tag that used to be reported as a removal but were within the grace period
+        self.stats = {"frames": 0, "errors": 0, "resyncs": 0, "bytes": 0, "flaps": 0}
+
+        self._timeout = timeout
+        self._removal_grace = removal_grace
+
         self._on_detection = on_detection
-        self._serial_conn = Serial(port, baud_rate, timeout=timeout)
+        self._reactor = reactor
+        self._read_rfid_thread = None
 
-        self._read_rfid_thread = Thread(target=self._read_rfid)
-        self._read_rfid_thread.daemon = True
-        self._read_rfid_thread.start()
+        if reactor is None:
+            self._serial_conn = Serial(port, baud_rate, timeout=timeout)
 
-    def _read_rfid(self):
+            self._read_rfid_thread = Thread(target=self._read_rfid)
+            self._read_rfid_thread.daemon = True
+            self._read_rfid_thread.start()
+        else:
+            # reads return whatever arrived without waiting
+            self._serial_conn = Serial(port, baud_rate, timeout=0)
+            self._buf = ""
+            self._removal_timer = None
+            reactor.add_reader(self._serial_conn, self._serial_readable)
 
+    def _read_rfid(self):
+        buf = ""
         while not self._stop_read_thread.isSet():
 
-            head = self._serial_conn.read()
-            if len(head) == 0 and self._old_tag != "":
+            # blocks for the first byte only, everything else that arrived comes with it
+            data = self._serial_conn.read(max(1, self._serial_conn.in_waiting))
+
+            if self._old_tag != "" and mtime() - self._last_frame_time > self._removal_grace:
+                debug("tag removed")
                 self._on_detection(None)
                 self._old_tag = ""
+                self._serial_conn.timeout = self._timeout
 
-            elif head == RFIDReader.START_BYTE:
+            if len(data) == 0:
+                # a partial frame followed by silence won't be completed anymore
+                self.stats["resyncs"] += len(buf)
+                buf = ""
+                continue
 
-                # actually the tag data is divided into 2 bytes version + 8 bytes tag + 2 bytes checksum
-                # I couldn't find out anything about the version differences, so I just ignored it.
-                tag = self._serial_conn.read(12)
+            self.stats["bytes"] += len(data)
+            buf = self._parse(buf + data)
 
-                tail = self._serial_conn.read()
-                if tail == RFIDReader.END_BYTE and self._old_tag != tag:
+    def _serial_readable(self):
+        # on the reactor, a partial frame that is never completed is dropped by the resync once the next one arrives
+        data = self._serial_conn.read(self._serial_conn.in_waiting)
+        if len(data) is 0:
+            return
+
+        self.stats["bytes"] += len(data)
+        self._buf = self._parse(self._buf + data)
+
+    def _check_removal(self):
+        # on the reactor: a single timer per grace period instead of one per frame, it's moved on lazily
+        self._removal_timer = None
+        if self._old_tag == "":
+            return
+
+        remaining = self._last_frame_time + self._removal_grace - mtime()
+        if remaining > 0:
+            self._removal_timer = self._reactor.call_later(remaining, self._check_removal)
+            return
 
-                    # the checksum is calculated by XORing the version and tag bytes
-                    calc_checksum = 0
-                    for i in range(0, 10, 2):
-                        calc_checksum ^= int(tag[i:i + 2], 16)
+        debug("tag removed")
+        self._on_detection(None)
+        self._old_tag = ""
 
-                    if calc_checksum == int(tag[10:12], 16):
+    def _parse(self, buf):
+        # handles all complete frames in buf and returns what's left of it
+        while True:
+            start = buf.find(RFIDReader.START_BYTE)
+            if start == -1:
+                self.stats["resyncs"] += len(buf)
+                return ""
+
+            if start is not 0:
+                self.stats["resyncs"] += start
+                buf = buf[start:]
+
+            if len(buf) < RFIDReader.FRAME_LENGTH:
+                return buf
+
+            if buf[RFIDReader.FRAME_LENGTH - 1] != RFIDReader.END_BYTE:
+                # that start byte was noise, go on searching after it
+                self.stats["resyncs"] += 1
+                buf = buf[1:]
+                continue
+
+            # actually the tag data is divided into 2 bytes version + 8 bytes tag + 2 bytes checksum
+            # I couldn't find out anything about the version differences, so I just ignored it.
+            tag = buf[1:RFIDReader.FRAME_LENGTH - 1]
+            buf = buf[RFIDReader.FRAME_LENGTH:]
+            self.stats["frames"] += 1
+
+            # the reader repeats the frame as long as the tag is there
+            if tag != self._old_tag:
+                with span("rfid.frame"):
+                    self._decode_frame(tag)
+            else:
+                now = mtime()
+                if now - self._last_frame_time > self._timeout:
+                    debug("tag was gone for " + str(int((now - self._last_frame_time) * 1000)) + " ms, ignored")
+                    self.stats["flaps"] += 1
+                self._last_frame_time = now
+
+    def _decode_frame(self, tag):
+        # the checksum is calculated by XORing the version and tag bytes
+        values = [_HEX_VALUES.get(tag[i:i + 2]) for i in range(0, 12, 2)]
+        if None in values or values[0] ^ values[1] ^ values[2] ^ values[3] ^ values[4] != values[5]:
+            self.stats["errors"] += 1
+            return
 
-                        # make sure, on_detection is always called alternating (tag, None, tag, None, tag, ...
-                        if self._old_tag != "":
-                            self._on_detection(None)
+        # make sure, on_detection is always called alternating (tag, None, tag, None, tag, ...
+        if self._old_tag != "":
+            self._on_detection(None)
 
-                        self._on_detection(tag)
-                        self._old_tag = tag
+        self._on_detection(tag)
+        self._old_tag = tag
+        self._last_frame_time = mtime()
+
+        if self._reactor is None:
+            # the next read returns empty once the grace period is over
+            self._serial_conn.timeout = self._removal_grace
+        elif self._removal_timer is None:
+            self._removal_timer = self._reactor.call_later(self._removal_grace, self._check_removal)
 
     def terminate(self):
         debug("rfid terminating.")
-        if self._read_rfid_thread is None:
+        if self._stop_read_thread.isSet():
             debug("already terminated")
             return
 
         self._stop_read_thread.set()
-        self._read_rfid_thread.join()
+        if self._reactor is None:
+            self._read_rfid_thread.join()
+            self._read_rfid_thread = None
+        else:
+            self._reactor.remove_reader(self._serial_conn)
+            if self._removal_timer is not None:
+                self._removal_timer.cancel()
 
         self._serial_conn.close()
-        self._read_rfid_thread = None
 
 
 ################################################################
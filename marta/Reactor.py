@@ -0,0 +1,263 @@
+import select
+import signal
+from os import pipe, read, write, close, O_NONBLOCK
+from fcntl import fcntl, F_GETFL, F_SETFL
+from errno import EAGAIN, EINTR
+from heapq import heappush, heappop
+from itertools import count
+from collections import deque
+from threading import Thread, current_thread
+from math import ceil
+from logging import getLogger
+from monotonic import monotonic as mtime
+import traceback
+
+debug = getLogger('   Reactor').debug
+
+
+class _Timer(object):
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        # may be called from any thread, the reactor skips the timer when it's due
+        self.cancelled = True
+
+
+def _set_non_blocking(fd):
+    fcntl(fd, F_SETFL, fcntl(fd, F_GETFL) | O_NONBLOCK)
+
+
+class Reactor(object):
+    # A single thread waits for all file descriptors and timers at once and runs their callbacks one after another.
+    # Nothing polls: with nothing to do, the thread sleeps in poll() until a descriptor becomes readable or the next
+    # timer is due. Callbacks must never block, they run on the reactor thread and everyone else waits for them.
+    #
+    # add_reader, remove_reader and call_later may be called from any thread, other threads hand over everything
+    # else with call_soon_threadsafe.
+
+    def __init__(self):
+        self._poll = select.poll()
+
+        # fd -> callback
+        self._readers = {}
+
+        # heap of (when, sequence, _Timer), the sequence keeps timers due at the same time in order
+        self._timers = []
+        self._sequence = count()
+
+        # (callback, args) handed over by other threads, deque.append is atomic
+        self._calls = deque()
+
+        # writing a byte wakes the reactor up
+        self._wakeup_read, self._wakeup_write = pipe()
+        _set_non_blocking(self._wakeup_read)
+        _set_non_blocking(self._wakeup_write)
+        self._poll.register(self._wakeup_read, select.POLLIN)
+
+        self._running = False
+        self._thread = None
+
+        # called on the reactor thread after a signal arrived, see wake_on_signals
+        self._on_signal = None
+
+        # wakeups: returns from poll(), reads: reader callbacks, timers: timer callbacks, calls: handed over calls
+        self.stats = {"wakeups": 0, "reads": 0, "timers": 0, "calls": 0}
+
+    def start(self):
+        self._running = True
+        self._thread = Thread(target=self.run, name="reactor")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _in_reactor(self):
+        return current_thread() is self._thread
+
+    @staticmethod
+    def _fileno(f):
+        return f if isinstance(f, (int, long)) else f.fileno()
+
+    def add_reader(self, f, callback):
+        # callback() is called whenever f (a file descriptor or anything with fileno()) is readable or closed
+        if not self._in_reactor():
+            self.call_soon_threadsafe(self.add_reader, f, callback)
+            return
+
+        fd = Reactor._fileno(f)
+        self._readers[fd] = callback
+        self._poll.register(fd, select.POLLIN | select.POLLPRI)
+
+    def remove_reader(self, f):
+        if not self._in_reactor():
+            self.call_soon_threadsafe(self.remove_reader, f)
+            return
+
+        fd = Reactor._fileno(f)
+        if self._readers.pop(fd, None) is not None:
+            self._poll.unregister(fd)
+
+    def call_later(self, delay, callback, *args):
+        # returns a timer that can be cancelled
+        timer = _Timer(mtime() + delay, callback, args)
+        if self._in_reactor():
+            heappush(self._timers, (timer.when, next(self._sequence), timer))
+        else:
+            self.call_soon_threadsafe(self._add_timer, timer)
+        return timer
+
+    def _add_timer(self, timer):
+        heappush(self._timers, (timer.when, next(self._sequence), timer))
+
+    def call_soon_threadsafe(self, callback, *args):
+        self._calls.append((callback, args))
+        self._wake_up()
+
+    def _wake_up(self):
+        try:
+            write(self._wakeup_write, "x")
+        except OSError as e:
+            # the pipe is full, the reactor will wake up either way
+            if e.errno != EAGAIN:
+                raise
+
+    def wake_on_signals(self, callback):
+        # Python runs signal handlers in the main thread only, and python 2 can't interrupt it while it waits for a
+        # lock. The signal's C handler writes a zero byte to the wakeup pipe, callback() should then wake the main
+        # thread up, e.g. with a message. Has to be called from the main thread.
+        self._on_signal = callback
+        signal.set_wakeup_fd(self._wakeup_write)
+
+    def _drain_wakeups(self):
+        signalled = False
+        try:
+            while True:
+                data = read(self._wakeup_read, 4096)
+                if len(data) is 0:
+                    break
+                signalled = signalled or "\0" in data
+        except OSError as e:
+            if e.errno != EAGAIN:
+                raise
+
+        if signalled and self._on_signal is not None:
+            Reactor._run(self._on_signal, ())
+
+    def _timeout(self):
+        # in millis for poll(), None waits forever
+        if len(self._calls) is not 0:
+            return 0
+
+        while len(self._timers) is not 0 and self._timers[0][2].cancelled:
+            heappop(self._timers)
+
+        if len(self._timers) is 0:
+            return None
+
+        # rounded up, poll() waking up a little early would just cost another wakeup
+        return max(0, int(ceil((self._timers[0][0] - mtime()) * 1000)))
+
+    @staticmethod
+    def _run(callback, args):
+        # a failing callback must not take the reactor and everything on it down
+        try:
+            callback(*args)
+        except Exception:
+            debug("callback failed: %s", traceback.format_exc())
+
+    def run(self):
+        debug("running")
+        while self._running:
+            try:
+                events = self._poll.poll(self._timeout())
+            except select.error as e:
+                if e.args[0] != EINTR:
+                    raise
+                continue
+
+            self.stats["wakeups"] += 1
+
+            for fd, event in events:
+                if fd == self._wakeup_read:
+                    self._drain_wakeups()
+                    continue
+
+                callback = self._readers.get(fd)
+                if callback is not None:
+                    self.stats["reads"] += 1
+                    Reactor._run(callback, ())
+
+            # calls handed over while these run come next time around, without waiting
+            for i in range(len(self._calls)):
+                callback, args = self._calls.popleft()
+                self.stats["calls"] += 1
+                Reactor._run(callback, args)
+
+            now = mtime()
+            while len(self._timers) is not 0 and self._timers[0][0] <= now:
+                timer = heappop(self._timers)[2]
+                if not timer.cancelled:
+                    self.stats["timers"] += 1
+                    Reactor._run(timer.callback, timer.args)
+
+        debug("stopped")
+
+    def _stop(self):
+        self._running = False
+
+    def stop(self):
+        debug("stopping")
+        if self._thread is None:
+            return
+
+        self.call_soon_threadsafe(self._stop)
+        self._thread.join()
+        self._thread = None
+
+        if self._on_signal is not None:
+            self._on_signal = None
+            try:
+                signal.set_wakeup_fd(-1)
+            except ValueError:
+                debug("signals still wake up the closed pipe, not in the main thread")
+
+        close(self._wakeup_read)
+        close(self._wakeup_write)
+
+
+################################################################
+
+def main():
+    from SetupLogging import setup_stdout_logging
+    from sys import stdin
+    from threading import Event
+    setup_stdout_logging()
+
+    reactor = Reactor()
+    reactor.start()
+    done = Event()
+
+    def tick(n):
+        debug("tick %d", n)
+        reactor.call_later(1, tick, n + 1)
+
+    def line_entered():
+        line = stdin.readline()
+        if line.strip() == "":
+            done.set()
+            return
+        debug("entered: %s", line.strip())
+
+    debug("type something, ENTER on an empty line to quit")
+    reactor.call_later(1, tick, 1)
+    reactor.add_reader(stdin, line_entered)
+
+    done.wait()
+    reactor.stop()
+    debug(str(reactor.stats))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+from logging import Handler, getLogger
+from collections import deque
+from itertools import count
+from threading import Thread, Lock
+from os import pipe, write, close
+from select import select
+from time import time
+
+debug = getLogger('   RingLog').debug
+
+
+class RingHandler(Handler):
+    # Logging from any thread only appends the record to two deques: no lock, no formatting, no I/O. A background
+    # thread formats what came in since the last time and hands it to the target handler's file in a single write,
+    # at most once per flush_interval. Log calls should pass their arguments lazily, debug("x: %s", x), so nothing is
+    # formatted unless the level is enabled, and then only by the flusher. The arguments are formatted later on, so
+    # they must not be changed after the call.
+    #
+    # The ring keeps the latest records for dump(), no matter whether they were written already.
+
+    FLUSH_INTERVAL = 2
+
+    # records waiting for the flusher, if the card stalls for long the oldest are dropped
+    MAX_PENDING = 10000
+
+    RING_SIZE = 4096
+
+    def __init__(self, target, flush_interval=FLUSH_INTERVAL, max_pending=MAX_PENDING, ring_size=RING_SIZE):
+        Handler.__init__(self)
+        self._target = target
+        self._flush_interval = flush_interval
+
+        self._pending = deque(maxlen=max_pending)
+        self._ring = deque(maxlen=ring_size)
+
+        self.stats = {"records": 0, "dropped": 0, "writes": 0, "bytes": 0}
+
+        self._start()
+
+    def _start(self):
+        self._sequence = count()
+        self._next_sequence = 0
+
+        # only ever taken by flushing threads
+        self._flush_lock = Lock()
+
+        # the flusher sleeps in select() until the interval passed or close() writes to the pipe, python 2's timed
+        # waits would poll the clock 20 times a second
+        self._stopped = False
+        self._stop_read, self._stop_write = pipe()
+        self._flusher_thread = Thread(target=self._flush_loop)
+        self._flusher_thread.daemon = True
+        self._flusher_thread.start()
+
+    def after_fork(self):
+        # in a forked child: the flusher thread is gone and the parent writes its own records
+        self._pending.clear()
+        self._ring.clear()
+        self._start()
+
+    def handle(self, record):
+        # Handler.handle would take the handler's lock
+        if self.filter(record):
+            self.emit(record)
+        return record
+
+    def emit(self, record):
+        # deque.append and count.next are atomic
+        record.ring_sequence = next(self._sequence)
+        self._pending.append(record)
+        self._ring.append(record)
+
+    def _flush_loop(self):
+        while len(select([self._stop_read], [], [], self._flush_interval)[0]) is 0:
+            self.flush()
+
+    def _format(self, record):
+        try:
+            return self._target.format(record) + "\n"
+        except Exception as e:
+            return "unformattable log record " + repr(record.msg) + ": " + str(e) + "\n"
+
+    def flush(self):
+        with self._flush_lock:
+            self._flush()
+
+    def _flush(self):
+        lines = []
+        while True:
+            try:
+                record = self._pending.popleft()
+            except IndexError:
+                break
+
+            if record.ring_sequence != self._next_sequence:
+                dropped = record.ring_sequence - self._next_sequence
+                self.stats["dropped"] += dropped
+                lines.append("... " + str(dropped) + " log messages dropped\n")
+            self._next_sequence = record.ring_sequence + 1
+
+            lines.append(self._format(record))
+            self.stats["records"] += 1
+
+        if len(lines) is 0:
+            return
+
+        data = "".join(lines)
+        self.stats["writes"] += 1
+        self.stats["bytes"] += len(data)
+
+        self._target.acquire()
+        try:
+            self._write(data)
+        except (IOError, OSError):
+            self._target.handleError(record)
+        finally:
+            self._target.release()
+
+    def _write(self, data):
+        target = self._target
+        if target.stream is None:
+            target.stream = target._open()
+
+        # a file exceeds maxBytes by one batch at most
+        if getattr(target, "maxBytes", 0) > 0 and target.stream.tell() + len(data) >= target.maxBytes:
+            target.doRollover()
+
+        target.stream.write(data)
+        target.stream.flush()
+
+    def _latest_records(self):
+        # other threads might log while the ring is copied
+        for attempt in range(10):
+            try:
+                return list(self._ring)
+            except RuntimeError:
+                pass
+        return []
+
+    def dump(self, path, seconds):
+        # writes the records of the last seconds to path, e.g. after a crash
+        since = time() - seconds
+        records = [record for record in self._latest_records() if record.created >= since]
+        debug("dumping " + str(len(records)) + " log messages to " + path)
+
+        try:
+            with open(path, 'w') as dump_file:
+                dump_file.write("".join(self._format(record) for record in records))
+        except (IOError, OSError) as e:
+            debug("could not dump the log: " + str(e))
+
+    def close(self):
+        if not self._stopped:
+            self._stopped = True
+            write(self._stop_write, "x")
+            self._flusher_thread.join()
+            close(self._stop_read)
+            close(self._stop_write)
+            self.flush()
+            self._target.close()
+        Handler.close(self)
+
+
+################################################################
+
+def main():
+    from logging import DEBUG, Formatter, StreamHandler
+    from monotonic import monotonic as mtime
+    from SetupLogging import setup_stdout_logging
+
+    logger = getLogger('')
+    logger.setLevel(DEBUG)
+
+    target = StreamHandler()
+    target.setFormatter(Formatter("%(asctime)s.%(msecs)03d | %(name)s |    %(message)s", "%H:%M:%S"))
+    ring = RingHandler(target, flush_interval=0.5)
+    logger.addHandler(ring)
+
+    start = mtime()
+    for i in range(10000):
+        debug("message %d of %d", i, 10000)
+    seconds = mtime() - start
+
+    logger.removeHandler(ring)
+    ring.close()
+
+    # the ring is gone, the result is logged right away
+    setup_stdout_logging()
+    debug(str(int(10000 / seconds)) + " messages/s, " + str(ring.stats))
+
+
+if __name__ == "__main__":
+    main()
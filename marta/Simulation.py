@@ -0,0 +1,111 @@
+from os import environ, makedirs, pathsep
+from os.path import dirname, abspath, join
+from shutil import copy
+from sys import path
+from tempfile import mkdtemp
+from time import sleep
+from logging import getLogger
+
+debug = getLogger('Simulation').debug
+
+# The sim directory contains stand-ins for RPi.GPIO, _rpi_ws281x, smbus, serial and the mpg123 binary.
+# After setup() they shadow the real ones, so the whole device runs on any machine.
+SIM_DIR = join(dirname(abspath(__file__)), "sim")
+
+REPOSITORY_DIR = dirname(dirname(abspath(__file__)))
+
+# version + tag bytes, the checksum is appended by make_tag
+_LIBRARY_TAG_DATA = ["0A0B0C0D0E", "1A1B1C1D1E", "2A2B2C2D2E"]
+
+
+def make_tag(data):
+    checksum = 0
+    for i in range(0, 10, 2):
+        checksum ^= int(data[i:i + 2], 16)
+    return data + "%02X" % checksum
+
+
+LIBRARY_TAGS = [make_tag(data) for data in _LIBRARY_TAG_DATA]
+
+
+def _build_library(marta_dir):
+    system_dir = join(REPOSITORY_DIR, "audio", "system")
+    startup = join(system_dir, "startup.mp3")
+    shutdown = join(system_dir, "shutdown.mp3")
+
+    layout = {
+        # an audiobook with a few chapters
+        "audiobook " + LIBRARY_TAGS[0]: {"": [startup, shutdown, startup]},
+        # two albums
+        "albums " + LIBRARY_TAGS[1]: {"first": [shutdown, startup], "second": [startup, shutdown]},
+        # a single song
+        "single " + LIBRARY_TAGS[2]: {"": [shutdown]},
+    }
+
+    makedirs(join(marta_dir, "audio", "system"))
+    copy(startup, join(marta_dir, "audio", "system"))
+    copy(shutdown, join(marta_dir, "audio", "system"))
+
+    for tag_dir, albums in layout.items():
+        for album, songs in albums.items():
+            album_dir = join(marta_dir, "audio", tag_dir, album)
+            makedirs(album_dir)
+            for i, song in enumerate(songs):
+                copy(song, join(album_dir, "track_" + str(i) + ".mp3"))
+
+
+def setup(marta_dir=None):
+    # Has to be called before any of the hardware modules are imported.
+    path.insert(0, SIM_DIR)
+    environ["PATH"] = SIM_DIR + pathsep + environ.get("PATH", "")
+
+    if marta_dir is None:
+        marta_dir = mkdtemp(prefix="marta_sim_")
+        _build_library(marta_dir)
+        makedirs(join(marta_dir, "logs"))
+        makedirs(join(marta_dir, "cache"))
+
+    environ["MARTA"] = marta_dir
+    debug("simulating in " + marta_dir)
+    return marta_dir
+
+
+################################################################
+# interacting with the simulated device
+
+def push_button(pin, millis=100):
+    import RPi.GPIO as GPIO
+    GPIO.set_level(pin, GPIO.LOW)
+    sleep(millis / 1000.0)
+    GPIO.set_level(pin, GPIO.HIGH)
+
+
+def present_tag(tag):
+    import serial
+    serial.present_tag(tag)
+
+
+def remove_tag():
+    import serial
+    serial.remove_tag()
+
+
+def tilt(x, y):
+    import smbus
+    if smbus.set_tilt(x, y):
+        import Buttons
+        import RPi.GPIO as GPIO
+        GPIO.set_level(Buttons.MPU_INTERRUPT, GPIO.HIGH)
+        GPIO.set_level(Buttons.MPU_INTERRUPT, GPIO.LOW)
+
+
+def hardware_stats():
+    import _rpi_ws281x
+    import serial
+    import smbus
+
+    stats = {}
+    for name, module in [("leds", _rpi_ws281x), ("serial", serial), ("i2c", smbus)]:
+        for key, value in module.stats.items():
+            stats[name + "." + key] = value
+    return stats
@@ -0,0 +1,237 @@
+from os import fsync, makedirs, rename, open as open_fd, close, O_RDONLY
+from os.path import exists, isdir, join
+from threading import Thread, Condition, Lock
+from zlib import crc32
+from logging import getLogger
+from monotonic import monotonic as mtime
+
+from Tracing import span
+
+debug = getLogger('StateStore').debug
+
+
+#  State files
+#
+#  state.snapshot: the complete state as of the last compaction, only ever replaced by a rename
+#  state.journal: every change since then, appended
+#
+# Both hold one record per line: <crc32 of the rest, 8 hex digits> <key>\t<value>
+#
+# A record that didn't make it to the card completely fails its checksum. It is dropped together with everything
+# after it, so after a power loss the state is what it was at some point in time, never a mix.
+
+class StateStore(object):
+    SNAPSHOT_FILE = "state.snapshot"
+    JOURNAL_FILE = "state.journal"
+
+    # changes are collected for that long and then written in one go
+    FLUSH_DELAY = 2
+
+    # the journal is folded into a new snapshot once it is that long
+    MAX_JOURNAL_RECORDS = 256
+
+    def __init__(self, state_dir, flush_delay=FLUSH_DELAY):
+        if not isdir(state_dir):
+            makedirs(state_dir)
+
+        self._state_dir = state_dir
+        self._snapshot_path = join(state_dir, StateStore.SNAPSHOT_FILE)
+        self._journal_path = join(state_dir, StateStore.JOURNAL_FILE)
+        self._flush_delay = flush_delay
+
+        self._condition = Condition()
+        self._write_lock = Lock()
+        self._state = {}
+        self._pending = []
+        self._journal_records = 0
+        self._terminated = False
+
+        self.stats = {"changes": 0, "flushes": 0, "compactions": 0}
+
+        with span("state.recover"):
+            self._recover()
+
+        self._writer_thread = Thread(target=self._write_behind)
+        self._writer_thread.daemon = True
+        self._writer_thread.start()
+
+    @staticmethod
+    def _record(key, value):
+        body = key + "\t" + value
+        return "%08x %s\n" % (crc32(body) & 0xffffffff, body)
+
+    @staticmethod
+    def _read_records(path):
+        records = []
+        if not exists(path):
+            return records, True
+
+        with open(path, 'rb') as state_file:
+            for line in state_file:
+                if not line.endswith("\n") or len(line) < 10:
+                    return records, False
+
+                body = line[9:-1]
+                try:
+                    valid = int(line[:8], 16) == crc32(body) & 0xffffffff
+                except ValueError:
+                    valid = False
+
+                if not valid or "\t" not in body:
+                    return records, False
+
+                records.append(body.split("\t", 1))
+
+        return records, True
+
+    def _recover(self):
+        snapshot, snapshot_complete = StateStore._read_records(self._snapshot_path)
+        if not snapshot_complete:
+            debug("snapshot is broken, recovered " + str(len(snapshot)) + " records of it")
+
+        journal, journal_complete = StateStore._read_records(self._journal_path)
+        if not journal_complete:
+            debug("dropping the torn end of the journal after " + str(len(journal)) + " records")
+
+        for key, value in snapshot + journal:
+            self._state[key] = value
+
+        debug(str(len(self._state)) + " keys, " + str(len(journal)) + " journal records")
+
+        # start over with a clean snapshot and an empty journal
+        if len(journal) is not 0 or not journal_complete or not snapshot_complete:
+            self._compact()
+
+    def keys(self):
+        with self._condition:
+            return self._state.keys()
+
+    def get(self, key, default=None):
+        with self._condition:
+            return self._state.get(key, default)
+
+    def set(self, key, value):
+        # the change is visible right away and written behind
+        value = str(value)
+        with self._condition:
+            if self._state.get(key) == value:
+                return
+
+            self._state[key] = value
+            self._pending.append(StateStore._record(key, value))
+            self.stats["changes"] += 1
+
+            # only the first change of a batch wakes the writer, the others wouldn't shorten its delay anyway
+            if len(self._pending) is 1:
+                self._condition.notify()
+
+    def _write_behind(self):
+        while True:
+            with self._condition:
+                while len(self._pending) is 0 and not self._terminated:
+                    self._condition.wait()
+
+                if self._terminated:
+                    return
+
+                # give the changes that usually follow a chance to make it into the same write
+                deadline = mtime() + self._flush_delay
+                while not self._terminated:
+                    remaining = deadline - mtime()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+
+                if self._terminated:
+                    return
+
+            self.flush()
+
+    def flush(self):
+        with self._write_lock:
+            with self._condition:
+                records = self._pending
+                self._pending = []
+
+            if len(records) is 0:
+                return
+
+            with span("state.flush"):
+                try:
+                    with open(self._journal_path, 'ab') as journal_file:
+                        journal_file.write("".join(records))
+                        journal_file.flush()
+                        fsync(journal_file.fileno())
+                except (IOError, OSError) as e:
+                    debug("could not write the journal: " + str(e))
+                    return
+
+            self.stats["flushes"] += 1
+            self._journal_records += len(records)
+
+            if self._journal_records >= StateStore.MAX_JOURNAL_RECORDS:
+                self._compact()
+
+    def _compact(self):
+        debug("compacting")
+        with self._condition:
+            records = [StateStore._record(key, value) for key, value in sorted(self._state.items())]
+
+        # A crash before the rename keeps the old snapshot and journal, one after it replays a journal that only
+        # repeats what is in the snapshot already. The journal is only emptied once the directory is synced, before
+        # that the card might still hold the old snapshot after a power loss.
+        tmp_path = self._snapshot_path + ".tmp"
+        try:
+            with open(tmp_path, 'wb') as snapshot_file:
+                snapshot_file.write("".join(records))
+                snapshot_file.flush()
+                fsync(snapshot_file.fileno())
+            rename(tmp_path, self._snapshot_path)
+            self._sync_dir()
+
+            open(self._journal_path, 'wb').close()
+        except (IOError, OSError) as e:
+            debug("could not compact: " + str(e))
+            return
+
+        self._journal_records = 0
+        self.stats["compactions"] += 1
+
+    def _sync_dir(self):
+        # makes the rename durable
+        fd = open_fd(self._state_dir, O_RDONLY)
+        try:
+            fsync(fd)
+        finally:
+            close(fd)
+
+    def terminate(self):
+        debug("terminating")
+        with self._condition:
+            self._terminated = True
+            self._condition.notify()
+
+        self._writer_thread.join()
+        self.flush()
+
+
+################################################################
+
+def main():
+    from SetupLogging import setup_stdout_logging
+    from sys import argv
+
+    setup_stdout_logging()
+
+    if len(argv) is not 2:
+        debug("usage: StateStore.py <state dir>")
+        exit(1)
+
+    store = StateStore(argv[1])
+    for key in sorted(store.keys()):
+        debug(key + " = " + store.get(key))
+    store.terminate()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,55 +1,163 @@
-from os import listdir
-from os.path import isdir
+from os import listdir, stat, rename, fsync
+from os.path import isdir, exists
 from logging import getLogger
 from re import compile, match
+from cPickle import load, dump, HIGHEST_PROTOCOL
 from Util import sorted_aphanumeric
+from Tracing import span
 
 TAG_TO_DIR = {}
 
+# album directory -> sorted song file names (without the state and indicator files)
+ALBUM_TO_SONGS = {}
+
 debug = getLogger('  TagToDir').debug
 
 ALBUM_INDICATOR_FILE = ".albumindicator"
+SONG_STATE_FILE = ".songstate"
 
+_NO_SONG_FILES = [ALBUM_INDICATOR_FILE, SONG_STATE_FILE]
 
-def prepare_albums(tag_path):
-    possible_albums = sorted_aphanumeric(listdir(tag_path))
-    if len(possible_albums) is 0:
-        raise Exception("empty tag directory: " + tag_path)
+# tag directories end with the 12 hex digits of their tag
+TAG_DIR_REGEX = compile("^.*([0-9A-F]{12})$")
 
-    albums = []
+# Bump this whenever the structure of the index changes, old indices will be dropped and rebuilt.
+_INDEX_VERSION = 1
+
+
+#  Library index structure
+#
+#  {
+#    "version": _INDEX_VERSION,
+#    "mtime": <mtime of the audio dir>,
+#    "dirs": [<all tag dirs>],
+#    "tags": {
+#      <tag dir>: {
+#        "mtime": <mtime of the tag dir>,
+#        "dirs": [<album dirs, sorted>],
+#        "songs": [<song files, sorted, only if there are no album dirs>],
+#        "albums": {
+#          <album dir>: {"mtime": <mtime of the album dir>, "indicator": <bool>, "songs": [<song files, sorted>]}
+#        }
+#      }
+#    }
+#  }
+#
+# A directory's mtime changes whenever an entry is added, removed or renamed, so directories with an unchanged
+# mtime are taken from the index without listing them again.
+
+def _mtime(path):
+    return stat(path).st_mtime
+
+
+def _songs(files):
+    return sorted_aphanumeric([f for f in files if f not in _NO_SONG_FILES])
+
+
+def _load_index(index_path):
+    if index_path is None or not exists(index_path):
+        return None
+
+    try:
+        with open(index_path, 'rb') as index_file:
+            index = load(index_file)
+    except Exception as e:
+        debug("ignoring broken library index: " + str(e))
+        return None
+
+    if not isinstance(index, dict) or index.get("version") != _INDEX_VERSION:
+        debug("ignoring library index of unknown version")
+        return None
+
+    return index
+
+
+def _save_index(index_path, index):
+    # write and rename, so a power loss never leaves a torn index behind
+    tmp_path = index_path + ".tmp"
+    try:
+        with open(tmp_path, 'wb') as index_file:
+            dump(index, index_file, HIGHEST_PROTOCOL)
+            index_file.flush()
+            fsync(index_file.fileno())
+        rename(tmp_path, index_path)
+    except (IOError, OSError) as e:
+        debug("could not save library index: " + str(e))
+
+
+def _scan_album(album_path, cached):
+    mtime = _mtime(album_path)
+    if cached is not None and cached["mtime"] == mtime:
+        return cached
+
+    debug("scanning " + album_path)
+    files = listdir(album_path)
+    if len(files) is 0:
+        raise Exception("empty album directory: " + album_path)
 
+    return {"mtime": mtime, "indicator": ALBUM_INDICATOR_FILE in files, "songs": _songs(files)}
+
+
+def prepare_albums(tag_path, cached=None):
+    mtime = _mtime(tag_path)
+
+    if cached is not None and cached["mtime"] == mtime:
+        album_dirs = cached["dirs"]
+        songs = cached["songs"]
+    else:
+        debug("scanning " + tag_path)
+        possible_albums = sorted_aphanumeric(listdir(tag_path))
+        if len(possible_albums) is 0:
+            raise Exception("empty tag directory: " + tag_path)
+
+        album_dirs = []
+        files = []
+        for album_dir in possible_albums:
+            if isdir(tag_path + "/" + album_dir):
+                album_dirs.append(album_dir)
+            else:
+                files.append(album_dir)
+
+        if len(album_dirs) is not 0 and len(files) is not 0:
+            raise Exception("directory and files mixed: " + tag_path)
+
+        songs = _songs(files)
+
+    cached_albums = {} if cached is None else cached["albums"]
+    entry = {"mtime": mtime, "dirs": album_dirs, "songs": songs, "albums": {}}
+
+    if len(album_dirs) is 0:
+        ALBUM_TO_SONGS[tag_path] = songs
+        return [tag_path], entry
+
+    albums = []
     current_album_dir = None
-    at_least_one_file = False
-    for album_dir in possible_albums:
+    for album_dir in album_dirs:
         current = tag_path + "/" + album_dir
 
-        if isdir(current):
-            files = listdir(current)
-            if len(files) is 0:
-                raise Exception("empty album directory: " + current)
+        album = _scan_album(current, cached_albums.get(album_dir))
+        entry["albums"][album_dir] = album
+        ALBUM_TO_SONGS[current] = album["songs"]
 
-            if ALBUM_INDICATOR_FILE in files:
-                current_album_dir = current
+        if album["indicator"]:
+            current_album_dir = current
 
-            albums.append(current)
-
-        else:
-            at_least_one_file = True
+        albums.append(current)
 
     # we have to shift and cannot simply insert in place at index 0 because that doesn't rotate the other entries
     if current_album_dir is not None:
         i = albums.index(current_album_dir)
         albums = albums[i:] + albums[:i]
 
-    if len(albums) is 0:
-        albums.append(tag_path)
-    elif at_least_one_file:
-        raise Exception("directory and files mixed: " + tag_path)
+    return albums, entry
+
 
-    return albums
+def prepare(audio_path, index_path=None):
+    with span("library.prepare"):
+        _prepare(audio_path, index_path)
 
 
-def prepare(audio_path):
+def _prepare(audio_path, index_path):
     if not isdir(audio_path):
         debug("not a directory: " + audio_path)
         exit(1)
@@ -57,33 +165,44 @@ def prepare(audio_path):
     if not isdir(audio_path + "/system"):
         raise Exception("missing directory: " + audio_path + "/system")
 
-    dirs = listdir(audio_path)
+    debug(audio_path + "/system exists")
 
-    regex = compile("^.*([0-9A-F]{12})$")
+    old_index = _load_index(index_path)
+    old_tags = {} if old_index is None else old_index["tags"]
 
-    debug(audio_path + "/system exists")
+    mtime = _mtime(audio_path)
+    if old_index is not None and old_index["mtime"] == mtime:
+        dirs = old_index["dirs"]
+    else:
+        dirs = listdir(audio_path)
+
+    index = {"version": _INDEX_VERSION, "mtime": mtime, "dirs": dirs, "tags": {}}
 
     for d in dirs:
 
         current = audio_path + "/" + d
 
-        if not isdir(audio_path + "/" + d):
-            raise Exception("not a directory: " + current)
-
         if d == "system":
             continue
 
-        if not match(regex, d):
+        if d not in old_tags and not isdir(current):
+            raise Exception("not a directory: " + current)
+
+        if not match(TAG_DIR_REGEX, d):
             raise Exception("naming convention error: " + current)
 
         tag = d[-12:]
 
         if tag in TAG_TO_DIR:
-            raise Exception("tag found twice: " + d + ", " + TAG_TO_DIR[tag])
+            raise Exception("tag found twice: " + d + ", " + str(TAG_TO_DIR[tag]))
 
-        TAG_TO_DIR[tag] = prepare_albums(current)
+        TAG_TO_DIR[tag], index["tags"][d] = prepare_albums(current, old_tags.get(d))
         debug(tag + "=" + str(TAG_TO_DIR[tag]))
 
+    if index_path is not None and index != old_index:
+        debug("saving library index")
+        _save_index(index_path, index)
+
 
 if __name__ == "__main__":
     from SetupLogging import setup_stdout_logging
@@ -0,0 +1,45 @@
+from bisect import bisect_left
+from math import atan2, degrees, sqrt
+
+
+def _dist(a, b):
+    return sqrt((a * a) + (b * b))
+
+
+def accel_rotation(ax, ay, az):
+    # (x rotation, y rotation) in degrees, from the direction of gravity alone
+    return degrees(atan2(ay, _dist(ax, az))), -degrees(atan2(ax, _dist(ay, az)))
+
+
+def zone(value, limits, current=None, hysteresis=0):
+    # Index of the zone value is in, limits are sorted. The current zone is only left hysteresis degrees beyond its
+    # limits, so a value jittering around a limit doesn't switch back and forth.
+    if current is not None:
+        low = limits[current - 1] - hysteresis if current > 0 else None
+        high = limits[current] + hysteresis if current < len(limits) else None
+        if (low is None or value >= low) and (high is None or value <= high):
+            return current
+
+    return bisect_left(limits, value)
+
+
+class TiltFilter(object):
+    # Complementary filter: the gyro follows fast movements, the accelerometer slowly pulls out the gyro's drift and
+    # the linear accelerations of the device. Every sample costs the same, no matter how many came before.
+
+    def __init__(self, time_constant=0.25):
+        self._time_constant = time_constant
+        self.x = None
+        self.y = None
+
+    def update(self, ax, ay, az, gx, gy, dt):
+        accel_x, accel_y = accel_rotation(ax, ay, az)
+
+        if self.x is None:
+            self.x, self.y = accel_x, accel_y
+            return self.x, self.y
+
+        alpha = self._time_constant / (self._time_constant + dt)
+        self.x = alpha * (self.x + gx * dt) + (1 - alpha) * accel_x
+        self.y = alpha * (self.y + gy * dt) + (1 - alpha) * accel_y
+        return self.x, self.y
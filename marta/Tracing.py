@@ -0,0 +1,104 @@
+from collections import deque
+from logging import getLogger
+from monotonic import monotonic as mtime
+
+debug = getLogger('   Tracing').debug
+
+# only the latest samples per name are kept for the percentiles
+_MAX_SAMPLES = 1024
+
+_enabled = False
+
+# name -> [count, max, deque of latest durations]
+_stats = {}
+
+
+class _Span(object):
+    def __init__(self, name):
+        self._name = name
+        self._start = None
+
+    def __enter__(self):
+        self._start = mtime()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        record(self._name, mtime() - self._start)
+        return False
+
+
+class _NoSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+def enable():
+    global _enabled
+    debug("tracing enabled")
+    _enabled = True
+
+
+def is_enabled():
+    return _enabled
+
+
+def span(name):
+    # with span("name"): ... records how long the block took, costs a single function call if tracing is disabled
+    if not _enabled:
+        return _NO_SPAN
+
+    return _Span(name)
+
+
+def record(name, seconds):
+    if not _enabled:
+        return
+
+    entry = _stats.get(name)
+    if entry is None:
+        entry = _stats.setdefault(name, [0, 0.0, deque(maxlen=_MAX_SAMPLES)])
+
+    entry[0] += 1
+    entry[1] = max(entry[1], seconds)
+    entry[2].append(seconds)
+
+
+def _percentile(sorted_samples, p):
+    return sorted_samples[min(len(sorted_samples) - 1, int(len(sorted_samples) * p))]
+
+
+def stats():
+    # name -> (count, p50, p95, max) in seconds
+    result = {}
+    for name in list(_stats):
+        count, maximum, samples = _stats[name]
+        samples = sorted(samples)
+        result[name] = (count, _percentile(samples, 0.5), _percentile(samples, 0.95), maximum)
+    return result
+
+
+def summary():
+    lines = ["%-32s %8s %10s %10s %10s" % ("name", "count", "p50 ms", "p95 ms", "max ms")]
+    current = stats()
+    for name in sorted(current):
+        count, p50, p95, maximum = current[name]
+        lines.append("%-32s %8d %10.2f %10.2f %10.2f" % (name, count, p50 * 1000, p95 * 1000, maximum * 1000))
+    return "\n".join(lines) + "\n"
+
+
+def dump(path):
+    if not _enabled:
+        return
+
+    debug("writing trace summary to " + path)
+    try:
+        with open(path, 'w') as trace_file:
+            trace_file.write(summary())
+    except IOError as e:
+        debug("could not write trace summary: " + str(e))
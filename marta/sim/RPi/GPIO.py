@@ -0,0 +1,71 @@
+# Simulated RPi.GPIO, see Simulation.py
+from threading import Lock
+from logging import getLogger
+
+debug = getLogger('   SimGPIO').debug
+
+BCM = 11
+OUT = 0
+IN = 1
+PUD_UP = 22
+RISING = 31
+FALLING = 32
+BOTH = 33
+HIGH = 1
+LOW = 0
+
+_lock = Lock()
+
+# pin -> level, all buttons are pulled up
+_levels = {}
+
+# pin -> (edge, callback)
+_callbacks = {}
+
+
+def setwarnings(flag):
+    pass
+
+
+def setmode(mode):
+    pass
+
+
+def setup(pin, direction, pull_up_down=None):
+    _levels[pin] = HIGH if pull_up_down == PUD_UP else LOW
+
+
+def add_event_detect(pin, edge, callback=None, bouncetime=None):
+    _callbacks[pin] = (edge, callback)
+
+
+def remove_event_detect(pin):
+    _callbacks.pop(pin, None)
+
+
+def input(pin):
+    return _levels.get(pin, HIGH)
+
+
+def output(pin, value):
+    _levels[pin] = 1 if value else 0
+
+
+def cleanup():
+    _levels.clear()
+    _callbacks.clear()
+
+
+################################################################
+# simulation controls
+
+def set_level(pin, level):
+    # like the real library, callbacks are called one after another
+    with _lock:
+        if _levels.get(pin) == level:
+            return
+
+        _levels[pin] = level
+        edge, callback = _callbacks.get(pin, (None, None))
+        if callback is not None and edge in [BOTH, RISING if level == HIGH else FALLING]:
+            callback(pin)
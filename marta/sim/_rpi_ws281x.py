@@ -0,0 +1,100 @@
+# Simulated rpi_ws281x SWIG wrapper, see Simulation.py
+WS2811_SUCCESS = 0
+WS2811_STRIP_RGB = 0x100800
+WS2811_STRIP_GRB = 0x081000
+
+_MAX_LEDS = 1024
+
+# counters for benchmarks
+stats = {"led_set": 0, "led_get": 0, "render": 0}
+
+
+class _Channel(object):
+    def __init__(self):
+        self.count = 0
+        self.gpionum = 0
+        self.invert = 0
+        self.brightness = 0
+        self.strip_type = WS2811_STRIP_RGB
+        self.leds = [0] * _MAX_LEDS
+
+
+class _Controller(object):
+    def __init__(self):
+        self.channels = [_Channel(), _Channel()]
+        self.freq = 0
+        self.dmanum = 0
+        self.rendered = []
+
+
+def new_ws2811_t():
+    return _Controller()
+
+
+def delete_ws2811_t(leds):
+    pass
+
+
+def ws2811_channel_get(leds, channum):
+    return leds.channels[channum]
+
+
+def ws2811_channel_t_count_set(channel, count):
+    channel.count = count
+
+
+def ws2811_channel_t_count_get(channel):
+    return channel.count
+
+
+def ws2811_channel_t_gpionum_set(channel, gpionum):
+    channel.gpionum = gpionum
+
+
+def ws2811_channel_t_invert_set(channel, invert):
+    channel.invert = invert
+
+
+def ws2811_channel_t_brightness_set(channel, brightness):
+    channel.brightness = brightness
+
+
+def ws2811_channel_t_brightness_get(channel):
+    return channel.brightness
+
+
+def ws2811_channel_t_strip_type_set(channel, strip_type):
+    channel.strip_type = strip_type
+
+
+def ws2811_t_freq_set(leds, freq):
+    leds.freq = freq
+
+
+def ws2811_t_dmanum_set(leds, dmanum):
+    leds.dmanum = dmanum
+
+
+def ws2811_init(leds):
+    return WS2811_SUCCESS
+
+
+def ws2811_render(leds):
+    stats["render"] += 1
+    channel = leds.channels[0]
+    leds.rendered = channel.leds[:channel.count]
+    return WS2811_SUCCESS
+
+
+def ws2811_get_return_t_str(resp):
+    return "simulated error " + str(resp)
+
+
+def ws2811_led_set(channel, n, value):
+    stats["led_set"] += 1
+    channel.leds[n] = value
+
+
+def ws2811_led_get(channel, n):
+    stats["led_get"] += 1
+    return channel.leds[n]
@@ -0,0 +1,128 @@
+# Simulated pyserial with an RDM6300 attached, see Simulation.py
+from threading import Condition, Thread
+from os import pipe, read, write, close, O_NONBLOCK
+from fcntl import fcntl, F_GETFL, F_SETFL
+from errno import EAGAIN
+from select import select
+from time import sleep
+from random import random, choice
+from monotonic import monotonic as mtime
+
+# the RDM6300 repeats the frame as long as the tag is in the field
+_FRAME_INTERVAL = 0.06
+
+_condition = Condition()
+_tag = None
+
+# probability of a byte being replaced by garbage
+_noise = 0.0
+
+# counters for benchmarks
+stats = {"reads": 0, "bytes": 0}
+
+
+def _frame(tag):
+    frame = "\x02" + tag + "\x03"
+    if _noise == 0:
+        return frame
+    return "".join(choice("\x00\x02\x03\xff0123456789ABCDEF") if random() < _noise else c for c in frame)
+
+
+class Serial(object):
+    # Like pyserial on the device, a read waits in the kernel: the RDM6300 side appends its frames from a thread of its
+    # own and writes a byte into a pipe for each of them, which is also the port's fileno() to poll.
+
+    def __init__(self, port=None, baudrate=9600, timeout=None):
+        self.port = port
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self._buffer = ""
+        self._closed = False
+
+        self._signal_read, self._signal_write = pipe()
+        fcntl(self._signal_read, F_SETFL, fcntl(self._signal_read, F_GETFL) | O_NONBLOCK)
+
+        self._sender = Thread(target=self._send_frames)
+        self._sender.daemon = True
+        self._sender.start()
+
+    def _send_frames(self):
+        # the reader repeats the frame every _FRAME_INTERVAL as long as the tag is in the field
+        while True:
+            with _condition:
+                while _tag is None and not self._closed:
+                    _condition.wait()
+
+                if self._closed:
+                    return
+
+                self._buffer += _frame(_tag)
+
+            write(self._signal_write, "x")
+            sleep(_FRAME_INTERVAL)
+
+    def _drain_signals(self):
+        try:
+            while len(read(self._signal_read, 4096)) is not 0:
+                pass
+        except OSError as e:
+            if e.errno != EAGAIN:
+                raise
+
+    def fileno(self):
+        return self._signal_read
+
+    @property
+    def in_waiting(self):
+        with _condition:
+            return len(self._buffer)
+
+    def read(self, size=1):
+        end = None if self.timeout is None else mtime() + self.timeout
+        stats["reads"] += 1
+        while True:
+            with _condition:
+                if self._closed:
+                    return ""
+
+                # a frame appended after this comes with a byte in the pipe, the select below won't miss it
+                self._drain_signals()
+                now = mtime()
+                if len(self._buffer) >= size or (len(self._buffer) is not 0 and self.timeout == 0) or (
+                        end is not None and now >= end):
+                    data = self._buffer[:size]
+                    self._buffer = self._buffer[size:]
+                    stats["bytes"] += len(data)
+                    return data
+
+            select([self._signal_read], [], [], None if end is None else end - now)
+
+    def close(self):
+        with _condition:
+            if self._closed:
+                return
+            self._closed = True
+            _condition.notify_all()
+
+        self._sender.join()
+        close(self._signal_read)
+        close(self._signal_write)
+
+
+################################################################
+# simulation controls
+
+def present_tag(tag):
+    global _tag
+    with _condition:
+        _tag = tag
+        _condition.notify_all()
+
+
+def remove_tag():
+    present_tag(None)
+
+
+def set_noise(probability):
+    global _noise
+    _noise = probability
@@ -0,0 +1,169 @@
+# Simulated smbus with an MPU-6050 attached, see Simulation.py
+from math import sin, radians, sqrt
+from random import gauss
+from threading import Lock
+from monotonic import monotonic as mtime
+
+_ACCEL_XOUT_H = 0x3b
+_GYRO_XOUT_H = 0x43
+_ACCEL_SCALE = 16384.0
+_GYRO_SCALE = 131.0
+
+_SMPLRT_DIV = 0x19
+_CONFIG = 0x1a
+_FIFO_EN = 0x23
+_INT_ENABLE = 0x38
+_USER_CTRL = 0x6a
+_FIFO_COUNT_H = 0x72
+_FIFO_COUNT_L = 0x73
+_FIFO_R_W = 0x74
+
+_USER_CTRL_FIFO_EN = 0x40
+_USER_CTRL_FIFO_RESET = 0x04
+_INT_ENABLE_MOTION = 0x40
+_FIFO_SIZE = 1024
+
+# noise of the accelerometer in g and of the gyro in degrees per second
+_NOISE = 0.01
+_GYRO_NOISE = 0.5
+
+# how fast the simulated device is tilted to a new position, in degrees per second
+_TILT_SPEED = 180.0
+
+# the gyro reports the average rate over this window, like the low pass filtered one does
+_GYRO_WINDOW = 0.02
+
+_lock = Lock()
+
+# tilting from _tilt_from at _tilt_start towards _tilt_to
+_tilt_from = (0.0, 0.0)
+_tilt_to = (0.0, 0.0)
+_tilt_start = 0.0
+
+# the MPU whose interrupt is enabled
+_motion_interrupt_bus = []
+
+# counters for benchmarks
+stats = {"transactions": 0, "bytes": 0}
+
+
+def _to_word_2c(value):
+    value = int(round(value))
+    value = max(-32768, min(32767, value))
+    return value & 0xFFFF
+
+
+def _tilt(now):
+    # (x rotation, y rotation)
+    tilt = []
+    for start, end in zip(_tilt_from, _tilt_to):
+        distance = end - start
+        # the FIFO is filled after the fact, samples from before the last set_tilt just see where it started
+        elapsed = max(0.0, now - _tilt_start)
+        if elapsed >= abs(distance) / _TILT_SPEED:
+            tilt.append(end)
+        else:
+            tilt.append(start + (1 if distance > 0 else -1) * _TILT_SPEED * elapsed)
+    return tilt
+
+
+def _sample_registers(now):
+    x_rotation, y_rotation = _tilt(now)
+    before = _tilt(now - _GYRO_WINDOW)
+    x_rate = (x_rotation - before[0]) / _GYRO_WINDOW
+    y_rate = (y_rotation - before[1]) / _GYRO_WINDOW
+    ay = sin(radians(x_rotation))
+    ax = -sin(radians(y_rotation))
+    az = sqrt(max(0.0, 1.0 - ax * ax - ay * ay))
+
+    registers = {}
+    for i, value in enumerate([ax, ay, az]):
+        word = _to_word_2c((value + gauss(0, _NOISE)) * _ACCEL_SCALE)
+        registers[_ACCEL_XOUT_H + 2 * i] = word >> 8
+        registers[_ACCEL_XOUT_H + 2 * i + 1] = word & 0xFF
+    for i, value in enumerate([x_rate, y_rate, 0.0]):
+        word = _to_word_2c((value + gauss(0, _GYRO_NOISE)) * _GYRO_SCALE)
+        registers[_GYRO_XOUT_H + 2 * i] = word >> 8
+        registers[_GYRO_XOUT_H + 2 * i + 1] = word & 0xFF
+    return registers
+
+
+class SMBus(object):
+    def __init__(self, bus=None):
+        self._registers = {}
+        self._fifo = []
+        self._fifo_time = 0.0
+
+    def _sample_rate(self):
+        gyro_rate = 1000.0 if 0 < self._registers.get(_CONFIG, 0) & 7 < 7 else 8000.0
+        return gyro_rate / (1 + self._registers.get(_SMPLRT_DIV, 0))
+
+    def _fill_fifo(self):
+        # the MPU samples into its FIFO at the sample rate, here it catches up whenever the FIFO is looked at
+        if not self._registers.get(_USER_CTRL, 0) & _USER_CTRL_FIFO_EN:
+            return
+
+        interval = 1 / self._sample_rate()
+        now = mtime()
+        while self._fifo_time + interval <= now:
+            self._fifo_time += interval
+            registers = _sample_registers(self._fifo_time)
+            self._fifo += [registers[r] for r in range(_ACCEL_XOUT_H, _ACCEL_XOUT_H + 6)]
+            self._fifo += [registers[r] for r in range(_GYRO_XOUT_H, _GYRO_XOUT_H + 6)]
+
+        # a full FIFO drops its oldest bytes, after that it's not aligned to samples anymore
+        self._fifo = self._fifo[-_FIFO_SIZE:]
+
+    def _read(self, register, length):
+        if register == _FIFO_R_W:
+            data = self._fifo[:length]
+            self._fifo = self._fifo[length:]
+            return data + [0] * (length - len(data))
+
+        if register == _FIFO_COUNT_H:
+            self._fill_fifo()
+            count = min(len(self._fifo), _FIFO_SIZE)
+            return [count >> 8, count & 0xFF][:length]
+
+        sample = _sample_registers(mtime())
+        return [sample.get(r, self._registers.get(r, 0)) for r in range(register, register + length)]
+
+    def write_byte_data(self, address, register, value):
+        with _lock:
+            stats["transactions"] += 1
+            stats["bytes"] += 1
+            self._registers[register] = value
+            if register == _INT_ENABLE and value & _INT_ENABLE_MOTION:
+                _motion_interrupt_bus[:] = [self]
+            if register == _USER_CTRL and value & _USER_CTRL_FIFO_RESET:
+                self._fifo = []
+                self._fifo_time = mtime()
+
+    def read_byte_data(self, address, register):
+        with _lock:
+            stats["transactions"] += 1
+            stats["bytes"] += 1
+            return self._read(register, 1)[0]
+
+    def read_i2c_block_data(self, address, register, length):
+        with _lock:
+            stats["transactions"] += 1
+            stats["bytes"] += length
+            return self._read(register, length)
+
+    def close(self):
+        pass
+
+
+################################################################
+# simulation controls
+
+def set_tilt(x_rotation, y_rotation):
+    # returns whether the motion interrupt fires
+    global _tilt_from, _tilt_to, _tilt_start
+    with _lock:
+        now = mtime()
+        _tilt_from = tuple(_tilt(now))
+        _tilt_to = (float(x_rotation), float(y_rotation))
+        _tilt_start = now
+        return _tilt_from != _tilt_to and len(_motion_interrupt_bus) is not 0
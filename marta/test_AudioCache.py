@@ -0,0 +1,126 @@
+import unittest
+from os import close, remove
+from tempfile import mkstemp
+from time import sleep
+
+from AudioCache import AudioCache, _file_stat
+
+ENTRY_SIZE = 100
+
+
+class _FakeCache(AudioCache):
+    # decodes nothing, every entry is ENTRY_SIZE bytes unless sizes says otherwise
+    def __init__(self, budget):
+        super(_FakeCache, self).__init__(budget)
+        self.sizes = {}
+
+    def _decode(self, file_name, position, seconds):
+        # entries warmed one after another must not share their last use
+        sleep(.002)
+        try:
+            file_stat = _file_stat(file_name)
+        except OSError:
+            file_stat = None
+        return "\0" * self.sizes.get(file_name, ENTRY_SIZE), False, file_stat
+
+
+class AudioCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = _FakeCache(budget=3 * ENTRY_SIZE)
+
+    def warm(self, *groups, **kwargs):
+        # one file per group, terminate() waits until all of them are decoded
+        for group in groups:
+            self.cache.warm(group, group + ".mp3", **kwargs)
+
+    def cached(self):
+        return sorted(file_name[:-4] for file_name, position in self.cache._entries)
+
+    def test_get(self):
+        self.warm("a")
+        self.cache.terminate()
+        self.assertEqual(("\0" * ENTRY_SIZE, False), self.cache.get("a.mp3", 0))
+        self.assertIsNone(self.cache.get("a.mp3", 4))
+        self.assertIsNone(self.cache.get("b.mp3", 0))
+        self.assertEqual(1, self.cache.stats["hits"])
+        self.assertEqual(2, self.cache.stats["misses"])
+
+    def test_least_recently_used_is_evicted(self):
+        self.warm("a", "b", "c", "d")
+        self.cache.terminate()
+        self.assertEqual(["b", "c", "d"], self.cached())
+        self.assertEqual(3 * ENTRY_SIZE, self.cache.size())
+        self.assertEqual(1, self.cache.stats["evictions"])
+
+    def test_least_used_is_evicted_first(self):
+        self.cache.use("a", 3)
+        self.cache.use("b")
+        self.cache.use("c", 2)
+        self.warm("a", "b", "c", "d")
+        self.cache.terminate()
+        self.assertEqual(["a", "c", "d"], self.cached())
+
+    def test_pinned_entries_stay(self):
+        self.warm("a", pinned=True)
+        self.warm("b", "c", "d")
+        self.cache.terminate()
+        self.assertEqual(["a", "c", "d"], self.cached())
+
+    def test_pinned_entries_may_exceed_the_budget(self):
+        self.warm("a", "b", "c", "d", pinned=True)
+        self.cache.terminate()
+        self.assertEqual(["a", "b", "c", "d"], self.cached())
+        self.assertEqual(0, self.cache.stats["evictions"])
+
+    def test_nothing_is_evicted_for_an_entry_that_cannot_fit(self):
+        self.cache.sizes["big.mp3"] = 3 * ENTRY_SIZE
+        self.warm("a", pinned=True)
+        self.warm("b", "c", "big")
+        self.cache.terminate()
+        self.assertEqual(["a", "b", "c"], self.cached())
+        self.assertEqual(0, self.cache.stats["evictions"])
+
+    def test_the_old_entry_of_a_group_stays_if_the_new_one_cannot_fit(self):
+        self.cache.sizes["big.mp3"] = 4 * ENTRY_SIZE
+        self.cache.warm("tag", "a.mp3")
+        self.cache.warm("tag", "big.mp3")
+        self.cache.terminate()
+        self.assertEqual(["a"], self.cached())
+
+    def test_the_old_entry_of_a_group_makes_room_for_the_new_one(self):
+        self.cache.sizes["big.mp3"] = 2 * ENTRY_SIZE
+        self.warm("a", pinned=True)
+        self.cache.warm("tag", "c.mp3")
+        self.cache.warm("tag", "big.mp3")
+        self.cache.terminate()
+        self.assertEqual(["a", "big"], self.cached())
+        self.assertEqual(0, self.cache.stats["evictions"])
+
+    def test_a_group_has_a_single_entry(self):
+        self.cache.warm("tag", "a.mp3")
+        self.cache.warm("tag", "b.mp3")
+        self.cache.terminate()
+        self.assertEqual(["b"], self.cached())
+        self.assertEqual(ENTRY_SIZE, self.cache.size())
+
+    def test_check_drops_replaced_files(self):
+        handle, file_name = mkstemp(suffix=".mp3")
+        close(handle)
+        try:
+            self.cache.warm("tag", file_name)
+            self.cache.terminate()
+
+            self.cache.check(file_name)
+            self.assertIsNotNone(self.cache.get(file_name, 0))
+
+            with open(file_name, 'wb') as f:
+                f.write("replaced")
+            self.cache.check(file_name)
+            self.assertIsNone(self.cache.get(file_name, 0))
+            self.assertEqual(0, self.cache.size())
+        finally:
+            remove(file_name)
+
+
+if __name__ == "__main__":
+    unittest.main()
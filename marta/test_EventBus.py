@@ -0,0 +1,59 @@
+import unittest
+from Queue import Empty
+
+from EventBus import EventBus
+
+
+class EventBusTest(unittest.TestCase):
+    def setUp(self):
+        self.bus = EventBus()
+
+    def messages(self):
+        messages = []
+        while True:
+            try:
+                messages.append(self.bus.get(timeout=0)[0])
+            except Empty:
+                return messages
+
+    def test_critical_messages_come_first(self):
+        self.bus.put(["a"])
+        self.bus.put(["b"], priority=EventBus.PRIORITY_CRITICAL)
+        self.bus.put(["c"])
+        self.bus.put(["d"], priority=EventBus.PRIORITY_CRITICAL)
+        self.assertEqual([["b"], ["d"], ["a"], ["c"]], self.messages())
+
+    def test_replace_keeps_the_latest_message_of_a_key(self):
+        self.bus.put(["rotation", 1], key="rotation", replace=True)
+        self.bus.put(["button"], key="button")
+        self.bus.put(["rotation", 2], key="rotation", replace=True)
+        self.assertEqual(2, self.bus.depth())
+        self.assertEqual([["button"], ["rotation", 2]], self.messages())
+
+    def test_take_removes_the_oldest_message_of_a_key(self):
+        self.bus.put(["red", 1], key="red")
+        self.bus.put(["green"], key="green")
+        self.bus.put(["red", 2], key="red")
+
+        self.assertEqual(["red", 1], self.bus.take("red"))
+        self.assertTrue(self.bus.has_pending("red"))
+        self.assertEqual(["red", 2], self.bus.take("red"))
+        self.assertIsNone(self.bus.take("red"))
+        self.assertFalse(self.bus.has_pending("red"))
+        self.assertEqual([["green"]], self.messages())
+        self.assertEqual(0, self.bus.depth())
+
+    def test_discard_keeps_the_given_keys(self):
+        self.bus.put(["stopped"])
+        self.bus.put(["tag"], key="tag")
+        self.bus.put(["button"], key="button")
+        self.bus.discard(["tag"])
+        self.assertEqual(1, self.bus.depth())
+        self.assertEqual([["tag"]], self.messages())
+
+    def test_get_times_out(self):
+        self.assertRaises(Empty, self.bus.get, 0.01)
+
+
+if __name__ == "__main__":
+    unittest.main()
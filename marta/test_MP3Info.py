@@ -0,0 +1,69 @@
+import unittest
+from os import close, remove
+from os.path import abspath, dirname, isfile, join
+from tempfile import mkstemp
+
+from MP3Info import _parse_header, get_mp3_info, check_frames
+
+# MPEG 1 layer III, 128 kbps, 44100 Hz, no padding, stereo
+HEADER = "\xFF\xFB\x90\x00"
+FRAME = HEADER + "\0" * 413
+
+STARTUP_SOUND = join(dirname(dirname(abspath(__file__))), "audio", "system", "startup.mp3")
+
+
+class MP3InfoTest(unittest.TestCase):
+    def setUp(self):
+        handle, self.file_name = mkstemp(suffix=".mp3")
+        close(handle)
+
+    def tearDown(self):
+        remove(self.file_name)
+
+    def write(self, data):
+        with open(self.file_name, 'wb') as f:
+            f.write(data)
+
+    def test_parse_header(self):
+        version, layer, bitrate, sample_rate, samples_per_frame, frame_length, mono = _parse_header(HEADER)
+        self.assertEqual((3, 1), (version, layer))
+        self.assertEqual(128, bitrate)
+        self.assertEqual(44100, sample_rate)
+        self.assertEqual(1152, samples_per_frame)
+        self.assertEqual(417, frame_length)
+        self.assertFalse(mono)
+
+    def test_parse_header_rejects_garbage(self):
+        self.assertIsNone(_parse_header("\0\0\0\0"))
+        self.assertIsNone(_parse_header("\xFF\xFB"))
+        # bitrate index 15 is invalid
+        self.assertIsNone(_parse_header("\xFF\xFB\xF0\x00"))
+
+    def test_cbr_length_is_estimated_from_the_size(self):
+        self.write(FRAME * 100)
+        info = get_mp3_info(self.file_name)
+        self.assertEqual(44100, info.sample_rate)
+        self.assertEqual(128, info.bitrate)
+        self.assertFalse(info.vbr)
+        self.assertAlmostEqual(100 * 1152, info.total_samples, delta=1152)
+
+    def test_check_frames(self):
+        self.write(FRAME * 100 + "TAG" + "\0" * 125)
+        self.assertEqual((100, None), check_frames(self.file_name))
+
+    def test_check_frames_finds_lost_sync(self):
+        self.write(FRAME * 50 + "garbage" + FRAME * 50)
+        frames, problem = check_frames(self.file_name)
+        self.assertEqual(50, frames)
+        self.assertEqual("lost frame sync at byte " + str(50 * len(FRAME)), problem)
+
+    @unittest.skipUnless(isfile(STARTUP_SOUND), "no startup sound")
+    def test_vbr_length_is_read_from_the_xing_header(self):
+        info = get_mp3_info(STARTUP_SOUND)
+        self.assertEqual(44100, info.sample_rate)
+        self.assertEqual(167251, info.total_samples)
+        self.assertTrue(info.vbr)
+
+
+if __name__ == "__main__":
+    unittest.main()
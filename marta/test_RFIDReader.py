@@ -0,0 +1,65 @@
+import unittest
+from sys import path
+
+from Simulation import SIM_DIR, make_tag
+
+# the simulated serial port, nothing is sent as long as no tag is placed
+path.insert(0, SIM_DIR)
+
+from Reactor import Reactor
+from RFIDReader import RFIDReader
+
+TAG = make_tag("0A0B0C0D0E")
+FRAME = RFIDReader.START_BYTE + TAG + RFIDReader.END_BYTE
+
+
+class RFIDReaderTest(unittest.TestCase):
+    def setUp(self):
+        self.detections = []
+        self.reactor = Reactor()
+        self.reactor.start()
+        self.reader = RFIDReader(self.detections.append, reactor=self.reactor)
+
+    def tearDown(self):
+        self.reader.terminate()
+        self.reactor.stop()
+
+    def parse(self, *chunks):
+        buf = ""
+        for chunk in chunks:
+            buf = self.reader._parse(buf + chunk)
+        return buf
+
+    def test_frame_split_across_reads(self):
+        self.assertEqual("", self.parse(FRAME[:3], FRAME[3:9], FRAME[9:]))
+        self.assertEqual([TAG], self.detections)
+        self.assertEqual(1, self.reader.stats["frames"])
+        self.assertEqual(0, self.reader.stats["resyncs"])
+
+    def test_incomplete_frame_is_kept(self):
+        self.assertEqual(FRAME[:5], self.parse(FRAME[:5]))
+        self.assertEqual([], self.detections)
+
+    def test_noise_is_skipped(self):
+        self.parse("\xff\x00", "\x02garbage" + FRAME[:4], FRAME[4:])
+        self.assertEqual([TAG], self.detections)
+        self.assertEqual(10, self.reader.stats["resyncs"])
+
+    def test_broken_checksum_is_no_detection(self):
+        self.parse(RFIDReader.START_BYTE + TAG[:-2] + "00" + RFIDReader.END_BYTE)
+        self.assertEqual([], self.detections)
+        self.assertEqual(1, self.reader.stats["errors"])
+
+    def test_repeated_frames_are_a_single_detection(self):
+        self.parse(FRAME * 3)
+        self.assertEqual([TAG], self.detections)
+        self.assertEqual(3, self.reader.stats["frames"])
+
+    def test_another_tag_removes_the_first_one(self):
+        other = make_tag("1A1B1C1D1E")
+        self.parse(FRAME, RFIDReader.START_BYTE + other + RFIDReader.END_BYTE)
+        self.assertEqual([TAG, None, other], self.detections)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,99 @@
+import unittest
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import sleep
+
+from StateStore import StateStore
+
+
+class StateStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.state_dir = mkdtemp(prefix="marta_state_")
+
+    def tearDown(self):
+        rmtree(self.state_dir)
+
+    def reopen(self, store):
+        store.terminate()
+        return StateStore(self.state_dir)
+
+    def append_to_journal(self, data):
+        with open(join(self.state_dir, StateStore.JOURNAL_FILE), 'ab') as journal_file:
+            journal_file.write(data)
+
+    def test_changes_survive_a_restart(self):
+        store = StateStore(self.state_dir)
+        store.set("position:a", "1 2000")
+        store.set("volume", 5)
+        self.assertEqual("5", store.get("volume"))
+
+        store = self.reopen(store)
+        self.assertEqual("1 2000", store.get("position:a"))
+        self.assertEqual("5", store.get("volume"))
+        store.terminate()
+
+    def test_a_burst_of_changes_is_written_at_once(self):
+        store = StateStore(self.state_dir, flush_delay=0.2)
+        for i in range(20):
+            store.set("key", i)
+            sleep(0.005)
+        sleep(0.4)
+        self.assertEqual(1, store.stats["flushes"])
+        store.terminate()
+
+    def test_a_torn_record_is_dropped_with_everything_after_it(self):
+        store = StateStore(self.state_dir)
+        store.set("a", "1")
+        store.terminate()
+
+        record = StateStore._record("b", "2")
+        self.append_to_journal(record[:-3])
+        self.append_to_journal(StateStore._record("c", "3"))
+
+        store = StateStore(self.state_dir)
+        self.assertEqual("1", store.get("a"))
+        self.assertIsNone(store.get("b"))
+        self.assertIsNone(store.get("c"))
+        store.terminate()
+
+    def test_a_record_with_a_wrong_checksum_is_dropped(self):
+        store = StateStore(self.state_dir)
+        store.terminate()
+
+        record = StateStore._record("a", "1")
+        self.append_to_journal(record.replace("\t1", "\t7"))
+
+        store = StateStore(self.state_dir)
+        self.assertIsNone(store.get("a"))
+        store.terminate()
+
+    def test_recovery_starts_over_with_an_empty_journal(self):
+        store = StateStore(self.state_dir)
+        store.set("a", "1")
+        store.terminate()
+        self.append_to_journal("garbage")
+
+        store = StateStore(self.state_dir)
+        self.assertEqual(1, store.stats["compactions"])
+        with open(join(self.state_dir, StateStore.JOURNAL_FILE), 'rb') as journal_file:
+            self.assertEqual("", journal_file.read())
+
+        store = self.reopen(store)
+        self.assertEqual("1", store.get("a"))
+        store.terminate()
+
+    def test_a_long_journal_is_compacted(self):
+        store = StateStore(self.state_dir)
+        for i in range(StateStore.MAX_JOURNAL_RECORDS):
+            store.set("key", i)
+            store.flush()
+        self.assertEqual(1, store.stats["compactions"])
+
+        store = self.reopen(store)
+        self.assertEqual(str(StateStore.MAX_JOURNAL_RECORDS - 1), store.get("key"))
+        store.terminate()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,59 @@
+import unittest
+
+from TiltFilter import TiltFilter, accel_rotation, zone
+
+LIMITS = [-45, 45]
+
+
+class TiltFilterTest(unittest.TestCase):
+    def test_accel_rotation(self):
+        self.assertEqual((0, 0), accel_rotation(0, 0, 1))
+        x, y = accel_rotation(0, 1, 1)
+        self.assertAlmostEqual(45, x)
+        self.assertAlmostEqual(0, y)
+        x, y = accel_rotation(1, 0, 1)
+        self.assertAlmostEqual(0, x)
+        self.assertAlmostEqual(-45, y)
+
+    def test_zone_without_current(self):
+        self.assertEqual(0, zone(-60, LIMITS))
+        self.assertEqual(1, zone(0, LIMITS))
+        self.assertEqual(2, zone(60, LIMITS))
+
+    def test_zone_is_left_beyond_the_hysteresis_only(self):
+        self.assertEqual(1, zone(48, LIMITS, current=1, hysteresis=5))
+        self.assertEqual(2, zone(51, LIMITS, current=1, hysteresis=5))
+        self.assertEqual(2, zone(42, LIMITS, current=2, hysteresis=5))
+        self.assertEqual(1, zone(39, LIMITS, current=2, hysteresis=5))
+        self.assertEqual(0, zone(-48, LIMITS, current=0, hysteresis=5))
+        self.assertEqual(1, zone(-39, LIMITS, current=0, hysteresis=5))
+
+    def test_zone_jumps_over_the_middle(self):
+        self.assertEqual(2, zone(60, LIMITS, current=0, hysteresis=5))
+
+    def test_first_sample_is_taken_from_the_accelerometer(self):
+        tilt_filter = TiltFilter()
+        x, y = tilt_filter.update(0, 1, 1, 100, 100, 0.01)
+        self.assertAlmostEqual(45, x)
+        self.assertAlmostEqual(0, y)
+
+    def test_filter_converges_to_the_accelerometer(self):
+        tilt_filter = TiltFilter()
+        tilt_filter.update(0, 0, 1, 0, 0, 0.01)
+        for _ in range(500):
+            x, y = tilt_filter.update(0, 1, 1, 0, 0, 0.01)
+        self.assertAlmostEqual(45, x, places=3)
+        self.assertAlmostEqual(0, y, places=3)
+
+    def test_gyro_follows_fast_movements(self):
+        tilt_filter = TiltFilter()
+        tilt_filter.update(0, 0, 1, 0, 0, 0.01)
+        # 90 degrees per second for 0.1 s, the accelerometer hasn't noticed yet
+        for _ in range(10):
+            x, y = tilt_filter.update(0, 0, 1, 90, 0, 0.01)
+        self.assertGreater(x, 5)
+        self.assertLess(x, 9)
+
+
+if __name__ == "__main__":
+    unittest.main()